@@ -1,21 +1,63 @@
 """
 classes to manage development boxes
 """
-import pickle
+from bisect import bisect_left, insort
 from sys import stderr
+from threading import RLock
 from time import time
 
+from DevBoxInventoryMetrics import metrics
+from DevBoxInventorySnapshot import DevBoxInventorySnapshot
+from DevBoxInventoryStorage import DevBoxInventoryPickleStorage
+
+
+# owner names are shared by many boxes - keep a single copy of each name
+_user_names = {}
+
+
+def _intern_user(user):
+
+    if user is None:
+        return None
+
+    return _user_names.setdefault(user, user)
+
+
+class DevBoxInventoryConflict(Exception):
+    """
+    a box was changed by someone else between reading and changing it
+    """
+    pass
+
 
 class DevBox(object):
     """
-    represents a development box
+    represents a development box - lease is None or (time the lease ends, channel it was taken in)
     """
-    def __init__(self, name, ip=None, user=None, comment=None, taken_timestamp=None):
+    __slots__ = ('_name', '_ip', '_user', '_comment', '_taken_timestamp', '_lease')
+
+    def __init__(self, name, ip=None, user=None, comment=None, taken_timestamp=None, lease=None):
         self._name = name
         self._ip = ip
-        self._user = user
+        self._user = _intern_user(user)
         self._comment = comment
         self._taken_timestamp = taken_timestamp
+        self._lease = lease
+
+    def __getstate__(self):
+        return self._name, self._ip, self._user, self._comment, self._taken_timestamp, self._lease
+
+    def __setstate__(self, state):
+
+        if isinstance(state, dict):
+            # boxes pickled by v0.2 and older carry their instance dict
+            state = (state.get('_name'), state.get('_ip'), state.get('_user'), state.get('_comment'),
+                     state.get('_taken_timestamp'))
+
+        # boxes pickled before leases were introduced have no lease
+        self._name, self._ip, user, self._comment, self._taken_timestamp = state[:5]
+        self._lease = tuple(state[5]) if len(state) > 5 and state[5] else None
+        self._user = _intern_user(user)
 
     @property
     def name(self):
@@ -35,7 +77,7 @@ class DevBox(object):
 
     @user.setter
     def user(self, value):
-        self._user = value
+        self._user = _intern_user(value)
 
     @property
     def comment(self):
@@ -53,114 +95,488 @@ class DevBox(object):
     def taken_timestamp(self, value):
         self._taken_timestamp = value
 
+    @property
+    def lease(self):
+        return self._lease
+
+    @lease.setter
+    def lease(self, value):
+        self._lease = tuple(value) if value else None
+
 
 class DevBoxInventory(object):
     """
     manage a set of DevBoxes
+
+    The boxes are persisted by a storage backend (see DevBoxInventoryStorage), if none is given the inventory is
+    stored as pickle file.
+
+    Besides the boxes by name the inventory keeps indexes of the boxes by owner, by ip, of the free boxes and a
+    sorted list of the box names. They are built by the first query needing them - a storage that decodes boxes on
+    first access does not have to read all of them on load - and updated on every change from then on so queries on
+    them don't need to look at all boxes. The first query looking at all boxes of such a storage has them decoded
+    before it takes the lock, so other queries and changes do not wait for that.
+
+    A shared storage may be changed by other processes. The inventory checks for such changes before every query
+    and change and reloads itself if there are any. Changes are done holding the lock of the storage, box_data_set
+    may be given the box data the change is based on and fails with DevBoxInventoryConflict if the box looks
+    different by now.
+
+    If a history (see DevBoxInventoryHistory) is given every change of the owner of a box and every delete of a box
+    is recorded in it. Stats (see DevBoxInventoryStats) are told about them once the change is committed, their
+    journal is made durable by the writes of the storage.
     """
-    def __init__(self, inventory_file):
+    def __init__(self, inventory_file, journal_size=0, commit_window=0, storage=None, history=None, stats=None):
 
         self._inventory_file = inventory_file
-        self._inventory = []
+        self._history = history
+        self._stats = stats
+        # calls telling the stats about changes not committed yet
+        self._stats_pending = []
+        self._lock = RLock()
+        # incremented on every change of the inventory
+        self._version = 0
+
+        if storage is None:
+            storage = DevBoxInventoryPickleStorage(inventory_file, journal_size, commit_window)
+        self._storage = storage
+        if stats is not None:
+            self._storage.sync_with(stats.commit)
 
         try:
-            self._load()
-        except IOError as error:
-            try:
-                self._save()
-            except Exception as error:
-                stderr.write(str(error))
-                exit(1)
+            # box name -> DevBox, keeps the insertion order for show
+            with metrics.timer('inventory_load_seconds'):
+                self._inventory = self._storage.load(DevBox, self._lock)
         except Exception as error:
             stderr.write(str(error))
             exit(1)
 
-    def _save(self):
-
-        try:
-            with open(self._inventory_file, "wb") as inv_file:
-                pickle.dump(self._inventory, inv_file)
-
-                return len(self._inventory)
-
-        except Exception as error:
-            raise Exception('Failed to create inventory file in `{0}` cause: {1}'.format(self._inventory_file, error))
+        self._index_build()
+
+    def _index_build(self):
+
+        # the indexes are built by _index_ensure
+        self._position = None
+
+    def _index_ensure(self):
 
-    def _load(self):
+        # called with the lock held
+        if self._position is not None:
+            return
+
+        # box name -> position in the inventory, used to return index query results in inventory order
+        self._position = {}
+        self._next_position = 0
+        # user -> set of box names, ip -> set of box names, names of boxes without user
+        self._by_user = {}
+        self._by_ip = {}
+        self._free = set()
+        # all box names in sorted order for prefix lookups
+        self._sorted_names = sorted(self._inventory)
+        for box in self._inventory.values():
+            self._position[box.name] = self._next_position
+            self._next_position += 1
+            self._index_add(box)
+
+    def _refresh(self):
+
+        # called with the lock held: pick up the changes other processes sharing the storage made
+        inventory = self._storage.refresh()
+        if inventory is not None:
+            self._inventory = inventory
+            self._index_build()
+            self._version += 1
+
+    def _index_add(self, box):
+
+        if self._position is None:
+            return
+        if box.user:
+            self._by_user.setdefault(box.user, set()).add(box.name)
+        else:
+            self._free.add(box.name)
+        if box.ip:
+            self._by_ip.setdefault(box.ip, set()).add(box.name)
+
+    def _index_remove(self, box):
+
+        if self._position is None:
+            return
+        if box.user:
+            names = self._by_user[box.user]
+            names.discard(box.name)
+            if not names:
+                del self._by_user[box.user]
+        else:
+            self._free.discard(box.name)
+        if box.ip:
+            names = self._by_ip[box.ip]
+            names.discard(box.name)
+            if not names:
+                del self._by_ip[box.ip]
+
+    def _index_box_added(self, box):
+
+        if self._position is None:
+            return
+        self._position[box.name] = self._next_position
+        self._next_position += 1
+        self._index_add(box)
+        insort(self._sorted_names, box.name)
+
+    def _index_box_deleted(self, box):
+
+        if self._position is None:
+            return
+        del self._position[box.name]
+        del self._sorted_names[bisect_left(self._sorted_names, box.name)]
+        self._index_remove(box)
+
+    def _box_names_with_prefix(self, prefix):
+
+        names = []
+        for idx in range(bisect_left(self._sorted_names, prefix), len(self._sorted_names)):
+            name = self._sorted_names[idx]
+            if not name.startswith(prefix):
+                break
+            names.append(name)
+
+        return names
+
+    def _box_datas_of(self, names):
+
+        with self._lock:
+            boxes = [self._inventory[name] for name in sorted(names, key=self._position.__getitem__)]
+
+        return [(box.name, box.ip, box.user, box.comment, box.taken_timestamp) for box in boxes]
+
+    def _box_datas_named(self, names):
+
+        # called with the lock held - names in inventory order
+        boxes = [self._inventory[name] for name in names]
+
+        return [(box.name, box.ip, box.user, box.comment, box.taken_timestamp) for box in boxes]
+
+    def _boxes_decode(self):
+
+        # called without the lock held by queries looking at all boxes: a snapshot decodes the boxes not accessed yet
+        # (see DevBoxInventorySnapshot.decode) before the query takes the lock - only the first of them has to
+        with self._lock:
+            self._refresh()
+            inventory = self._inventory
+        if isinstance(inventory, DevBoxInventorySnapshot):
+            inventory.decode()
+
+    def _commit(self):
+
+        # called holding the lock of the storage - the stats only learn about changes that were committed: every
+        # change reported to the storage so far is durable once commit returns
+        with self._lock:
+            stats_pending, self._stats_pending = self._stats_pending, []
+        self._storage.commit()
+        for stats_call, args in stats_pending:
+            stats_call(*args)
+
+    def __len__(self):
+        return len(self._inventory)
+
+    def close(self):
+        """
+        flush and close the storage, the history and the stats
+        """
+        self._storage.close()
+        if self._history is not None:
+            self._history.close()
+        if self._stats is not None:
+            self._stats.close()
 
-        try:
-            with open(self._inventory_file, "rb") as inv_file:
-                self._inventory = pickle.load(inv_file)
-
-                return len(self._inventory)
-        except IOError as error:
-            if error.errno == 2:
-                raise IOError('File not found')
-            else:
-                raise Exception('Failed to load inventory file from `{0}` cause: {1}'.format(self._inventory_file, error))
-        except EOFError as error:
-            raise Exception(
-                'Failed to load inventory file from `{0}` cause file is empty or has invalid format.'.format(
-                    self._inventory_file))
-
-        except Exception as error:
-            raise Exception('Failed to load inventory file from `{0}` cause: {1}'.format(self._inventory_file, error))
+    @property
+    def version(self):
+        """
+        changes whenever a box is added, deleted or changed
+        """
+        with self._lock:
+            self._refresh()
+            return self._version
 
     def box_add(self, name, ip=None, user=None, comment=None):
 
-        for box in self._inventory:
-            if box.name == name:
-                return 0
+        with self._storage.exclusive():
+            with self._lock:
+                self._refresh()
+                if name in self._inventory:
+                    return 0
 
-        self._inventory.append(DevBox(name, ip, user, comment))
-        self._save()
+                box = self._inventory[name] = DevBox(name, ip, user, comment)
+                self._index_box_added(box)
+                self._version += 1
+                self._storage.box_added(box)
+            self._commit()
 
         return 1
 
-    def box_del(self, name):
+    def box_add_many(self, box_datas):
+        """
+        add the boxes given as (name, ip, user, comment) with a single write - all or none: if one of the names is
+        in use no box is added. Returns the names in use.
+        """
+        with self._storage.exclusive():
+            with self._lock:
+                self._refresh()
+                in_use = [box_data[0] for box_data in box_datas if box_data[0] in self._inventory]
+                if in_use or not box_datas:
+                    return in_use
+
+                for name, ip, user, comment in box_datas:
+                    box = self._inventory[name] = DevBox(name, ip, user, comment)
+                    self._index_box_added(box)
+                    self._storage.box_added(box)
+                self._version += 1
+            self._commit()
+
+        return []
 
-        for box in self._inventory:
+    def box_del(self, name):
 
-            if box.name == name:
-                self._inventory.remove(box)
-                self._save()
-                return 1
+        with self._storage.exclusive():
+            with self._lock:
+                self._refresh()
+                box = self._inventory.pop(name, None)
+                if box is None:
+                    return 0
+
+                self._index_box_deleted(box)
+                self._version += 1
+                self._storage.box_deleted(box)
+                if self._history is not None:
+                    self._history.record('del', name, '', box.user)
+                if self._stats is not None:
+                    self._stats_pending.append((self._stats.box_deleted, (name, time())))
+            self._commit()
 
-        return 0
+        return 1
 
     def box_data_get(self, name):
 
-        for box in self._inventory:
-
-            if box.name == name:
-                return box.name, box.ip, box.user, box.comment
-
-        return None, None, None, None
+        with self._lock:
+            self._refresh()
+            box = self._inventory.get(name)
+            if box is None:
+                return None, None, None, None
+
+            return box.name, box.ip, box.user, box.comment
+
+    def box_data_set(self, name, ip=None, user=None, comment=None, expected=None, lease=None):
+        """
+        change the box - if expected (box data as returned by box_data_get) is given the box is only changed if it
+        still looks like this, DevBoxInventoryConflict is raised otherwise. A change of the owner ends the lease of
+        the box, lease sets a new one.
+        """
+        with self._storage.exclusive():
+            with self._lock:
+                self._refresh()
+                box = self._inventory.get(name)
+                if box is None:
+                    return 0
+                if expected is not None and (box.name, box.ip, box.user, box.comment) != tuple(expected):
+                    raise DevBoxInventoryConflict('box {0} was changed in the meantime'.format(name))
+
+                self._box_change(box, ip, user, comment, lease)
+                self._version += 1
+            self._commit()
 
-    def box_data_set(self, name, ip=None, user=None, comment=None):
-
-        for box in self._inventory:
-
-            if box.name == name:
-                if ip is not None:
-                    box.ip = ip
-                if user is not None:
-                    if box.user != user:
-                        box.taken_timestamp = time()
-                    box.user = user
-                if comment is not None:
-                    box.comment = comment
-                self._save()
-                return 1
+        return 1
 
-        return 0
+    def box_lease_get(self, name):
+        """
+        (owner, time the lease ends, channel) of the box or None if it has no lease
+        """
+        with self._lock:
+            self._refresh()
+            box = self._inventory.get(name)
+            if box is None or box.lease is None or not box.user:
+                return None
+
+            return (box.user,) + box.lease
+
+    def box_leases(self):
+        """
+        (name, owner, time the lease ends, channel) of all boxes having a lease
+        """
+        with self._lock:
+            self._refresh()
+            if isinstance(self._inventory, DevBoxInventorySnapshot):
+                # only the boxes in the lease table of the snapshot are decoded
+                boxes = self._inventory.leases()
+            else:
+                boxes = self._inventory.values()
+            return [(box.name, box.user) + box.lease for box in boxes if box.lease and box.user]
+
+    def box_lease_expire(self, name, lease_end):
+        """
+        drop the ownership of the box if its lease ends at lease_end - returns the former owner or None if the box
+        got another lease or owner in the meantime
+        """
+        with self._storage.exclusive():
+            with self._lock:
+                self._refresh()
+                box = self._inventory.get(name)
+                if box is None or not box.user or box.lease is None or box.lease[0] != lease_end:
+                    return None
+
+                user = box.user
+                self._box_change(box, None, '', None)
+                self._version += 1
+            self._commit()
+
+        return user
+
+    def box_data_set_many(self, changes):
+        """
+        change several boxes with a single write - changes is a list of (name, ip, user, comment, expected) as taken
+        by box_data_set. All or none: returns 0 if one of the boxes does not exist, raises DevBoxInventoryConflict
+        if one of them does not look as expected. Returns the number of changed boxes otherwise.
+        """
+        with self._storage.exclusive():
+            with self._lock:
+                self._refresh()
+                boxes = []
+                for name, ip, user, comment, expected in changes:
+                    box = self._inventory.get(name)
+                    if box is None:
+                        return 0
+                    if expected is not None and (box.name, box.ip, box.user, box.comment) != tuple(expected):
+                        raise DevBoxInventoryConflict('box {0} was changed in the meantime'.format(name))
+                    boxes.append(box)
+                if not boxes:
+                    return 0
+
+                for box, (_, ip, user, comment, _) in zip(boxes, changes):
+                    self._box_change(box, ip, user, comment)
+                self._version += 1
+            self._commit()
+
+        return len(boxes)
+
+    def _box_change(self, box, ip, user, comment, lease=None):
+
+        # called with the lock held
+        self._index_remove(box)
+        if ip is not None:
+            box.ip = ip
+        if user is not None:
+            if box.user != user:
+                box.taken_timestamp = time()
+                box.lease = None
+                if self._history is not None and (user or box.user):
+                    self._history.record('put' if not user else 'occupy' if box.user else 'take', box.name, user,
+                                         box.user)
+                if self._stats is not None and (user or box.user):
+                    self._stats_pending.append((self._stats.owner_changed, (box.name, box.user, user,
+                                                                            box.taken_timestamp)))
+            box.user = user
+        if lease is not None:
+            box.lease = lease
+        if comment is not None:
+            box.comment = comment
+        self._index_add(box)
+        self._storage.box_changed(box)
 
     def box_names(self):
 
-        for box in self._inventory:
-            yield box.name
+        with self._lock:
+            self._refresh()
+            return list(self._inventory)
 
     def box_datas(self):
+        """
+        snapshot of the data of all boxes
+        """
+        self._boxes_decode()
+        with self._lock:
+            self._refresh()
+            return [(box.name, box.ip, box.user, box.comment, box.taken_timestamp) for box in self._inventory.values()]
+
+    def box_datas_apply(self, func):
+        """
+        call func with the data of all boxes - no box is changed until it returns, not even by other processes
+        sharing the storage
+        """
+        self._boxes_decode()
+        with self._storage.exclusive():
+            with self._lock:
+                self._refresh()
+                return func([(box.name, box.ip, box.user, box.comment, box.taken_timestamp)
+                             for box in self._inventory.values()])
+
+    def box_datas_by_user(self, user):
+        """
+        data of all boxes owned by user - the query is pushed down to the storage if it supports it
+        """
+        self._boxes_decode()
+        with self._lock:
+            self._refresh()
+            names = self._storage.box_names_by_user(user)
+            if names is not None:
+                return self._box_datas_named(names)
+            self._index_ensure()
+            return self._box_datas_of(self._by_user.get(user, ()))
+
+    def box_datas_by_ip(self, ip):
+        """
+        data of all boxes having the given ip - the query is pushed down to the storage if it supports it
+        """
+        self._boxes_decode()
+        with self._lock:
+            self._refresh()
+            names = self._storage.box_names_by_ip(ip)
+            if names is not None:
+                return self._box_datas_named(names)
+            self._index_ensure()
+            return self._box_datas_of(self._by_ip.get(ip, ()))
+
+    def box_datas_free(self):
+        """
+        data of all boxes not owned by anyone
+        """
+        self._boxes_decode()
+        with self._lock:
+            self._refresh()
+            self._index_ensure()
+            return self._box_datas_of(self._free)
+
+    def box_datas_filter(self, box_filter):
+        """
+        data of all boxes matching the DevBoxFilter - owner and ip are pushed down to the storage if it supports it,
+        otherwise the smallest index matching the filter is used to find the candidates, only if there is none all
+        boxes are checked
+        """
+        self._boxes_decode()
+        with self._lock:
+            self._refresh()
+            names = None
+            if box_filter.owner:
+                names = self._storage.box_names_by_user(box_filter.owner)
+            elif box_filter.ip is not None:
+                names = self._storage.box_names_by_ip(box_filter.ip)
+            if names is not None:
+                return [(box.name, box.ip, box.user, box.comment, box.taken_timestamp)
+                        for box in (self._inventory[name] for name in names) if box_filter.match(box)]
+
+            self._index_ensure()
+            candidates = []
+            if box_filter.owner is not None:
+                candidates.append(self._by_user.get(box_filter.owner, ()) if box_filter.owner else self._free)
+            if box_filter.ip is not None:
+                candidates.append(self._by_ip.get(box_filter.ip, ()))
+            if box_filter.prefix:
+                candidates.append(self._box_names_with_prefix(box_filter.prefix))
+
+            if candidates:
+                names = sorted(min(candidates, key=len), key=self._position.__getitem__)
+                boxes = [self._inventory[name] for name in names]
+            else:
+                boxes = self._inventory.values()
 
-        for box in self._inventory:
-            yield box.name, box.ip, box.user, box.comment, box.taken_timestamp
+            return [(box.name, box.ip, box.user, box.comment, box.taken_timestamp)
+                    for box in boxes if box_filter.match(box)]
@@ -0,0 +1,77 @@
+"""
+asyncio based event loop for the DevBoxInventorySlackBot (python 3 only)
+"""
+import asyncio
+import syslog
+from concurrent.futures import ThreadPoolExecutor
+
+
+class DevBoxInventoryAsyncRunner(object):
+    """
+    runs the bot without polling: the loop sleeps until the RTM websocket becomes readable and hands every batch of
+    events to a worker thread, so parsing commands and posting replies never blocks receiving the next frames
+    """
+    def __init__(self, bot, idle_timeout=1.0):
+
+        self._bot = bot
+        # we wake up at least every idle_timeout seconds to notice a restart requested by a command
+        self._idle_timeout = idle_timeout
+        # one worker - the commands of a batch and the batches are executed in the order they were received
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._tasks = set()
+
+    def run(self):
+
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self._run(loop))
+        finally:
+            loop.close()
+
+    async def _run(self, loop):
+
+        bot = self._bot
+        bot._running = True
+
+        if not bot.slack_client.rtm_connect():
+            syslog.syslog(syslog.LOG_ERR, 'slack-bot {0} failed to connect to slack. check token and bot name.'.format(
+                bot.bot_user_name))
+            return
+
+        syslog.syslog(syslog.LOG_INFO, 'slack-bot {0} started (asyncio).'.format(bot.bot_user_name))
+
+        readable = asyncio.Event()
+        sock_fd = bot.slack_client.server.websocket.sock.fileno()
+        loop.add_reader(sock_fd, readable.set)
+        try:
+            while bot._running:
+                try:
+                    await asyncio.wait_for(readable.wait(), self._idle_timeout)
+                except asyncio.TimeoutError:
+                    continue
+                readable.clear()
+
+                # a readable socket may carry several frames and TLS may buffer some of them - read until empty
+                while True:
+                    events = bot.rtm_read()
+                    if not events:
+                        break
+                    self._dispatch(loop, events)
+        finally:
+            loop.remove_reader(sock_fd)
+            if self._tasks:
+                await asyncio.wait(self._tasks)
+            self._executor.shutdown(wait=True)
+
+    def _dispatch(self, loop, events):
+
+        task = loop.run_in_executor(self._executor, self._bot.parse_slack_output, events)
+        self._tasks.add(task)
+        task.add_done_callback(self._task_done)
+
+    def _task_done(self, task):
+
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            syslog.syslog(syslog.LOG_ERR, 'slack-bot {0} failed to handle events: {1}'.format(
+                self._bot.bot_user_name, task.exception()))
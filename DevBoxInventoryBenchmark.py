@@ -0,0 +1,313 @@
+"""
+benchmarks for the DevBoxInventory - run offline: python DevBoxInventoryBenchmark.py [--output <file>]
+
+The results are printed and - if an output file is given - written as json so runs of different commits can be
+compared.
+"""
+import argparse
+import gc
+import json
+import pickle
+import platform
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import timeit
+from collections import OrderedDict
+from os import path
+from time import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from DevBoxInventory import DevBox, DevBoxInventory
+from DevBoxInventoryCmdParser import DevBoxInventoryCmdParser
+from DevBoxInventoryCmdParserLegacy import DevBoxInventoryCmdParserLegacy
+from DevBoxInventoryRenderer import DevBoxInventoryRenderer
+from DevBoxInventorySlackBot import DevBoxInventorySlackBot
+from DevBoxInventorySnapshot import snapshot_dumps
+from DevBoxInventoryStorage import storage_create
+
+# storage configurations the inventory operations are measured with: name -> (storage type, journal size)
+STORAGES = OrderedDict([('pickle', ('pickle', 0)),
+                        ('journal', ('pickle', 1000)),
+                        ('snapshot', ('snapshot', 0)),
+                        ('sqlite', ('sqlite', 0))])
+
+
+class _LegacyDevBox(object):
+    """
+    DevBox as stored up to v0.2 - plain object with an instance dict
+    """
+    def __init__(self, name, ip=None, user=None, comment=None, taken_timestamp=None):
+        self._name = name
+        self._ip = ip
+        self._user = user
+        self._comment = comment
+        self._taken_timestamp = taken_timestamp
+
+
+def _make_boxes(box_type, count, user_count=50):
+
+    # build the user names on the fly like slack messages do - every box gets its own copy of the string
+    return [box_type('box{0:06}'.format(i),
+                     '10.{0}.{1}.{2}'.format(i >> 16 & 0xff, i >> 8 & 0xff, i & 0xff),
+                     ''.join(['user', str(i % user_count)]),
+                     'comment {0}'.format(i % 10),
+                     1474398312.0 + i)
+            for i in range(count)]
+
+
+def bench_memory(box_type, count):
+    """
+    memory used to hold count boxes (bytes, None if tracemalloc is not available) and their pickle size
+    """
+    gc.collect()
+    boxes = None
+    memory = None
+
+    if tracemalloc is not None:
+        tracemalloc.start()
+        boxes = _make_boxes(box_type, count)
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+    else:
+        boxes = _make_boxes(box_type, count)
+
+    return memory, len(pickle.dumps(boxes, pickle.HIGHEST_PROTOCOL))
+
+
+def bench_parser(parser_type, arg_count, number=200):
+    """
+    seconds to parse a command line carrying arg_count arguments
+    """
+    parser = parser_type('inventory', ['update'], ['ip', 'comment'])
+    cmd_line = '<@inventory> update foo ' + ' '.join('ip:1.2.3.{0} comment:"foo bar {0}"'.format(i)
+                                                     for i in range(arg_count))
+
+    return min(timeit.repeat(lambda: parser.parse(cmd_line), number=number, repeat=3)) / number
+
+
+def _latency(samples):
+    """
+    summary of a list of latencies in seconds
+    """
+    samples = sorted(samples)
+    return {'count': len(samples),
+            'avg': sum(samples) / len(samples),
+            'p50': samples[len(samples) // 2],
+            'max': samples[-1]}
+
+
+def _inventory_file_create(storage_type, inventory_file, count):
+
+    # write the boxes in one go - adding them one by one would save the inventory count times
+    boxes = _make_boxes(DevBox, count)
+    if storage_type == 'pickle':
+        with open(inventory_file, 'wb') as inv_file:
+            pickle.dump(OrderedDict((box.name, box) for box in boxes), inv_file)
+    elif storage_type == 'snapshot':
+        with open(inventory_file, 'wb') as inv_file:
+            inv_file.write(snapshot_dumps(OrderedDict((box.name, box) for box in boxes)))
+    else:
+        storage_create(storage_type, inventory_file).load(DevBox, None)
+        db = sqlite3.connect(inventory_file)
+        db.executemany('INSERT INTO boxes (name, ip, user, comment, taken_timestamp) VALUES (?, ?, ?, ?, ?)',
+                       ((box.name, box.ip, box.user, box.comment, box.taken_timestamp) for box in boxes))
+        db.commit()
+        db.close()
+
+
+def _inventory_open(storage_name, inventory_file):
+
+    storage_type, journal_size = STORAGES[storage_name]
+    return DevBoxInventory(inventory_file, storage=storage_create(storage_type, inventory_file, journal_size))
+
+
+def bench_load(storage_name, inventory_file, repeat=3):
+    """
+    seconds to open an inventory - reading the storage, the indexes are built by the first query needing them
+    """
+    samples = []
+    for _ in range(repeat):
+        start = timeit.default_timer()
+        inventory = _inventory_open(storage_name, inventory_file)
+        samples.append(timeit.default_timer() - start)
+        inventory.close()
+
+    return min(samples)
+
+
+def bench_load_memory(storage_name, inventory_file):
+    """
+    memory held by an opened inventory (bytes, None if tracemalloc is not available)
+    """
+    if tracemalloc is None:
+        return None
+
+    gc.collect()
+    tracemalloc.start()
+    inventory = _inventory_open(storage_name, inventory_file)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    inventory.close()
+
+    return memory
+
+
+def bench_ops(inventory, number=20):
+    """
+    latency of box_add, box_data_set and box_del including writing the change to the storage
+    """
+    results = OrderedDict()
+    names = ['bench{0:06}'.format(i) for i in range(number)]
+
+    for op, call in (('box_add', lambda name: inventory.box_add(name, ip='192.168.0.1', comment='bench')),
+                     ('box_data_set', lambda name: inventory.box_data_set(name, user='bench', comment='taken')),
+                     ('box_del', lambda name: inventory.box_del(name))):
+        samples = []
+        for name in names:
+            start = timeit.default_timer()
+            call(name)
+            samples.append(timeit.default_timer() - start)
+        results[op] = _latency(samples)
+
+    return results
+
+
+def bench_show(inventory, number=5):
+    """
+    seconds to answer show (all boxes, first messages only) and show mine - cold: nothing rendered yet,
+    warm: rows cached but not the output, cached: answered from the output cache
+    """
+    # a bot without slack connection - show only needs the inventory and the renderer
+    bot = DevBoxInventorySlackBot.__new__(DevBoxInventorySlackBot)
+    bot.inventory = inventory
+    show_all = {'owner': None, 'comment': None, 'ip': None}
+    show_mine = {'owner': 'user1', 'comment': None, 'ip': None}
+
+    def show_cold():
+        bot._renderer = DevBoxInventoryRenderer()
+        bot._show(None, show_all, None)
+
+    bot._renderer = DevBoxInventoryRenderer()
+    bot._show(None, show_all, None)
+    bot._show(None, show_mine, None)
+    cache_key = (None, None, None, None, None)
+    bot._renderer.output_put(inventory.version, cache_key, bot._show(None, show_all, None))
+
+    return OrderedDict([
+        ('show_cold', min(timeit.repeat(show_cold, number=number, repeat=3)) / number),
+        ('show_warm', min(timeit.repeat(lambda: bot._show(None, show_all, None), number=number, repeat=3)) / number),
+        ('show_mine', min(timeit.repeat(lambda: bot._show(None, show_mine, None), number=number, repeat=3)) / number),
+        ('show_cached', min(timeit.repeat(lambda: bot._renderer.output_get(inventory.version, cache_key),
+                                          number=number, repeat=3)) / number)])
+
+
+def show_regressions(inventory_results, factor=1.5):
+    """
+    (count, storage, seconds, seconds of pickle) of the storages answering show (warm) more than factor times slower
+    than the pickle storage - a storage decoding boxes on first use must keep them once show needed all of them
+    """
+    regressions = []
+    for count, storages in inventory_results.items():
+        pickle_show = storages['pickle']['show']['show_warm']
+        for storage_name, result in storages.items():
+            if result['show']['show_warm'] > pickle_show * factor:
+                regressions.append((count, storage_name, result['show']['show_warm'], pickle_show))
+
+    return regressions
+
+
+def _commit_get():
+
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=path.dirname(path.abspath(__file__))).decode().strip()
+    except Exception:
+        return None
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='benchmark the DevBoxInventory')
+    parser.add_argument('--output', help='write the results as json to this file')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 1000, 10000, 100000],
+                        help='inventory sizes to measure')
+    args = parser.parse_args()
+
+    results = OrderedDict([('timestamp', time()),
+                           ('commit', _commit_get()),
+                           ('python', platform.python_version()),
+                           ('parser', OrderedDict()),
+                           ('memory', OrderedDict()),
+                           ('inventory', OrderedDict())])
+
+    print('{0:10}{1:>16}{2:>16}'.format('args', 'legacy [us]', 'parser [us]'))
+    for arg_count in (1, 10, 100, 1000):
+        legacy = bench_parser(DevBoxInventoryCmdParserLegacy, arg_count)
+        current = bench_parser(DevBoxInventoryCmdParser, arg_count)
+        results['parser'][arg_count] = {'legacy': legacy, 'parser': current}
+        print('{0:<10}{1:>16.1f}{2:>16.1f}'.format(arg_count, legacy * 1e6, current * 1e6))
+    print('')
+
+    print('{0:10}{1:>10}{2:>16}{3:>16}'.format('count', 'type', 'memory [B]', 'pickle [B]'))
+    for count in (10000, 100000):
+        results['memory'][count] = OrderedDict()
+        for box_type in (_LegacyDevBox, DevBox):
+            memory, pickle_size = bench_memory(box_type, count)
+            type_name = 'legacy' if box_type is _LegacyDevBox else 'slotted'
+            results['memory'][count][type_name] = {'memory': memory, 'pickle': pickle_size}
+            print('{0:<10}{1:>10}{2:>16}{3:>16}'.format(count,
+                                                        type_name,
+                                                        memory if memory is not None else '-',
+                                                        pickle_size))
+    print('')
+
+    print('{0:10}{1:>10}{2:>12}{3:>12}{4:>12}{5:>12}{6:>12}{7:>12}{8:>12}{9:>12}'.format(
+        'count', 'storage', 'load [ms]', 'load [kB]', 'add [ms]', 'set [ms]', 'del [ms]', 'show [ms]', 'warm [ms]',
+        'mine [ms]'))
+    tmp_dir = tempfile.mkdtemp(prefix='inventory-bench-')
+    try:
+        for count in args.sizes:
+            results['inventory'][count] = OrderedDict()
+            for storage_name in STORAGES:
+                inventory_file = path.join(tmp_dir, '{0}-{1}'.format(storage_name, count))
+                _inventory_file_create(STORAGES[storage_name][0], inventory_file, count)
+
+                load = bench_load(storage_name, inventory_file)
+                load_memory = bench_load_memory(storage_name, inventory_file)
+                inventory = _inventory_open(storage_name, inventory_file)
+                try:
+                    ops = bench_ops(inventory)
+                    show = bench_show(inventory)
+                finally:
+                    inventory.close()
+
+                results['inventory'][count][storage_name] = OrderedDict([('load', load),
+                                                                         ('load_memory', load_memory),
+                                                                         ('ops', ops),
+                                                                         ('show', show)])
+                print('{0:<10}{1:>10}{2:>12.2f}{3:>12}{4:>12.2f}{5:>12.2f}{6:>12.2f}{7:>12.2f}{8:>12.2f}'
+                      '{9:>12.2f}'.format(
+                    count, storage_name, load * 1e3, load_memory // 1024 if load_memory is not None else '-',
+                    ops['box_add']['avg'] * 1e3, ops['box_data_set']['avg'] * 1e3, ops['box_del']['avg'] * 1e3,
+                    show['show_cold'] * 1e3, show['show_warm'] * 1e3, show['show_mine'] * 1e3))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    results['show_regressions'] = show_regressions(results['inventory'])
+    for count, storage_name, seconds, pickle_seconds in results['show_regressions']:
+        print('show on {0} boxes of {1} takes {2:.2f}ms - pickle takes {3:.2f}ms'.format(
+            count, storage_name, seconds * 1e3, pickle_seconds * 1e3))
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""
+read lists of boxes pasted to slack (CSV or YAML) for bulk adds
+"""
+import csv
+import re
+
+import yaml
+
+from DevBoxInventoryFilter import DevBoxFilter
+
+# columns of a box list - lists without header use this order
+BOX_COLUMNS = ('name', 'ip', 'comment')
+
+
+def _unescape(text):
+
+    # slack escapes these three characters in messages
+    return text.replace('&lt;', '<').replace('&gt;', '>').replace('&amp;', '&')
+
+
+def _csv_rows(lines):
+
+    if str is bytes:
+        # python 2 - the csv module does not read unicode
+        return [[cell.decode('utf-8') for cell in row]
+                for row in csv.reader([line.encode('utf-8') for line in lines], skipinitialspace=True)]
+
+    return list(csv.reader(lines, skipinitialspace=True))
+
+
+def _boxes_from_csv(lines):
+
+    rows = [row for row in _csv_rows(lines) if any(cell.strip() for cell in row)]
+    columns = BOX_COLUMNS
+    if rows and rows[0] and rows[0][0].strip().lower() == 'name':
+        columns = tuple(cell.strip().lower() for cell in rows.pop(0))
+        unknown = [column for column in columns if column not in BOX_COLUMNS]
+        if unknown:
+            raise ValueError('unknown column {0}'.format(unknown[0]))
+
+    boxes = []
+    for line_no, row in enumerate(rows, 1):
+        if len(row) > len(columns):
+            raise ValueError('row {0} has more than {1} columns'.format(line_no, len(columns)))
+        boxes.append(dict((column, cell.strip()) for column, cell in zip(columns, row)))
+
+    return boxes
+
+
+def _boxes_from_yaml(text):
+
+    try:
+        items = yaml.safe_load(text)
+    except yaml.YAMLError as error:
+        raise ValueError('invalid YAML: {0}'.format(str(error).splitlines()[0]))
+
+    if not isinstance(items, list):
+        raise ValueError('YAML must be a list of boxes')
+
+    boxes = []
+    for item in items:
+        if not isinstance(item, dict):
+            item = {'name': item}
+        unknown = [key for key in item if key not in BOX_COLUMNS]
+        if unknown:
+            raise ValueError('unknown key {0}'.format(unknown[0]))
+        boxes.append(dict((key, u'{0}'.format(value).strip()) for key, value in item.items() if value is not None))
+
+    return boxes
+
+
+def boxes_parse(text):
+    """
+    parse a list of boxes - CSV (name[,ip[,comment]] with optional header line) or a YAML list of names or
+    mappings having the keys name, ip and comment. Returns a list of (name, ip, comment), raises ValueError if the
+    list is invalid.
+    """
+    lines = [line for line in _unescape(text).strip().strip('`').splitlines() if line.strip()]
+    if not lines:
+        raise ValueError('no boxes given')
+
+    if lines[0].lstrip().startswith('-'):
+        boxes = _boxes_from_yaml('\n'.join(lines))
+    else:
+        boxes = _boxes_from_csv(lines)
+
+    result = []
+    names = set()
+    for box in boxes:
+        name = box.get('name', '')
+        if not name or re.search(r'\s', name):
+            raise ValueError('invalid box name "{0}"'.format(name))
+        if DevBoxFilter.is_pattern(name):
+            raise ValueError('box name {0} contains wildcards'.format(name))
+        if name in names:
+            raise ValueError('box {0} is given twice'.format(name))
+        names.add(name)
+        result.append((name, box.get('ip') or None, box.get('comment') or None))
+
+    return result
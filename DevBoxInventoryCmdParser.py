@@ -1,5 +1,70 @@
+class DevBoxInventoryCmd(object):
+    """
+    immutable result of parsing a command line - body holds the lines following the command line, if any
+    """
+    __slots__ = ('_cmd', '_machine_name', '_args', '_reminder', '_body')
+
+    def __init__(self, cmd, machine_name, args, reminder, body=None):
+        self._cmd = cmd
+        self._machine_name = machine_name
+        self._args = dict(args)
+        self._reminder = reminder
+        self._body = body
+
+    def has_cmd(self):
+        return self._cmd is not None
+
+    def has_machine_name(self):
+        return self._machine_name is not None and len(self._machine_name) > 0
+
+    def has_reminder(self):
+        return self._reminder is not None and len(self._reminder) > 0
+
+    def has_body(self):
+        return self._body is not None and len(self._body.strip()) > 0
+
+    @property
+    def cmd(self):
+        return self._cmd
+
+    @property
+    def machine_name(self):
+        return self._machine_name
+
+    @property
+    def reminder(self):
+        return self._reminder
+
+    @property
+    def body(self):
+        return self._body
+
+    def has_arg(self, arg_name):
+        return self._args.get(arg_name) is not None
+
+    def get_arg(self, arg_name):
+        return self._args.get(arg_name)
+
+
+class _ParseState(object):
+    """
+    state of a single parse run
+    """
+    def __init__(self, arg_list):
+        self.cmd = None
+        self.machine_name = None
+        self.arg_list = dict((arg_name, None) for arg_name in arg_list)
+        self.reminder = None
+
+
 class DevBoxInventoryCmdParser(object):
+    """
+    parses command lines of the form <@bot> <cmd> [<machine name>] [<arg>:<value> ...]
 
+    parse_cmd is reentrant and returns a DevBoxInventoryCmd, the lines following the first line of a message are
+    passed on as its body. parse keeps the result of the last call in the parser and is kept for single threaded
+    users.
+    """
     def __init__(self, bot_name, cmd_list, arg_list):
 
         assert len(bot_name) > 0
@@ -8,6 +73,8 @@ class DevBoxInventoryCmdParser(object):
 
         self._bot_name = '<@{0}>'.format(bot_name)
         self._cmd_list = cmd_list
+        self._cmd_set = set(cmd_list)
+        self._arg_names = list(arg_list)
         self._machine_name = None
         self._arg_list = dict()
         for arg_name in arg_list:
@@ -58,124 +125,105 @@ class DevBoxInventoryCmdParser(object):
         else:
             return None
 
-    def _reset_state(self):
-
-        for key in self._arg_list:
-            self._arg_list[key] = None
-
-        self._machine_name = None
-        self._reminder = None
-        self._cmd = None
-        self._error = None
-
-    def _read_bot_name(self, cmd_line):
+    @staticmethod
+    def _skip_space(cmd_line, pos):
 
-        cmd_line = cmd_line.strip()
+        end = len(cmd_line)
+        while pos < end and cmd_line[pos].isspace():
+            pos += 1
 
-        if cmd_line.startswith('{0} '.format(self._bot_name)) or \
-                        cmd_line.startswith(self._bot_name) and len(cmd_line) == len(self._bot_name):
-                return True, cmd_line[len(self._bot_name):].strip()
+        return pos
 
-        return False, cmd_line
+    def _parse(self, state, cmd_line):
 
-    def _read_command(self, cmd_line):
+        # single pass over the line: pos moves from token to token, nothing but the tokens is copied
+        cmd_line = cmd_line.strip().replace('\t', ' ')
+        state.reminder = cmd_line
+        end = len(cmd_line)
 
-        cmd_line = cmd_line.strip()
-        if not cmd_line:
-            return True, ''
+        bot_name_len = len(self._bot_name)
+        if not cmd_line.startswith(self._bot_name) or (end > bot_name_len and cmd_line[bot_name_len] != ' '):
+            return False
 
-        cmd = cmd_line.split(' ', 1)[0]
+        pos = self._skip_space(cmd_line, bot_name_len)
+        state.reminder = ''
+        if pos == end:
+            return True
 
-        if cmd not in self._cmd_list:
+        token_end = cmd_line.find(' ', pos)
+        if token_end < 0:
+            token_end = end
+        cmd = cmd_line[pos:token_end]
+        if cmd not in self._cmd_set:
+            state.reminder = cmd_line[pos:]
             raise Exception('unknown command {0}'.format(cmd))
+        state.cmd = cmd
+        pos = self._skip_space(cmd_line, token_end)
 
-        self._cmd = cmd
-
-        return True, cmd_line[len(cmd):].strip()
-
-    def _read_machine_name(self, cmd_line):
-
-        cmd_line = cmd_line.strip()
-
-        if not cmd_line:
-            return True, ''
-
-        self._machine_name = cmd_line.split(' ', 1)[0]
-
-        return True, cmd_line[len(self._machine_name):].strip()
-
-    def _read_argument_name(self, cmd_line):
-
-        self._current_arg = ''
-
-        cmd_line = cmd_line.strip()
-        if not cmd_line:
-            return True, ''
-
-        self._current_arg = cmd_line.split(':', 1)[0]
-
-        if self._current_arg not in self._arg_list:
-            raise Exception('unknown argument name {0}'.format(self._current_arg))
-
-        self._arg_list[self._current_arg] = ''
-
-        return True, cmd_line[len(self._current_arg) + 1:]
-
-    def _read_argument_value(self, cmd_line):
-
-        if not cmd_line:
-            return True, ''
-
-        if cmd_line.startswith('"'):
-
-            cmd_line = cmd_line[1:]
-
-            try:
-                idx = cmd_line.index('"')
-                self._arg_list[self._current_arg] = cmd_line[:idx]
-
-                return True, cmd_line[len(self._arg_list[self._current_arg]) + 1:].strip()
-
-            except ValueError:
-                raise Exception('invalid quotation of argument value for argument {0}.'.format(self._current_arg))
-
-        else:
-            if cmd_line.startswith(' '):
-                self._arg_list[self._current_arg] = ''
-                return True, cmd_line[1:].strip()
-
-            self._arg_list[self._current_arg] = cmd_line.split(' ', 1)[0]
-            return True, cmd_line[len(self._arg_list[self._current_arg]):].strip()
-
-    def parse(self, cmd_line):
-
-        self._reset_state()
-        cmd_line = cmd_line.strip().replace('\t', ' ')
-        self._reminder = cmd_line
-
-        rc, self._reminder = self._read_bot_name(cmd_line)
-        if rc is False:
-            return False
-        if not self._reminder:
+        if pos == end:
             return True
 
-        rc, self._reminder = self._read_command(self._reminder)
-        if rc is False:
-            return False
+        token_end = cmd_line.find(' ', pos)
+        if token_end < 0:
+            token_end = end
+        state.machine_name = cmd_line[pos:token_end]
+        pos = self._skip_space(cmd_line, token_end)
+
+        while pos < end:
+
+            # <arg-name>:
+            token_end = cmd_line.find(':', pos)
+            if token_end < 0:
+                token_end = end
+            arg_name = cmd_line[pos:token_end]
+            if arg_name not in state.arg_list:
+                state.reminder = cmd_line[pos:]
+                raise Exception('unknown argument name {0}'.format(arg_name))
+            state.arg_list[arg_name] = ''
+            pos = min(token_end + 1, end)
+
+            if pos == end:
+                break
+
+            # <arg-value>, "<arg value>" or nothing if followed by a space
+            if cmd_line[pos] == '"':
+                token_end = cmd_line.find('"', pos + 1)
+                if token_end < 0:
+                    state.reminder = cmd_line[pos:]
+                    raise Exception('invalid quotation of argument value for argument {0}.'.format(arg_name))
+                state.arg_list[arg_name] = cmd_line[pos + 1:token_end]
+                pos = self._skip_space(cmd_line, token_end + 1)
+            elif cmd_line[pos] == ' ':
+                pos = self._skip_space(cmd_line, pos + 1)
+            else:
+                token_end = cmd_line.find(' ', pos)
+                if token_end < 0:
+                    token_end = end
+                state.arg_list[arg_name] = cmd_line[pos:token_end]
+                pos = self._skip_space(cmd_line, token_end)
 
-        rc, self._reminder = self._read_machine_name(self._reminder)
-
-        if rc is False:
-            return False
+        return True
 
-        while self._reminder:
+    def parse_cmd(self, cmd_line):
+        """
+        parse the command line - returns a DevBoxInventoryCmd or None if the line is not addressed to the bot, raises
+        an Exception on unknown commands or arguments
+        """
+        cmd_line, _, body = cmd_line.strip().partition('\n')
+        state = _ParseState(self._arg_names)
+        if not self._parse(state, cmd_line):
+            return None
 
-            rc, self._reminder = self._read_argument_name(self._reminder)
-            if not rc:
-                return False
+        return DevBoxInventoryCmd(state.cmd, state.machine_name, state.arg_list, state.reminder, body or None)
 
-            rc, self._reminder = self._read_argument_value(self._reminder)
-            if not rc:
-                return False
+    def parse(self, cmd_line):
 
-        return True
+        state = _ParseState(self._arg_names)
+        try:
+            return self._parse(state, cmd_line)
+        finally:
+            self._cmd = state.cmd
+            self._machine_name = state.machine_name
+            self._arg_list = state.arg_list
+            self._reminder = state.reminder
+            self._error = None
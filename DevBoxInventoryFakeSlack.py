@@ -0,0 +1,234 @@
+"""
+local stand-in for slack - serves the parts of the web api and the RTM websocket the DevBoxInventorySlackBot uses
+"""
+import base64
+import hashlib
+import json
+import socket
+import struct
+from threading import Lock, Thread
+from time import sleep, time
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs
+
+_WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+
+class _FakeSlackHTTPServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _FakeSlackHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+
+        fake = self.server.fake
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length).decode('utf-8')
+        args = dict((key, values[-1]) for key, values in parse_qs(body, keep_blank_values=True).items())
+
+        if not self.path.startswith('/api/'):
+            self._reply(404, {'ok': False, 'error': 'not_found'})
+            return
+
+        status, result = fake.api(self.path[len('/api/'):], args)
+        self._reply(status, result)
+
+    def do_GET(self):
+
+        if self.path != '/rtm' or self.headers.get('Upgrade', '').lower() != 'websocket':
+            self._reply(404, {'ok': False, 'error': 'not_found'})
+            return
+
+        key = self.headers.get('Sec-WebSocket-Key', '')
+        accept = base64.b64encode(hashlib.sha1((key + _WEBSOCKET_GUID).encode('ascii')).digest()).decode('ascii')
+        self.send_response(101, 'Switching Protocols')
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', accept)
+        self.end_headers()
+        self.wfile.flush()
+
+        self.close_connection = True
+        self.server.fake.rtm_serve(self.connection, self.rfile)
+
+    def _reply(self, status, result):
+
+        body = json.dumps(result).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class DevBoxInventoryFakeSlack(object):
+    """
+    serves rtm.start, users.list, users.info and chat.postMessage on http://host:port/api/ and an RTM websocket
+
+    Events given to send_event are pushed to all RTM connections, every posted message is put to the queue posts as
+    (time received, channel, text). post_delay adds a fixed latency to every web api call.
+    """
+    def __init__(self, users, host='127.0.0.1', port=0, post_delay=0.0):
+
+        # user id -> user name
+        self._users = users
+        self._post_delay = post_delay
+        self.posts = Queue()
+
+        self._connections = []
+        self._connections_lock = Lock()
+
+        self._server = _FakeSlackHTTPServer((host, port), _FakeSlackHandler)
+        self._server.fake = self
+        self._thread = None
+
+    @property
+    def api_url(self):
+        return 'http://{0}:{1}/api/'.format(*self._server.server_address[:2])
+
+    @property
+    def rtm_url(self):
+        return 'ws://{0}:{1}/rtm'.format(*self._server.server_address[:2])
+
+    @property
+    def connections(self):
+        return len(self._connections)
+
+    def start(self):
+
+        self._thread = Thread(target=self._server.serve_forever, name='fake-slack')
+        self._thread.daemon = True
+        self._thread.start()
+
+        return self
+
+    def stop(self):
+
+        self._server.shutdown()
+        self._server.server_close()
+        with self._connections_lock:
+            for connection in self._connections:
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+            self._connections = []
+
+    def send_event(self, event):
+
+        frame = self._frame(json.dumps(event).encode('utf-8'))
+        with self._connections_lock:
+            for connection in self._connections:
+                try:
+                    connection.sendall(frame)
+                except socket.error:
+                    pass
+
+    def api(self, method, args):
+        """
+        answer a web api call - returns the http status and the result
+        """
+        if self._post_delay:
+            sleep(self._post_delay)
+
+        if method == 'rtm.start':
+            return 200, {'ok': True,
+                         'url': self.rtm_url,
+                         'team': {'domain': 'fake'},
+                         'self': {'name': 'fake'},
+                         'channels': [], 'groups': [], 'ims': [], 'users': []}
+
+        if method == 'users.list':
+            user_ids = sorted(self._users)
+            start = int(args.get('cursor') or 0)
+            end = start + int(args.get('limit') or len(user_ids))
+            return 200, {'ok': True,
+                         'members': [{'id': user_id, 'name': self._users[user_id]} for user_id in user_ids[start:end]],
+                         'response_metadata': {'next_cursor': str(end) if end < len(user_ids) else ''}}
+
+        if method == 'users.info':
+            user_id = args.get('user')
+            if user_id not in self._users:
+                return 200, {'ok': False, 'error': 'user_not_found'}
+            return 200, {'ok': True, 'user': {'id': user_id, 'name': self._users[user_id]}}
+
+        if method == 'chat.postMessage':
+            self.posts.put((time(), args.get('channel'), args.get('text')))
+            return 200, {'ok': True, 'channel': args.get('channel'), 'ts': '{0:.6f}'.format(time())}
+
+        return 200, {'ok': False, 'error': 'unknown_method'}
+
+    def rtm_serve(self, connection, rfile):
+        """
+        keep the RTM connection until the client closes it - called by the handler of the websocket upgrade
+        """
+        with self._connections_lock:
+            self._connections.append(connection)
+
+        try:
+            while True:
+                opcode, payload = self._frame_read(rfile)
+                if opcode is None or opcode == 0x8:
+                    return
+                if opcode == 0x9:
+                    connection.sendall(self._frame(payload, 0xa))
+        except (socket.error, ValueError):
+            pass
+        finally:
+            with self._connections_lock:
+                if connection in self._connections:
+                    self._connections.remove(connection)
+
+    @staticmethod
+    def _frame(payload, opcode=0x1):
+
+        # server frames are never masked
+        length = len(payload)
+        if length < 126:
+            header = struct.pack('!BB', 0x80 | opcode, length)
+        elif length < 1 << 16:
+            header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+
+        return header + payload
+
+    @staticmethod
+    def _frame_read(rfile):
+
+        header = rfile.read(2)
+        if len(header) < 2:
+            return None, None
+
+        first, second = struct.unpack('!BB', header)
+        length = second & 0x7f
+        if length == 126:
+            length = struct.unpack('!H', rfile.read(2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', rfile.read(8))[0]
+
+        mask = bytearray(rfile.read(4)) if second & 0x80 else None
+        payload = bytearray(rfile.read(length))
+        if mask:
+            for idx in range(len(payload)):
+                payload[idx] ^= mask[idx % 4]
+
+        return first & 0x0f, bytes(payload)
@@ -0,0 +1,119 @@
+"""
+filter for the boxes of the DevBoxInventory
+"""
+import fnmatch
+import re
+from binascii import hexlify
+from socket import AF_INET, AF_INET6, error as socket_error, inet_pton
+
+
+def _ip_parse(address):
+    """
+    returns (address family, address as int) of the given IPv4 or IPv6 address or None if it is invalid
+    """
+    family = AF_INET6 if ':' in address else AF_INET
+    try:
+        return family, int(hexlify(inet_pton(family, address.strip())), 16)
+    except (socket_error, ValueError, UnicodeError):
+        return None
+
+
+class DevBoxFilter(object):
+    """
+    compiled filter on box name (shell-style wildcard), owner, comment (substring, ignores case) and ip (address or
+    network in CIDR notation)
+
+    An owner of '' selects the free boxes. Use DevBoxFilter.compile to reuse filters compiled before.
+    """
+    _cache = {}
+    _cache_size = 256
+
+    def __init__(self, pattern=None, owner=None, comment=None, ip=None):
+
+        self._pattern = pattern
+        self._name_match = None
+        self._prefix = None
+        if pattern:
+            self._name_match = re.compile(fnmatch.translate(pattern)).match
+            # literal part of the pattern in front of the first wildcard, used to look up the names by prefix
+            self._prefix = re.split(r'[*?\[]', pattern, 1)[0]
+
+        self._owner = owner
+        self._comment = comment.lower() if comment else None
+
+        self._ip = None
+        self._network = None
+        if ip:
+            if '/' in ip:
+                address, _, prefix_len = ip.partition('/')
+                network = _ip_parse(address)
+                max_len = 32 if network and network[0] == AF_INET else 128
+                if network is None or not prefix_len.isdigit() or int(prefix_len) > max_len:
+                    raise Exception('invalid network {0}'.format(ip))
+                shift = max_len - int(prefix_len)
+                self._network = network[0], network[1] >> shift, shift
+            else:
+                self._ip = ip
+
+    @classmethod
+    def compile(cls, pattern=None, owner=None, comment=None, ip=None):
+
+        key = (pattern, owner, comment, ip)
+        box_filter = cls._cache.get(key)
+        if box_filter is None:
+            if len(cls._cache) >= cls._cache_size:
+                cls._cache.clear()
+            box_filter = cls._cache[key] = cls(pattern, owner, comment, ip)
+
+        return box_filter
+
+    @staticmethod
+    def is_pattern(name):
+        """
+        True if the name contains shell-style wildcards
+        """
+        return re.search(r'[*?\[]', name) is not None
+
+    @property
+    def pattern(self):
+        return self._pattern
+
+    @property
+    def prefix(self):
+        return self._prefix
+
+    @property
+    def owner(self):
+        return self._owner
+
+    @property
+    def ip(self):
+        return self._ip
+
+    def is_empty(self):
+        return not self._pattern and self._owner is None and self._comment is None and \
+            self._ip is None and self._network is None
+
+    def match(self, box):
+
+        if self._name_match is not None and self._name_match(box.name) is None:
+            return False
+
+        if self._owner is not None and (box.user or '') != self._owner:
+            return False
+
+        if self._comment is not None and (not box.comment or self._comment not in box.comment.lower()):
+            return False
+
+        if self._ip is not None and box.ip != self._ip:
+            return False
+
+        if self._network is not None:
+            if not box.ip:
+                return False
+            address = _ip_parse(box.ip)
+            family, network, shift = self._network
+            if address is None or address[0] != family or address[1] >> shift != network:
+                return False
+
+        return True
@@ -0,0 +1,199 @@
+"""
+append-only history of the ownership changes of the boxes
+"""
+import fcntl
+import json
+import os
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from os import path
+from threading import Lock
+from time import time
+
+from DevBoxInventoryMetrics import metrics
+
+# events of the history - take: a free box got an owner, occupy: the owner was replaced, put: the owner dropped
+# the box (or its lease ended), del: the box was deleted
+HISTORY_EVENTS = ('take', 'occupy', 'put', 'del')
+
+
+class DevBoxInventoryHistory(object):
+    """
+    records every ownership change in segments of about segment_size bytes below history_dir
+
+    A segment is named by the time of its first event in milliseconds, so the segments are sorted by time and the
+    one holding a given time is found by bisect. Each event is a line: time, event, box, owner and previous owner
+    separated by tabs. Events are appended holding a file lock and get their time inside of it, so the events of a
+    segment are sorted by time even if several bots share the history.
+
+    Per segment an index maps the box name to the times and the file offsets of its events. When a segment is full
+    its index is written next to it (<segment>.idx) and a new segment is started. The index of the current segment
+    is kept in memory and extended by reading what was appended since the last look. A query reads the indexes of
+    the segments it needs - newest first until enough events are found - and the lines of the box only.
+    """
+    segment_size = 1 << 20
+    # indexes of full segments kept in memory
+    index_cache_size = 16
+
+    def __init__(self, history_dir, segment_size=None):
+
+        self._dir = history_dir
+        if not path.isdir(history_dir):
+            os.makedirs(history_dir)
+        if segment_size is not None:
+            self.segment_size = segment_size
+
+        self._lock = Lock()
+        self._lock_file = open(path.join(history_dir, 'lock'), 'a')
+        # start times of the segments in ms, sorted
+        self._segments = []
+        # the newest segment: its start, its index, the bytes of it that are indexed and the file appended to
+        self._current = None
+        self._current_index = {}
+        self._current_size = 0
+        self._current_file = None
+        # start -> index of full segments
+        self._index_cache = OrderedDict()
+
+        with self._lock:
+            self._segments_scan()
+
+    def _segment_path(self, start, ext='.log'):
+
+        return path.join(self._dir, '{0:015d}{1}'.format(start, ext))
+
+    def _segments_scan(self):
+
+        # called with the lock held
+        self._segments = sorted(int(file_name[:-4]) for file_name in os.listdir(self._dir)
+                                if file_name.endswith('.log') and file_name[:-4].isdigit())
+        current = self._segments[-1] if self._segments else None
+        if current != self._current:
+            if self._current_file is not None:
+                self._current_file.close()
+            self._current = current
+            self._current_index = {}
+            self._current_size = 0
+            self._current_file = open(self._segment_path(current), 'ab') if current is not None else None
+
+    @staticmethod
+    def _index_read(segment_file, index, offset):
+        """
+        add the events from offset to the end of the segment to the index - returns the offset behind the last
+        complete line
+        """
+        with open(segment_file, 'rb') as segment:
+            segment.seek(offset)
+            for line in segment:
+                if not line.endswith(b'\n'):
+                    break
+                ts, _, name = line.split(b'\t', 3)[:3]
+                times, offsets = index.setdefault(name.decode('utf-8'), ([], []))
+                times.append(float(ts))
+                offsets.append(offset)
+                offset += len(line)
+
+        return offset
+
+    def _current_update(self):
+
+        # called with the lock held - a full segment was sealed by another bot sharing the history
+        if self._current is None or path.exists(self._segment_path(self._current, '.idx')):
+            self._segments_scan()
+        if self._current is not None:
+            self._current_size = self._index_read(self._segment_path(self._current), self._current_index,
+                                                  self._current_size)
+
+    def _segment_index(self, start):
+
+        # called with the lock held
+        if start == self._current:
+            return self._current_index
+
+        index = self._index_cache.pop(start, None)
+        if index is None:
+            try:
+                with open(self._segment_path(start, '.idx')) as index_file:
+                    index = dict((name, tuple(entries)) for name, entries in json.load(index_file).items())
+            except (IOError, OSError, ValueError):
+                # the bot stopped before it wrote the index
+                index = {}
+                self._index_read(self._segment_path(start), index, 0)
+                self._index_write(start, index)
+
+        self._index_cache[start] = index
+        while len(self._index_cache) > self.index_cache_size:
+            self._index_cache.popitem(last=False)
+
+        return index
+
+    def _index_write(self, start, index):
+
+        index_file = self._segment_path(start, '.idx')
+        with open(index_file + '.tmp', 'w') as tmp_file:
+            json.dump(index, tmp_file, separators=(',', ':'))
+        os.rename(index_file + '.tmp', index_file)
+
+    def record(self, event, name, user, prev_user):
+
+        with self._lock:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            try:
+                self._current_update()
+                ts = time()
+                if self._current is None or self._current_size >= self.segment_size:
+                    if self._current is not None:
+                        self._index_write(self._current, self._current_index)
+                    # segments are ordered by their name - never start one before the current one
+                    start = max(int(ts * 1000), (self._current or 0) + 1)
+                    open(self._segment_path(start), 'ab').close()
+                    self._segments_scan()
+
+                line = u'{0:.3f}\t{1}\t{2}\t{3}\t{4}\n'.format(ts, event, name, user or u'', prev_user or u'')
+                self._current_file.write(line.encode('utf-8'))
+                self._current_file.flush()
+            finally:
+                fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+        metrics.inc('inventory_history_events_total', event=event)
+
+    def events(self, name, since=None, limit=None):
+        """
+        (time, event, owner, previous owner) of the box since the given time, oldest first - the newest limit
+        events if there are more
+        """
+        result = []
+        with self._lock, metrics.timer('inventory_history_query_seconds'):
+            self._current_update()
+            segments = self._segments
+            if since is not None:
+                # the segment holding since is the last one starting before it
+                segments = segments[max(0, bisect_right(segments, int(since * 1000)) - 1):]
+
+            for start in reversed(segments):
+                times, offsets = self._segment_index(start).get(name, ((), ()))
+                offsets = offsets[bisect_left(times, since) if since is not None else 0:]
+                if limit is not None:
+                    offsets = offsets[max(0, len(offsets) - (limit - len(result))):]
+                if not offsets:
+                    continue
+
+                with open(self._segment_path(start), 'rb') as segment:
+                    for offset in reversed(offsets):
+                        segment.seek(offset)
+                        ts, event, _, user, prev_user = segment.readline().decode('utf-8').rstrip('\n').split('\t')
+                        result.append((float(ts), event, user, prev_user))
+
+                if limit is not None and len(result) >= limit:
+                    break
+
+        result.reverse()
+        return result
+
+    def close(self):
+
+        with self._lock:
+            if self._current_file is not None:
+                self._current_file.close()
+                self._current_file = None
+            self._lock_file.close()
@@ -0,0 +1,140 @@
+"""
+time limited ownership of boxes - reminds the owner before the lease of a box ends and drops the ownership at its end
+"""
+import heapq
+import re
+import syslog
+from threading import Condition, Thread
+from time import time
+
+from DevBoxInventoryMetrics import metrics
+
+_LEASE_UNITS = {'m': 60, 'h': 60 * 60, 'd': 24 * 60 * 60}
+
+
+def lease_parse(text):
+    """
+    seconds of a lease given as <n>m, <n>h or <n>d (hours if there is no unit) - None if the text is invalid
+    """
+    match = re.match(r'^(\d+)([mhd]?)$', (text or '').strip().lower())
+    if match is None or not int(match.group(1)):
+        return None
+
+    return int(match.group(1)) * _LEASE_UNITS[match.group(2) or 'h']
+
+
+class DevBoxInventoryLeases(object):
+    """
+    fires the reminders and the ends of the leases of the boxes of an inventory
+
+    Every lease puts two events to a heap ordered by time, a thread sleeps until the earliest is due. Events are never
+    removed - when an event is due the inventory tells whether the box still has this lease, events of leases that
+    were extended, ended by put or taken over by someone else are dropped. So scheduling and firing an event is
+    O(log n) and the inventory is only read as a whole by rebuild().
+
+    remind and expire are called as func(name, user, lease end, channel) from the thread of the scheduler, expire
+    after the ownership was dropped.
+    """
+    def __init__(self, inventory, remind, expire, remind_before=15 * 60):
+
+        self._inventory = inventory
+        self._remind = remind
+        self._expire = expire
+        self._remind_before = remind_before
+
+        self._cond = Condition()
+        # (time due, sequence, kind, box name, lease end)
+        self._events = []
+        # (box name, lease end) of the leases having events - rebuild may find a lease scheduled already
+        self._scheduled = set()
+        self._seq = 0
+        self._running = True
+
+        self._thread = Thread(target=self._run, name='leases')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __len__(self):
+        return len(self._events)
+
+    def schedule(self, name, lease_end):
+        """
+        remind the owner of the box before lease_end and drop the ownership at lease_end
+        """
+        with self._cond:
+            if (name, lease_end) in self._scheduled:
+                return
+            self._scheduled.add((name, lease_end))
+            if lease_end - self._remind_before > time():
+                self._push(lease_end - self._remind_before, 'remind', name, lease_end)
+            self._push(lease_end, 'expire', name, lease_end)
+            self._cond.notify()
+
+    def rebuild(self):
+        """
+        schedule the leases stored in the inventory - leases that ended while the bot was down end right away
+        """
+        leases = self._inventory.box_leases()
+        for name, _, lease_end, _ in leases:
+            self.schedule(name, lease_end)
+
+        return len(leases)
+
+    def close(self):
+
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        self._thread.join()
+
+    def _push(self, due, kind, name, lease_end):
+
+        # called with the condition held - the sequence keeps events of the same time in order
+        self._seq += 1
+        heapq.heappush(self._events, (due, self._seq, kind, name, lease_end))
+
+    def _next(self):
+
+        with self._cond:
+            while self._running:
+                now = time()
+                if self._events and self._events[0][0] <= now:
+                    event = heapq.heappop(self._events)
+                    if event[2] == 'expire':
+                        self._scheduled.discard((event[3], event[4]))
+                    return event
+                self._cond.wait(self._events[0][0] - now if self._events else None)
+
+        return None
+
+    def _run(self):
+
+        while True:
+            event = self._next()
+            if event is None:
+                return
+
+            _, _, kind, name, lease_end = event
+            try:
+                self._fire(kind, name, lease_end)
+            except Exception as error:
+                syslog.syslog(syslog.LOG_ERR, 'lease {0} of box {1} failed: {2}'.format(kind, name, error))
+
+    def _fire(self, kind, name, lease_end):
+
+        lease = self._inventory.box_lease_get(name)
+        if lease is None or lease[1] != lease_end:
+            # the lease was extended or the box was put or taken over in the meantime
+            metrics.inc('inventory_lease_events_total', kind=kind, result='stale')
+            return
+
+        user, _, channel = lease
+        if kind == 'remind':
+            self._remind(name, user, lease_end, channel)
+        else:
+            if self._inventory.box_lease_expire(name, lease_end) is None:
+                metrics.inc('inventory_lease_events_total', kind=kind, result='stale')
+                return
+            self._expire(name, user, lease_end, channel)
+
+        metrics.inc('inventory_lease_events_total', kind=kind, result='fired')
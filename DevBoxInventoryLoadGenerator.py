@@ -0,0 +1,169 @@
+"""
+end to end load test of the DevBoxInventorySlackBot against a local DevBoxInventoryFakeSlack server
+run offline: python DevBoxInventoryLoadGenerator.py [--help]
+
+Bursts of take, put and show commands of many users are sent as RTM events, the time until the first reply arrives
+at the fake web api is the latency of a command. Every command is sent to a channel of its own so replies can be
+told apart - the per channel rate limit of the outbox never kicks in.
+"""
+import argparse
+import json
+import random
+import shutil
+import tempfile
+from os import path
+from threading import Thread
+from time import sleep, time
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+from DevBoxInventory import DevBoxInventory
+from DevBoxInventoryFakeSlack import DevBoxInventoryFakeSlack
+from DevBoxInventorySlackBot import DevBoxInventorySlackBot
+from DevBoxInventoryStorage import storage_create
+
+BOT_ID = 'U0BOT'
+
+
+def script_build(users, boxes, commands, mix, seed=0):
+    """
+    list of (user id, command text) - mix maps command name to its weight
+    """
+    rnd = random.Random(seed)
+    cmd_names = sorted(mix)
+    weights = [mix[cmd_name] for cmd_name in cmd_names]
+    script = []
+
+    for _ in range(commands):
+        user = 'U{0:05}'.format(rnd.randrange(users))
+        pick = rnd.uniform(0, sum(weights))
+        for cmd_name, weight in zip(cmd_names, weights):
+            pick -= weight
+            if pick <= 0:
+                break
+
+        if cmd_name == 'show':
+            text = rnd.choice(['show mine', 'show free', 'show box0{0}*'.format(rnd.randrange(10))])
+        else:
+            text = '{0} box{1:05}'.format(cmd_name, rnd.randrange(boxes))
+        script.append((user, text))
+
+    return script
+
+
+def _percentile(samples, percent):
+
+    return samples[min(len(samples) - 1, int(len(samples) * percent / 100.0))]
+
+
+def run(args):
+
+    users = dict(('U{0:05}'.format(idx), 'user{0}'.format(idx)) for idx in range(args.users))
+    users[BOT_ID] = 'inventory'
+    fake = DevBoxInventoryFakeSlack(users, post_delay=args.post_delay).start()
+
+    tmp_dir = tempfile.mkdtemp(prefix='inventory-load-')
+    inventory_file = path.join(tmp_dir, 'inventory')
+    storage = storage_create(args.storage, inventory_file, args.journal_size)
+    inventory = DevBoxInventory(inventory_file, storage=storage)
+    for idx in range(args.boxes):
+        inventory.box_add('box{0:05}'.format(idx))
+    inventory.close()
+
+    bot = DevBoxInventorySlackBot('inventory', 'xoxb-fake', inventory_file, args.journal_size, args.commit_window,
+                                  args.storage, args.workers, fake.api_url)
+    bot.poll_interval = args.poll_interval
+    bot_thread = Thread(target=bot.run_async if args.run_mode == 'async' else bot.run, name='bot')
+    bot_thread.daemon = True
+    bot_thread.start()
+
+    try:
+        while not fake.connections:
+            sleep(0.01)
+
+        script = script_build(args.users, args.boxes, args.commands,
+                              dict((cmd_name, float(weight)) for cmd_name, weight in
+                                   (item.split(':') for item in args.mix.split(','))),
+                              args.seed)
+        # channel -> time the command was sent
+        sent = {}
+        # channel -> time the first reply arrived
+        replied = {}
+        posts = 0
+
+        start = time()
+        for seq, (user, text) in enumerate(script):
+            channel = 'C{0:07}'.format(seq)
+            sent[channel] = time()
+            fake.send_event({'type': 'message', 'channel': channel, 'user': user,
+                             'text': '<@{0}> {1}'.format(BOT_ID, text), 'ts': '{0:.6f}'.format(sent[channel])})
+            if (seq + 1) % args.burst == 0:
+                sleep(args.pause)
+
+        deadline = time() + args.timeout
+        while len(replied) < len(sent) and time() < deadline:
+            try:
+                received, channel, _ = fake.posts.get(timeout=0.1)
+            except Empty:
+                continue
+            posts += 1
+            if channel in sent and channel not in replied:
+                replied[channel] = received
+        duration = max(replied.values()) - start if replied else 0.0
+
+    finally:
+        bot._running = False
+        bot_thread.join(5)
+        fake.stop()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    latencies = sorted(replied[channel] - sent[channel] for channel in replied)
+    return {'commands': len(sent),
+            'replied': len(replied),
+            'posts': posts,
+            'duration': duration,
+            'throughput': len(replied) / duration if duration else 0.0,
+            'p50': _percentile(latencies, 50) if latencies else None,
+            'p99': _percentile(latencies, 99) if latencies else None,
+            'max': latencies[-1] if latencies else None}
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='end to end load test of the DevBoxInventorySlackBot')
+    parser.add_argument('--users', type=int, default=50, help='number of users sending commands')
+    parser.add_argument('--boxes', type=int, default=200, help='number of boxes in the inventory')
+    parser.add_argument('--commands', type=int, default=1000, help='number of commands to send')
+    parser.add_argument('--mix', default='take:45,put:45,show:10', help='weights of the commands')
+    parser.add_argument('--burst', type=int, default=50, help='commands sent at once')
+    parser.add_argument('--pause', type=float, default=0.2, help='seconds between two bursts')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the command script')
+    parser.add_argument('--timeout', type=float, default=60, help='seconds to wait for the replies')
+    parser.add_argument('--post-delay', type=float, default=0.0, help='latency of the fake web api in seconds')
+    parser.add_argument('--run-mode', choices=['poll', 'async'], default='poll')
+    parser.add_argument('--poll-interval', type=float, default=DevBoxInventorySlackBot.poll_interval)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--storage', choices=['pickle', 'snapshot', 'sqlite'], default='pickle')
+    parser.add_argument('--journal-size', type=int, default=0)
+    parser.add_argument('--commit-window', type=int, default=0)
+    parser.add_argument('--output', help='write the results as json to this file')
+    args = parser.parse_args()
+
+    result = run(args)
+
+    print('commands {0} replied {1} posts {2} in {3:.2f}s - {4:.1f} commands/s'.format(
+        result['commands'], result['replied'], result['posts'], result['duration'], result['throughput']))
+    if result['p50'] is not None:
+        print('latency p50 {0:.1f}ms p99 {1:.1f}ms max {2:.1f}ms'.format(
+            result['p50'] * 1e3, result['p99'] * 1e3, result['max'] * 1e3))
+
+    if args.output:
+        result['config'] = vars(args)
+        with open(args.output, 'w') as output_file:
+            json.dump(result, output_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+"""
+runtime metrics of the DevBoxInventorySlackBot - counters, latency histograms and gauges
+"""
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock, Thread
+from timeit import default_timer
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+
+class DevBoxInventoryMetrics(object):
+    """
+    collects counters and latency histograms by name and labels and renders them in the prometheus text format
+
+    Gauges are callables registered by name, they are read when the metrics are rendered.
+    """
+    # upper bounds of the histogram buckets in seconds - the last bucket (+Inf) is implicit
+    buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+
+        self._lock = Lock()
+        # (name, labels) -> value
+        self._counters = {}
+        # (name, labels) -> [count per bucket incl. +Inf, sum]
+        self._histograms = {}
+        # name -> callable
+        self._gauges = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            histogram[0][bisect_left(self.buckets, seconds)] += 1
+            histogram[1] += seconds
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        observe the time spent in the with block
+        """
+        start = default_timer()
+        try:
+            yield
+        finally:
+            self.observe(name, default_timer() - start, **labels)
+
+    def gauge(self, name, value_get):
+
+        with self._lock:
+            self._gauges[name] = value_get
+
+    def percentile(self, name, percent, **labels):
+        """
+        upper bound of the bucket holding the given percentile - None if nothing was observed
+        """
+        with self._lock:
+            histogram = self._histograms.get(self._key(name, labels))
+            if histogram is None:
+                return None
+            counts = list(histogram[0])
+
+        rank = sum(counts) * percent / 100.0
+        seen = 0
+        for idx, count in enumerate(counts):
+            seen += count
+            if count and seen >= rank:
+                return self.buckets[idx] if idx < len(self.buckets) else float('inf')
+
+        return None
+
+    @staticmethod
+    def _labels_render(labels, extra=()):
+
+        labels = tuple(labels) + tuple(extra)
+        if not labels:
+            return ''
+        return '{' + ','.join('{0}="{1}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                              for key, value in labels) + '}'
+
+    def render(self):
+        """
+        all metrics in the prometheus text exposition format
+        """
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, (list(counts), total)) for key, (counts, total) in self._histograms.items())
+            gauges = sorted(self._gauges.items())
+
+        lines = []
+        last_name = None
+        for (name, labels), value in counters:
+            if name != last_name:
+                lines.append('# TYPE {0} counter'.format(name))
+                last_name = name
+            lines.append('{0}{1} {2}'.format(name, self._labels_render(labels), value))
+
+        for (name, labels), (counts, total) in histograms:
+            if name != last_name:
+                lines.append('# TYPE {0} histogram'.format(name))
+                last_name = name
+            cumulative = 0
+            for bound, count in zip([repr(bound) for bound in self.buckets] + ['+Inf'], counts):
+                cumulative += count
+                lines.append('{0}_bucket{1} {2}'.format(name, self._labels_render(labels, [('le', bound)]),
+                                                        cumulative))
+            lines.append('{0}_sum{1} {2!r}'.format(name, self._labels_render(labels), total))
+            lines.append('{0}_count{1} {2}'.format(name, self._labels_render(labels), cumulative))
+
+        for name, value_get in gauges:
+            try:
+                value = value_get()
+            except Exception:
+                continue
+            lines.append('# TYPE {0} gauge'.format(name))
+            lines.append('{0} {1}'.format(name, value))
+
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """
+        short human readable overview: counters, count/avg/p50/p99 of the histograms and gauges
+        """
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, (sum(counts), total)) for key, (counts, total) in self._histograms.items())
+            gauges = sorted(self._gauges.items())
+
+        lines = []
+        for (name, labels), value in counters:
+            lines.append(u'{0:60}{1:>10}'.format(name + self._labels_render(labels), value))
+
+        for (name, labels), (count, total) in histograms:
+            lines.append(u'{0:60}{1:>10} avg {2:8.1f}ms p50 <{3:>7}ms p99 <{4:>7}ms'.format(
+                name + self._labels_render(labels), count, total / count * 1e3 if count else 0.0,
+                self._ms(self.percentile(name, 50, **dict(labels))),
+                self._ms(self.percentile(name, 99, **dict(labels)))))
+
+        for name, value_get in gauges:
+            try:
+                lines.append(u'{0:60}{1:>10}'.format(name, value_get()))
+            except Exception:
+                continue
+
+        return u'\n'.join(lines)
+
+    @staticmethod
+    def _ms(seconds):
+
+        if seconds is None:
+            return '-'
+        if seconds == float('inf'):
+            return 'inf'
+        return '{0:g}'.format(seconds * 1e3)
+
+
+# the metrics of the process - used by the bot, the inventory, the storages and the outbox
+metrics = DevBoxInventoryMetrics()
+
+
+class _MetricsHTTPServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+
+        body = self.server.metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class DevBoxInventoryMetricsServer(object):
+    """
+    serves the metrics on http://host:port/metrics for prometheus or curl
+    """
+    def __init__(self, port, host='127.0.0.1', registry=None):
+
+        self._server = _MetricsHTTPServer((host, port), _MetricsHandler)
+        self._server.metrics = registry if registry is not None else metrics
+        self._thread = Thread(target=self._server.serve_forever, name='metrics')
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def close(self):
+
+        self._server.shutdown()
+        self._server.server_close()
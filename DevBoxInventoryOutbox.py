@@ -0,0 +1,205 @@
+"""
+queue for the messages the DevBoxInventorySlackBot posts to slack
+"""
+import syslog
+from collections import OrderedDict, deque
+from threading import Condition, Thread
+from time import time
+
+from DevBoxInventoryMetrics import metrics
+
+
+class DevBoxInventoryOutbox(object):
+    """
+    messages are queued per channel and posted by background workers so a slow or rate limited web api call does
+    not stall the bot
+
+    - consecutive messages to the same channel are merged into one message as long as it stays below max_size
+    - every channel may post channel_burst messages at once and channel_rate messages per second after that
+    - if slack answers with HTTP 429 or error ratelimited nothing is posted before the time given by Retry-After
+    """
+    def __init__(self, slack_client, workers=2, channel_rate=1.0, channel_burst=5, max_size=4000, retries=3):
+
+        self._slack_client = slack_client
+        self._channel_rate = channel_rate
+        self._channel_burst = channel_burst
+        self._max_size = max_size
+        self._retries = retries
+
+        self._cond = Condition()
+        # channel -> deque of (message, enqueue time, time the event answered by the message was received)
+        self._channels = OrderedDict()
+        # channel -> (tokens, time of last update)
+        self._buckets = {}
+        self._busy = set()
+        self._blocked_until = 0
+        self._depth = 0
+        self._running = True
+
+        self._sent = 0
+        self._merged = 0
+        self._retried = 0
+        self._dropped = 0
+        self._latency_sum = 0.0
+        self._latency_max = 0.0
+
+        self._workers = []
+        for idx in range(workers):
+            worker = Thread(target=self._work, name='outbox-{0}'.format(idx))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def put(self, channel, msg, received=None):
+
+        with self._cond:
+            self._channels.setdefault(channel, deque()).append((msg, time(), received))
+            self._depth += 1
+            self._cond.notify()
+
+    @property
+    def depth(self):
+        """
+        number of messages waiting to be posted
+        """
+        return self._depth
+
+    def stats(self):
+
+        with self._cond:
+            return {'depth': self._depth,
+                    'sent': self._sent,
+                    'merged': self._merged,
+                    'retried': self._retried,
+                    'dropped': self._dropped,
+                    'latency_avg': self._latency_sum / self._sent if self._sent else 0.0,
+                    'latency_max': self._latency_max}
+
+    def close(self, timeout=None):
+        """
+        post all queued messages and stop the workers
+        """
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+
+        for worker in self._workers:
+            worker.join(timeout)
+
+    def _tokens(self, channel, now):
+
+        tokens, updated = self._buckets.get(channel, (self._channel_burst, now))
+        return min(self._channel_burst, tokens + (now - updated) * self._channel_rate)
+
+    def _next_channel(self):
+
+        # called with the lock held: returns a channel we may post to now or the time to wait for one
+        now = time()
+        if self._blocked_until > now:
+            return None, self._blocked_until - now
+
+        wait = None
+        for channel in self._channels:
+            if channel in self._busy:
+                continue
+            tokens = self._tokens(channel, now)
+            if tokens >= 1:
+                self._buckets[channel] = (tokens - 1, now)
+                return channel, None
+            channel_wait = (1 - tokens) / self._channel_rate
+            wait = channel_wait if wait is None else min(wait, channel_wait)
+
+        return None, wait
+
+    def _take(self, channel):
+
+        # called with the lock held: take the next message of the channel and merge the following ones into it
+        queue = self._channels[channel]
+        msg, enqueued, received = queue.popleft()
+        taken = 1
+        while queue and len(msg) + 1 + len(queue[0][0]) <= self._max_size:
+            next_msg, _, next_received = queue.popleft()
+            msg = msg + u'\n' + next_msg
+            if received is None or next_received is not None and next_received < received:
+                received = next_received
+            taken += 1
+
+        if not queue:
+            del self._channels[channel]
+        self._depth -= taken
+        self._merged += taken - 1
+
+        return msg, enqueued, received
+
+    def _work(self):
+
+        while True:
+            with self._cond:
+                while True:
+                    if not self._running and not self._depth:
+                        return
+                    channel, wait = self._next_channel()
+                    if channel is not None:
+                        break
+                    self._cond.wait(wait)
+
+                self._busy.add(channel)
+                msg, enqueued, received = self._take(channel)
+
+            with metrics.timer('inventory_post_seconds'):
+                retry_after = self._post(channel, msg)
+
+            with self._cond:
+                self._busy.discard(channel)
+                if retry_after is None:
+                    now = time()
+                    latency = now - enqueued
+                    self._sent += 1
+                    self._latency_sum += latency
+                    self._latency_max = max(self._latency_max, latency)
+                    metrics.inc('inventory_posts_total', result='sent')
+                    metrics.observe('inventory_outbox_latency_seconds', latency)
+                    if received is not None:
+                        metrics.observe('inventory_reply_lag_seconds', now - received)
+                elif retry_after >= 0:
+                    # put the message back in front of the channel queue and wait as long as slack told us
+                    self._retried += 1
+                    self._blocked_until = max(self._blocked_until, time() + retry_after)
+                    self._channels.setdefault(channel, deque()).appendleft((msg, enqueued, received))
+                    self._depth += 1
+                    metrics.inc('inventory_posts_total', result='ratelimited')
+                else:
+                    self._dropped += 1
+                    metrics.inc('inventory_posts_total', result='dropped')
+                self._cond.notify_all()
+
+    def _post(self, channel, msg):
+        """
+        post the message - returns None on success, the seconds to wait if we are rate limited or -1 if the message
+        could not be posted
+        """
+        for attempt in range(self._retries):
+            try:
+                response = self._slack_client.server.api_requester.do(self._slack_client.token,
+                                                                      'chat.postMessage',
+                                                                      {'channel': channel,
+                                                                       'text': msg,
+                                                                       'as_user': True})
+                if response.status_code == 429:
+                    return float(response.headers.get('Retry-After', 1))
+
+                result = response.json()
+                if result.get('ok'):
+                    return None
+                if result.get('error') == 'ratelimited':
+                    return float(response.headers.get('Retry-After', 1))
+
+                syslog.syslog(syslog.LOG_ERR, 'failed to post message to {0}: {1}'.format(channel,
+                                                                                         result.get('error')))
+                return -1
+
+            except Exception as error:
+                syslog.syslog(syslog.LOG_WARNING, 'failed to post message to {0} (attempt {1}): {2}'.format(
+                    channel, attempt + 1, error))
+
+        return -1
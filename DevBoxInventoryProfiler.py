@@ -0,0 +1,106 @@
+"""
+on demand profiling of the command dispatch of the DevBoxInventorySlackBot
+"""
+import cProfile
+import pstats
+import syslog
+from os import path
+from threading import Lock, Timer, local
+
+
+class DevBoxInventoryProfiler(object):
+    """
+    profiles the calls made through call() while a profiling window is open
+
+    A window has a single profiler - python 3.12 and newer allow only one profiler to be active at a time - so calls
+    from several threads are executed one after the other while the window is open. Calls made from within a profiled
+    call are part of its profile. The profiler must never break a call: if it fails the call runs unprofiled and the
+    error is logged.
+    """
+    def __init__(self):
+
+        self._lock = Lock()
+        # held by the profiled call running right now
+        self._call_lock = Lock()
+        self._profiler = None
+        self._calls = 0
+        self._timer = None
+        self._thread = local()
+
+    @property
+    def active(self):
+        return self._timer is not None
+
+    def start(self, seconds, done):
+        """
+        profile the next seconds and hand the pstats.Stats (None if nothing was called) and the number of profiled
+        calls to done - returns False if a window is open already
+        """
+        with self._lock:
+            if self._timer is not None:
+                return False
+            self._profiler = cProfile.Profile()
+            self._calls = 0
+            self._timer = Timer(seconds, self._stop, [done])
+            self._timer.daemon = True
+            self._timer.start()
+
+        return True
+
+    def _stop(self, done):
+
+        # wait for the call running right now
+        with self._call_lock, self._lock:
+            profiler, calls = self._profiler, self._calls
+            self._profiler = None
+            self._timer = None
+
+        stats = None
+        if calls:
+            try:
+                stats = pstats.Stats(profiler)
+            except Exception as error:
+                syslog.syslog(syslog.LOG_ERR, 'failed to read the profile: {0}'.format(error))
+
+        done(stats, calls)
+
+    def call(self, func, *args):
+
+        if self._timer is None or getattr(self._thread, 'profiling', False):
+            return func(*args)
+
+        with self._call_lock:
+            profiler = self._profiler
+            if profiler is None:
+                # the window closed while we waited
+                return func(*args)
+            try:
+                profiler.enable()
+            except Exception as error:
+                syslog.syslog(syslog.LOG_WARNING, 'failed to profile {0}: {1}'.format(func.__name__, error))
+                return func(*args)
+
+            self._thread.profiling = True
+            try:
+                return func(*args)
+            finally:
+                self._thread.profiling = False
+                try:
+                    profiler.disable()
+                    self._calls += 1
+                except Exception as error:
+                    syslog.syslog(syslog.LOG_WARNING, 'failed to profile {0}: {1}'.format(func.__name__, error))
+
+
+def profile_summary(stats, top=15):
+    """
+    the functions with the highest internal time as text table
+    """
+    lines = [u'{0:>9}{1:>11}{2:>11}  {3}'.format('calls', 'tottime', 'cumtime', 'function')]
+    entries = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)
+    for (file_name, line, func_name), (_, calls, tottime, cumtime, _) in entries[:top]:
+        location = func_name if file_name == '~' else u'{0}:{1}({2})'.format(path.basename(file_name), line,
+                                                                            func_name)
+        lines.append(u'{0:>9}{1:>11.4f}{2:>11.4f}  {3}'.format(calls, tottime, cumtime, location))
+
+    return u'\n'.join(lines)
@@ -0,0 +1,129 @@
+"""
+render the box list of the DevBoxInventory as slack messages
+"""
+import math
+from datetime import datetime
+
+
+class DevBoxInventoryRenderer(object):
+    """
+    renders box datas as table rows and packs the rows into code blocks of at most max_size characters each
+
+    Rendered rows are cached by box name and only rendered again if the data of the box changed. Complete outputs
+    may be cached by the caller for an inventory version, they are dropped as soon as the version changes.
+    """
+    header = u'{0:25}{1:15}{2:25}{3:20}{4}\n'.format('box name',
+                                                     'owner',
+                                                     'time taken',
+                                                     'address',
+                                                     'comment')
+
+    def __init__(self, max_size=4000, row_cache_size=200000, output_cache_size=256):
+
+        self._max_size = max_size
+
+        # box name -> (box data, rendered row)
+        self._row_cache = {}
+        self._row_cache_size = row_cache_size
+
+        self._output_cache = {}
+        self._output_cache_size = output_cache_size
+        self._output_version = None
+
+    def output_get(self, version, key):
+        """
+        output cached by output_put for the inventory version and key or None
+        """
+        if version != self._output_version:
+            return None
+
+        return self._output_cache.get(key)
+
+    def output_put(self, version, key, output):
+
+        if version != self._output_version or len(self._output_cache) >= self._output_cache_size:
+            self._output_cache = {}
+            self._output_version = version
+
+        self._output_cache[key] = output
+
+    def row(self, name, ip, user, comment, ts_taken):
+
+        box_data = (name, ip, user, comment, ts_taken)
+        cached = self._row_cache.get(name)
+        if cached is not None and cached[0] == box_data:
+            return cached[1]
+
+        row = self._row_render(name, ip, user, comment, ts_taken)
+        if len(self._row_cache) >= self._row_cache_size:
+            self._row_cache = {}
+        self._row_cache[name] = (box_data, row)
+
+        return row
+
+    def _row_render(self, name, ip, user, comment, ts_taken):
+
+        ts_taken_str = datetime.fromtimestamp(ts_taken).strftime('%d.%m.%Y %H:%M:%S') if ts_taken and user else '-'
+        return u'{0:25}{1:15}{2:25}{3:20}{4}\n'.format(name,
+                                                       user if user else 'free',
+                                                       ts_taken_str,
+                                                       ip if ip else '-',
+                                                       comment if comment else '-')
+
+    def rows(self, box_datas):
+
+        for name, ip, user, comment, ts_taken in box_datas:
+            yield self.row(name, ip, user, comment, ts_taken)
+
+    def chunks(self, rows):
+        """
+        pack the rows into messages - a single row longer than max_size gets a message of its own
+        """
+        for chunk, _ in self._chunks(rows):
+            yield chunk
+
+    def _chunks(self, rows):
+
+        # (message, number of rows in it)
+        frame_size = len(u'```\n') + len(self.header) + len(u'```')
+        chunk = []
+        chunk_size = frame_size
+
+        for row in rows:
+            if chunk and chunk_size + len(row) > self._max_size:
+                yield u''.join([u'```\n', self.header] + chunk + [u'```']), len(chunk)
+                chunk = []
+                chunk_size = frame_size
+            chunk.append(row)
+            chunk_size += len(row)
+
+        if chunk:
+            yield u''.join([u'```\n', self.header] + chunk + [u'```']), len(chunk)
+
+    def pages(self, box_datas, first=1, count=1):
+        """
+        the messages (pages) first .. first + count - 1 of the box datas, the number of pages up to the last one
+        returned and the number of box datas behind it. Rows behind the last page asked for are not rendered - the
+        pages left can be estimated by pages_estimate.
+        """
+        pages = []
+        number = 0
+        rows_done = 0
+        for number, (chunk, rows) in enumerate(self._chunks(self.rows(box_datas)), 1):
+            rows_done += rows
+            if number >= first:
+                pages.append(chunk)
+            if number >= first + count - 1:
+                break
+
+        return pages, number, len(box_datas) - rows_done
+
+    @staticmethod
+    def pages_estimate(pages, rows_left, rows_done):
+        """
+        number of pages the rows left will take if they are as long as the rows_done rendered into pages
+        """
+        if not rows_left:
+            return 0
+
+        return max(1, int(math.ceil(float(rows_left) * pages / rows_done)))
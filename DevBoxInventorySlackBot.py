@@ -1,33 +1,154 @@
-import fnmatch
+import errno
+import json
 import os
+import socket
 import time
 import syslog
+from contextlib import contextmanager
 from datetime import datetime
+from ssl import SSLError
+from threading import Lock, Thread
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+import requests
+import six
 from slackclient import SlackClient
-from DevBoxInventory import DevBoxInventory, DevBox
+from DevBoxInventory import DevBoxInventory, DevBox, DevBoxInventoryConflict
+from DevBoxInventoryStorage import storage_create
 
+from DevBoxInventoryBulk import boxes_parse
 from DevBoxInventoryCmdParser import DevBoxInventoryCmdParser
+from DevBoxInventoryFilter import DevBoxFilter
+from DevBoxInventoryHistory import DevBoxInventoryHistory
+from DevBoxInventoryLeases import DevBoxInventoryLeases, lease_parse
+from DevBoxInventoryMetrics import DevBoxInventoryMetricsServer, metrics
+from DevBoxInventoryOutbox import DevBoxInventoryOutbox
+from DevBoxInventoryProfiler import DevBoxInventoryProfiler, profile_summary
+from DevBoxInventoryRenderer import DevBoxInventoryRenderer
+from DevBoxInventoryStats import DevBoxInventoryStats
+from DevBoxInventoryUsers import DevBoxInventoryUserDirectory
+
+
+class DevBoxInventoryApiRequester(object):
+    """
+    sends the web api calls of the slack client to api_url instead of https://slack.com/api/ - e.g. to a
+    DevBoxInventoryFakeSlack server
+    """
+    def __init__(self, api_url):
+
+        self._api_url = api_url if api_url.endswith('/') else api_url + '/'
+
+    def do(self, token, request='?', post_data=None, domain=None):
+
+        post_data = dict(post_data or {})
+        for key, value in post_data.items():
+            if not isinstance(value, six.string_types):
+                post_data[key] = json.dumps(value)
+        post_data['token'] = token
+
+        return requests.post(self._api_url + request, data=post_data)
 
 
 class DevBoxInventorySlackBot:
-    def __init__(self, bot_name, bot_token, inventory_file):
+
+    # number of messages posted by show - remaining pages must be requested using the page argument
+    show_max_messages = 5
+    # seconds to sleep between two reads of slack in poll mode
+    poll_interval = 0.5
+    # longest profiling window _profile accepts
+    profile_max_seconds = 600
+    # how often a command is retried if its box was changed by another bot sharing the inventory
+    conflict_retries = 5
+    # number of locks the commands working on a single box are spread over
+    box_locks = 64
+    # number of box names listed in the reply to a bulk command
+    bulk_names_max = 20
+    # seconds before the end of a lease its owner is reminded
+    lease_remind_before = 15 * 60
+    # number of events the reply to history lists
+    history_max = 20
+    # days stats covers if none are given and number of boxes and users it lists
+    stats_days = 7
+    stats_rows = 10
+
+    def __init__(self, bot_name, bot_token, inventory_file, journal_size=0, commit_window=0, storage_type='pickle',
+                 workers=4, api_url=None, shared=False):
 
         self.slack_client = SlackClient(bot_token)
+        if api_url:
+            self.slack_client.server.api_requester = DevBoxInventoryApiRequester(api_url)
         self.bot_user_name = bot_name
 
-        self._build_users_list()
-        self.bot_client_id = None
+        self._users = DevBoxInventoryUserDirectory(self.slack_client, '{0}.users'.format(inventory_file))
+        self._users.load()
+        self.bot_client_id = self._users.id_by_name(bot_name)
 
-        for user_id in self.slack_users:
-            if self.slack_users[user_id] == bot_name:
-                self.bot_client_id = user_id
+        if self.bot_client_id is None and self._users.refresh():
+            # the cached directory may be older than the bot user
+            self.bot_client_id = self._users.id_by_name(bot_name)
 
         if self.bot_client_id is None:
             raise Exception('Bot user {0} not found.'.format(bot_name))
 
-        self.inventory = DevBoxInventory(inventory_file)
+        self._inventory_file = inventory_file
+        self._history = DevBoxInventoryHistory('{0}.history'.format(inventory_file))
+        self._stats = DevBoxInventoryStats('{0}.stats'.format(inventory_file))
+        self.inventory = DevBoxInventory(inventory_file,
+                                         storage=storage_create(storage_type, inventory_file, journal_size,
+                                                                commit_window, shared),
+                                         history=self._history, stats=self._stats)
+
+        self._cmd_table_build()
+
+        # commands working on boxes - they hold the locks of the boxes while they run. Boxes share a fixed number of
+        # locks, a command holds the ones of its boxes so only commands on boxes sharing a lock wait for each other.
+        self._box_cmds = set(['add', 'del', 'update', 'take', 'occupy', 'put'])
+        self._box_locks = [Lock() for _ in range(self.box_locks)]
+
+        # commands are executed by the workers - or directly by parse_slack_output if there are none
+        self._cmd_queue = Queue() if workers > 0 else None
+        self._cmd_workers = []
+        for idx in range(workers):
+            worker = Thread(target=self._cmd_worker, name='cmd-{0}'.format(idx))
+            worker.daemon = True
+            worker.start()
+            self._cmd_workers.append(worker)
+
+        self._renderer = DevBoxInventoryRenderer()
+        # replies are posted by the workers of the outbox
+        self._outbox = DevBoxInventoryOutbox(self.slack_client)
+        self._profiler = DevBoxInventoryProfiler()
+        self._leases = DevBoxInventoryLeases(self.inventory, self._lease_remind, self._lease_expire,
+                                             self.lease_remind_before)
+        # done in the background so a lazily loaded inventory answers right away
+        scan = Thread(target=self._inventory_scan, name='inventory-scan')
+        scan.daemon = True
+        scan.start()
+
+        metrics.gauge('inventory_boxes', lambda: len(self.inventory))
+        metrics.gauge('inventory_outbox_depth', lambda: self._outbox.depth)
+        metrics.gauge('inventory_command_queue_depth',
+                      lambda: self._cmd_queue.qsize() if self._cmd_queue is not None else 0)
+        metrics.gauge('inventory_lease_events', lambda: len(self._leases))
+
+        self._running = False
+
+    def _inventory_scan(self):
+
+        try:
+            # leases stored in the inventory are picked up again - the ones that ended in the meantime end right away
+            self._leases.rebuild()
+            # the stats are journaled with every change - all boxes are read only when counting starts
+            if not self._stats.counting:
+                self.inventory.box_datas_apply(self._stats.sync)
+        except Exception as error:
+            syslog.syslog(syslog.LOG_ERR, 'failed to read the leases and owners of the inventory: {0}'.format(error))
+
+    def _cmd_table_build(self):
 
-        self._cmd_routes = {
+        cmd_routes = {
             'help': self._cmd_help,
             'h': self._cmd_help,
             'halp': self._cmd_help,
@@ -39,38 +160,22 @@ class DevBoxInventorySlackBot:
             'take': self._cmd_take,
             'occupy': self._cmd_occupy,
             'put': self._cmd_put,
-            '_restart': self._cmd_restart
+            'history': self._cmd_history,
+            'stats': self._cmd_usage_stats,
+            '_restart': self._cmd_restart,
+            '_stats': self._cmd_stats,
+            '_profile': self._cmd_profile
         }
 
-        self._cmd_parser = DevBoxInventoryCmdParser(self.bot_client_id,
-                                                    [i for i in self._cmd_routes], ['ip', 'comment'])
-
-        self._running = False
-
-    def _build_users_list(self):
-
-        self.slack_users = {}
-
-        api_call = self.slack_client.api_call("users.list")
-
-        if api_call.get('ok'):
-            # retrieve all users so we can find our bot
-            users = api_call.get('members')
-            for user in users:
-                if 'name' in user:
-                    self.slack_users[user.get('id')] = user.get('name')
-
-        return len(self.slack_users)
+        self._cmd_routes = cmd_routes
+        self._cmd_parser = DevBoxInventoryCmdParser(self.bot_client_id, [i for i in cmd_routes],
+                                                    ['ip', 'comment', 'owner', 'page', 'lease', 'since'])
 
     def _user_name_by_id(self, id):
 
-        for user_id in self.slack_users:
-            if user_id == id:
-                return self.slack_users[id]
-
-        return None
+        return self._users.name_by_id(id)
 
-    def _cmd_help(self, channel_id, user_name):
+    def _cmd_help(self, channel_id, user_name, cmd):
 
         msg = u'```\n' \
               u'arguments:\n' \
@@ -80,67 +185,140 @@ class DevBoxInventorySlackBot:
               u'                                      currently supported: ip, comment\n' \
               u'commands:\n' \
               u'show [<shell-style-wildcard filter>]  list dev boxes - apply optional filter\n' \
+              u'show mine|free                        list boxes owned by you or not owned by anyone\n' \
+              u'show [<filter>] [<filter-arg>]        filter-args: owner:<user> comment:<text> ip:<address or cidr>\n' \
+              u'show [...] page:<n>                   show page <n> of a long list\n' \
               u'add <name> [<meta-arg>]               add a box having name <name> and optional meta info\n' \
+              u'add + list on the next lines          add all boxes of a CSV (name,ip,comment) or YAML list\n' \
               u'del <name>                            delete a box having name <name>\n' \
               u'update <name> [<meta-arg>]            update a box having name <name> using given meta info\n' \
               u'take <name> [<meta-arg>]              take ownership of box <name>, set optional meta info\n' \
+              u'take <name> lease:<n>m|h|d            take box <name> for <n> minutes/hours/days, again to extend\n' \
+              u'take <pattern> [comment:<text>]       take ownership of all free boxes matching the wildcard pattern\n' \
               u'occupy <name> [<meta-arg>]            take ownership of box <name> that is currently in use\n' \
-              u'put <name>                            drop ownership of box <name>\n' \
-              u'_restart                              restart bot (re-read user list)\n' \
+              u'put <name>|<pattern>                  drop ownership of box <name> or of your boxes matching\n' \
+              u'history <name> [since:<date>]         list the owners of box <name> (date: 2016-10-01 [12:00])\n' \
+              u'stats [<n>d]                          utilization of the boxes and boxes held per user of the last days\n' \
+              u'_restart                              restart bot (reconnect, re-read inventory and user list)\n' \
+              u'_stats                                show command latencies, persistence and reply lag\n' \
+              u'_profile <seconds>                    profile the commands of the next <seconds>, post the hotspots\n' \
               u'```'
 
         return True, msg
 
-    def _cmd_show(self, channel_id, user_name):
-
-        msg = u''
-        hdr = u'{0:25}{1:15}{2:25}{3:20}{4}\n'.format('box name',
-                                                      'owner',
-                                                      'time taken',
-                                                      'address',
-                                                      'comment')
-        for name, ip, user, comment, ts_taken in self.inventory.box_datas():
-
-            if self._cmd_parser.has_machine_name() and not fnmatch.fnmatch(name, self._cmd_parser.machine_name):
-                continue
-
-            ts_taken_str = datetime.fromtimestamp(ts_taken).strftime('%d.%m.%Y %H:%M:%S') if ts_taken and user else '-'
-            msg += u'{0:25}{1:15}{2:25}{3:20}{4}\n'.format(name,
-                                                           user if user else 'free',
-                                                           ts_taken_str,
-                                                           ip if ip else '-',
-                                                           comment if comment else '-')
-
-        if not msg:
-            if self._cmd_parser.has_machine_name():
+    def _cmd_show(self, channel_id, user_name, cmd):
+
+        pattern = cmd.machine_name if cmd.has_machine_name() else None
+        show_args = dict((arg_name, cmd.get_arg(arg_name))
+                         for arg_name in ('owner', 'comment', 'ip', 'page'))
+        if pattern == 'mine':
+            show_args['owner'], pattern = user_name, None
+        elif pattern == 'free':
+            show_args['owner'], pattern = '', None
+        elif pattern and pattern.split(':', 1)[0] in show_args:
+            # the parser takes the first word as box name - the filter may start with an argument, e.g. show ip:...
+            arg_name, value = pattern.split(':', 1)
+            if show_args[arg_name] is None:
+                show_args[arg_name] = value
+            pattern = None
+
+        page = show_args.pop('page')
+        if page is not None and (not page.isdigit() or int(page) < 1):
+            return False, u'Invalid page *{0}*.'.format(page)
+
+        # the output only depends on the inventory and the query - repeated shows are answered from the cache
+        # until the inventory changes
+        version = self.inventory.version
+        cache_key = (pattern, show_args['owner'], show_args['comment'], show_args['ip'], page)
+        output = self._renderer.output_get(version, cache_key)
+        if output is None:
+            output = self._show(pattern, show_args, page)
+            self._renderer.output_put(version, cache_key, output)
+
+        return output
+
+    def _show(self, pattern, show_args, page):
+
+        box_filter = DevBoxFilter.compile(pattern, **show_args)
+        if box_filter.is_empty():
+            box_datas = self.inventory.box_datas()
+        else:
+            box_datas = self.inventory.box_datas_filter(box_filter)
+
+        # the rows are rendered and packed into messages on the fly up to the last page we post - the pages behind it
+        # are estimated from the number of rows left
+        if page is None:
+            msgs, pages, rows_left = self._renderer.pages(box_datas, 1, self.show_max_messages)
+            if rows_left:
+                msgs.append(u'About {0} more pages. Use *show* with *page:<n>* to see them.'.format(
+                    self._renderer.pages_estimate(pages, rows_left, len(box_datas) - rows_left)))
+        else:
+            page = int(page)
+            msgs, pages, rows_left = self._renderer.pages(box_datas, page)
+            if pages and not msgs:
+                return False, u'There is no page *{0}* - the list has {1} pages.'.format(page, pages)
+            if rows_left:
+                msgs.append(u'Page {0} of about {1}.'.format(page, page + self._renderer.pages_estimate(
+                    pages, rows_left, len(box_datas) - rows_left)))
+            elif msgs:
+                msgs.append(u'Page {0} of {1}.'.format(page, pages))
+
+        if not msgs:
+            if not box_filter.is_empty():
                 return True, u'No matching boxes in inventory ;-('
             else:
                 return True, u'No boxes in inventory ;-('
         else:
-            return True, u'```\n' + hdr + msg + '```'
+            return True, msgs
+
+    def _names_list(self, names):
 
-    def _cmd_add(self, channel_id, user_name):
+        listed = u', '.join(u'*{0}*'.format(name) for name in names[:self.bulk_names_max])
+        if len(names) > self.bulk_names_max:
+            listed += u' and {0} more'.format(len(names) - self.bulk_names_max)
 
-        if not self._cmd_parser.has_machine_name():
+        return listed
+
+    def _cmd_add(self, channel_id, user_name, cmd):
+
+        if cmd.has_body():
+            return self._cmd_add_many(channel_id, user_name, cmd)
+
+        if not cmd.has_machine_name():
             return False, u'Missing box name. You may check the halp.'
 
-        box_name = self._cmd_parser.machine_name
+        box_name = cmd.machine_name
 
         ret = self.inventory.box_add(box_name,
-                                     ip=self._cmd_parser.get_arg('ip'),
+                                     ip=cmd.get_arg('ip'),
                                      user=None,
-                                     comment=self._cmd_parser.get_arg('comment'))
+                                     comment=cmd.get_arg('comment'))
         if ret is 0:
             return False, u'Failed to add box *{0}*. Name already in use?'.format(box_name)
         else:
             return True, u'Box *{0}* added to inventory.'.format(box_name)
 
-    def _cmd_del(self, channel_id, user_name):
+    def _cmd_add_many(self, channel_id, user_name, cmd):
+
+        try:
+            boxes = boxes_parse(cmd.body)
+        except ValueError as error:
+            return False, u'Invalid box list: {0}.'.format(error)
+
+        # all or nothing in a single write
+        in_use = self.inventory.box_add_many([(name, ip, None, comment) for name, ip, comment in boxes])
+        if in_use:
+            return False, u'No box added - names already in use: {0}.'.format(self._names_list(in_use))
 
-        if not self._cmd_parser.has_machine_name():
+        return True, u'{0} boxes added to inventory: {1}.'.format(len(boxes),
+                                                                 self._names_list([box[0] for box in boxes]))
+
+    def _cmd_del(self, channel_id, user_name, cmd):
+
+        if not cmd.has_machine_name():
             return False, u'Missing box name. You may check the halp.'
 
-        box_name = self._cmd_parser.machine_name
+        box_name = cmd.machine_name
 
         ret = self.inventory.box_del(box_name)
         if ret:
@@ -148,32 +326,62 @@ class DevBoxInventorySlackBot:
         else:
             return False, u'Failed to delete box *{0}* - name not known.'.format(box_name)
 
-    def _cmd_update(self, channel_id, user_name):
+    def _cmd_update(self, channel_id, user_name, cmd):
 
-        if not self._cmd_parser.has_machine_name():
+        if not cmd.has_machine_name():
             return False, u'Missing box name. You may check the halp.'
 
-        box_name = self._cmd_parser.machine_name
+        box_name = cmd.machine_name
 
         ret = self.inventory.box_data_set(box_name,
-                                          ip=self._cmd_parser.get_arg('ip'),
+                                          ip=cmd.get_arg('ip'),
                                           user=None,
-                                          comment=self._cmd_parser.get_arg('comment'))
+                                          comment=cmd.get_arg('comment'))
         if ret is 0:
             return False, u'Failed to update box *{0}*. Wrong name?'.format(box_name)
         else:
             return True, u'Box *{0}* updated.'.format(box_name)
 
-    def _cmd_set_box_ownership(self, channel_id, user_name, force):
+    @staticmethod
+    def _lease_end_render(lease_end):
+
+        return datetime.fromtimestamp(lease_end).strftime('%d.%m.%Y %H:%M')
+
+    def _lease_owner_mention(self, user_name):
+
+        user_id = self._users.id_by_name(user_name)
+        return u'<@{0}>'.format(user_id) if user_id else u'*{0}*'.format(user_name)
+
+    def _lease_remind(self, name, user_name, lease_end, channel_id):
 
-        if not self._cmd_parser.has_machine_name():
+        self._slack_msg(channel_id, u'{0} your lease of box *{1}* ends {2}. Take it again using lease:<time> to '
+                                    u'extend it.'.format(self._lease_owner_mention(user_name), name,
+                                                         self._lease_end_render(lease_end)))
+
+    def _lease_expire(self, name, user_name, lease_end, channel_id):
+
+        self._slack_msg(channel_id, u'{0} your lease of box *{1}* ended - the box is free again.'.format(
+            self._lease_owner_mention(user_name), name))
+
+    def _cmd_set_box_ownership(self, channel_id, user_name, cmd, force):
+
+        if not cmd.has_machine_name():
             return False, u'Missing box name. You may check the halp.'
 
-        box_name, ip, box_user, comment = self.inventory.box_data_get(self._cmd_parser.machine_name)
+        lease = None
+        if cmd.has_arg('lease'):
+            seconds = lease_parse(cmd.get_arg('lease'))
+            if seconds is None:
+                return False, u'Invalid lease *{0}* - give the time as <n>m, <n>h or <n>d.'.format(
+                    cmd.get_arg('lease'))
+            lease = (time.time() + seconds, channel_id)
+
+        box_name, box_ip, box_user, box_comment = self.inventory.box_data_get(cmd.machine_name)
+        ip, comment = box_ip, box_comment
 
         if not box_name:
             return False, u'Failed to take over box *{0}* - unknown or invalid box name.'.format(
-                self._cmd_parser.machine_name)
+                cmd.machine_name)
 
         old_user = None
         if not force:
@@ -181,59 +389,238 @@ class DevBoxInventorySlackBot:
                 return False, u'Box in use by *{0}*. You may force ownership by using the command occupy... USA!'.format(
                     box_user)
 
-            if box_user == user_name:
+            if box_user == user_name and lease is None:
                 return False, u'Maybe you forgot about it - but you are already the owner of *{0}*.'.format(box_name)
         else:
             if box_user and box_user != user_name:
                 old_user = box_user
 
-        ip = self._cmd_parser.get_arg('ip') if self._cmd_parser.has_arg('ip') else ip
-        comment = self._cmd_parser.get_arg('comment') if self._cmd_parser.has_arg('comment') else comment
+        ip = cmd.get_arg('ip') if cmd.has_arg('ip') else ip
+        comment = cmd.get_arg('comment') if cmd.has_arg('comment') else comment
+        # fails if another bot sharing the inventory changed the box since we read it - the command is retried
         ret = self.inventory.box_data_set(box_name,
                                           ip,
                                           user_name,
-                                          comment)
+                                          comment,
+                                          expected=(box_name, box_ip, box_user, box_comment),
+                                          lease=lease)
         if ret:
+            until = u''
+            if lease is not None:
+                self._leases.schedule(box_name, lease[0])
+                if box_user == user_name:
+                    return True, u'Lease of box *{0}* by *{1}* extended until {2}.'.format(
+                        box_name, user_name, self._lease_end_render(lease[0]))
+                until = u' until {0}'.format(self._lease_end_render(lease[0]))
             if old_user:
-                return True, u'Box *{0}* *STOLEN* from *{1}* now in use by *{2}*.'.format(box_name, old_user, user_name)
+                return True, u'Box *{0}* *STOLEN* from *{1}* now in use by *{2}*{3}.'.format(box_name, old_user,
+                                                                                        user_name, until)
             else:
-                return True, u'Box *{0}* now in use by *{1}*.'.format(box_name, user_name)
+                return True, u'Box *{0}* now in use by *{1}*{2}.'.format(box_name, user_name, until)
         else:
             return False, u'Failed to assign ownership of box *{0}* to *{1}*.'.format(box_name, user_name)
 
-    def _cmd_take(self, channel_id, user_name):
+    def _cmd_take(self, channel_id, user_name, cmd):
 
-        return self._cmd_set_box_ownership(channel_id, user_name, False)
+        if cmd.has_machine_name() and DevBoxFilter.is_pattern(cmd.machine_name):
+            return self._cmd_take_many(channel_id, user_name, cmd)
 
-    def _cmd_occupy(self, channel_id, user_name):
+        return self._cmd_set_box_ownership(channel_id, user_name, cmd, False)
 
-        return self._cmd_set_box_ownership(channel_id, user_name, True)
+    def _cmd_take_many(self, channel_id, user_name, cmd):
 
-    def _cmd_put(self, channel_id, user_name):
+        if cmd.has_arg('ip'):
+            return False, u'The ip can not be set for several boxes at once.'
 
-        if not self._cmd_parser.has_machine_name():
+        if cmd.has_arg('lease'):
+            return False, u'A lease can only be given for a single box.'
+
+        box_datas = self.inventory.box_datas_filter(DevBoxFilter.compile(cmd.machine_name))
+        if not box_datas:
+            return False, u'No box matches *{0}*.'.format(cmd.machine_name)
+
+        changes = []
+        in_use = []
+        for name, ip, user, comment, _ in box_datas:
+            if not user:
+                # fails as a whole if one of the boxes was changed since we read it - the command is retried
+                changes.append((name, None, user_name, cmd.get_arg('comment'), (name, ip, user, comment)))
+            elif user != user_name:
+                in_use.append(u'{0} ({1})'.format(name, user))
+
+        in_use_msg = u' In use: {0}.'.format(self._names_list(in_use)) if in_use else u''
+        if not changes:
+            return False, u'No free box matches *{0}*.{1}'.format(cmd.machine_name, in_use_msg)
+
+        if not self.inventory.box_data_set_many(changes):
+            return False, u'Failed to take the boxes matching *{0}*.'.format(cmd.machine_name)
+
+        return True, u'*{0}* took {1} boxes: {2}.{3}'.format(user_name, len(changes),
+                                                              self._names_list([change[0] for change in changes]),
+                                                              in_use_msg)
+
+    def _cmd_occupy(self, channel_id, user_name, cmd):
+
+        return self._cmd_set_box_ownership(channel_id, user_name, cmd, True)
+
+    def _cmd_put_many(self, channel_id, user_name, cmd):
+
+        box_datas = self.inventory.box_datas_filter(DevBoxFilter.compile(cmd.machine_name, owner=user_name))
+        if not box_datas:
+            return False, u'You own no box matching *{0}*.'.format(cmd.machine_name)
+
+        changes = [(name, None, '', None, (name, ip, user, comment)) for name, ip, user, comment, _ in box_datas]
+        if not self.inventory.box_data_set_many(changes):
+            return False, u'Failed to drop ownership of the boxes matching *{0}*.'.format(cmd.machine_name)
+
+        return True, u'*{0}* dropped ownership for {1} boxes: {2}.'.format(
+            user_name, len(changes), self._names_list([change[0] for change in changes]))
+
+    def _cmd_put(self, channel_id, user_name, cmd):
+
+        if not cmd.has_machine_name():
             return False, u'Missing box name. You may check the halp.'
 
-        box_name, ip, box_user, comment = self.inventory.box_data_get(self._cmd_parser.machine_name)
+        if DevBoxFilter.is_pattern(cmd.machine_name):
+            return self._cmd_put_many(channel_id, user_name, cmd)
+
+        box_name, ip, box_user, comment = self.inventory.box_data_get(cmd.machine_name)
 
         if not box_name:
             return False, u'Failed to drop ownership for box *{0}* - unknown or invalid box name.'.format(
-                self._cmd_parser.machine_name)
+                cmd.machine_name)
 
         if (box_user and box_user != user_name) or not box_user:
             return False, u'Failed to drop ownership for box *{0}* cause you are not the current user.'.format(box_name)
 
-        ret = self.inventory.box_data_set(box_name, ip, '', comment)
+        ret = self.inventory.box_data_set(box_name, ip, '', comment, expected=(box_name, ip, box_user, comment))
         if ret:
             return True, u'*{0}* dropped ownership for box *{1}*.'.format(user_name, box_name)
         else:
             return False, u'Failed to drop ownership of box *{0}* by *{1}*.'.format(box_name, user_name)
 
-    def _cmd_restart(self, channel_id, user_name):
+    @staticmethod
+    def _since_parse(text):
+
+        for date_format in ('%Y-%m-%d %H:%M', '%Y-%m-%d', '%d.%m.%Y %H:%M', '%d.%m.%Y'):
+            try:
+                return time.mktime(datetime.strptime(text.strip(), date_format).timetuple())
+            except ValueError:
+                continue
+
+        return None
 
+    def _cmd_history(self, channel_id, user_name, cmd):
+
+        if not cmd.has_machine_name():
+            return False, u'Missing box name. You may check the halp.'
+
+        since = None
+        if cmd.has_arg('since'):
+            since = self._since_parse(cmd.get_arg('since'))
+            if since is None:
+                return False, u'Invalid date *{0}* - give it as 2016-10-01 or "2016-10-01 12:00".'.format(
+                    cmd.get_arg('since'))
+
+        events = self._history.events(cmd.machine_name, since, self.history_max + 1)
+        if not events:
+            return True, u'No owner changes of box *{0}* recorded.'.format(cmd.machine_name)
+
+        lines = []
+        if len(events) > self.history_max:
+            events = events[1:]
+            lines.append(u'(the last {0} changes)'.format(self.history_max))
+        for ts, event, user, prev_user in events:
+            # put and del name the owner the box had before
+            owner = u'{0} (from {1})'.format(user, prev_user) if event == 'occupy' else user or prev_user
+            lines.append(u'{0}  {1:7} {2}'.format(datetime.fromtimestamp(ts).strftime('%d.%m.%Y %H:%M:%S'), event,
+                                                  owner).rstrip())
+
+        return True, u'history of box *{0}*\n```\n{1}\n```'.format(cmd.machine_name, u'\n'.join(lines))
+
+    @staticmethod
+    def _duration_render(seconds):
+
+        if seconds is None:
+            return u'-'
+        minutes = int(seconds // 60)
+        if minutes >= 24 * 60:
+            return u'{0}d {1}h'.format(minutes // (24 * 60), minutes % (24 * 60) // 60)
+        if minutes >= 60:
+            return u'{0}h {1}m'.format(minutes // 60, minutes % 60)
+        return u'{0}m'.format(minutes)
+
+    def _cmd_usage_stats(self, channel_id, user_name, cmd):
+
+        days = (cmd.machine_name or str(self.stats_days)).rstrip('d')
+        if not days.isdigit() or not 0 < int(days) <= self._stats.keep_days:
+            return False, u'Invalid time *{0}* - give the days to report as <n>d (1..{1}).'.format(
+                cmd.machine_name, self._stats.keep_days)
+
+        box_rows, user_rows = self._stats.report(int(days))
+        if not box_rows:
+            return True, u'No box was used in the last {0} days.'.format(days)
+
+        lines = [u'{0:24} {1:>5} {2:>6} {3:>10} {4:>9}'.format('box name', 'used', 'holds', 'mean hold', 'occupied')]
+        for name, utilization, holds, mean_hold, occupied in box_rows[:self.stats_rows]:
+            lines.append(u'{0:24} {1:>4.0f}% {2:>6} {3:>10} {4:>9}'.format(name, utilization * 100, holds,
+                                                                          self._duration_render(mean_hold), occupied))
+        lines.append(u'')
+        lines.append(u'{0:24} {1:>10} {2:>6} {3:>9}'.format('owner', 'held', 'holds', 'occupies'))
+        for name, held, holds, occupies in user_rows[:self.stats_rows]:
+            lines.append(u'{0:24} {1:>10} {2:>6} {3:>9}'.format(name, self._duration_render(held), holds, occupies))
+
+        return True, u'box usage of the last {0} days\n```\n{1}\n```'.format(days, u'\n'.join(lines))
+
+    def _cmd_restart(self, channel_id, user_name, cmd):
+
+        # rebuild the bot from scratch: reconnect, reload the inventory and read the complete user list
+        self._users.expire()
         self._running = False
         return True, u'Inventory bot restarted by *{0}*.'.format(user_name)
 
+    def _cmd_stats(self, channel_id, user_name, cmd):
+
+        return True, u'```\n{0}\n```'.format(metrics.summary())
+
+    def _cmd_profile(self, channel_id, user_name, cmd):
+
+        seconds = cmd.machine_name
+        if not seconds or not seconds.isdigit() or not 0 < int(seconds) <= self.profile_max_seconds:
+            return False, u'Invalid profiling time *{0}* - give the seconds to profile (1..{1}).'.format(
+                seconds, self.profile_max_seconds)
+
+        if not self.profile(int(seconds), channel_id):
+            return False, u'Profiling is running already.'
+
+        return True, u'Profiling commands for {0} seconds, started by *{1}*.'.format(seconds, user_name)
+
+    def profile(self, seconds, channel_id=None):
+        """
+        profile reading slack and executing commands for the next seconds. The profile is written next to the
+        inventory file, the hotspots are posted to channel_id (or logged if there is none).
+        """
+        def done(stats, calls):
+
+            if stats is None:
+                msg = u'Profiling done - no commands in {0} seconds.'.format(seconds)
+            else:
+                profile_file = '{0}.{1}.prof'.format(self._inventory_file, time.strftime('%Y%m%d-%H%M%S'))
+                try:
+                    stats.dump_stats(profile_file)
+                    saved = u'written to `{0}`'.format(profile_file)
+                except (IOError, OSError) as error:
+                    saved = u'failed to write `{0}`: {1}'.format(profile_file, error)
+                msg = u'Profiling done - {0} calls in {1} seconds, profile {2}.\n```\n{3}\n```'.format(
+                    calls, seconds, saved, profile_summary(stats))
+
+            if channel_id is not None:
+                self._slack_msg(channel_id, msg)
+            else:
+                syslog.syslog(syslog.LOG_INFO, msg)
+
+        return self._profiler.start(seconds, done)
+
     def _parse_command(self, command, user_name, channel_id):
 
         tokens = command.split(' ', 1)
@@ -251,47 +638,179 @@ class DevBoxInventorySlackBot:
         except KeyError as Err:
             self._slack_msg(channel_id, u'*ERROR*: Unknown command _{0}_. You may check the halp.'.format(cmd.lower()))
 
-    def _slack_msg(self, channel, msg):
-        self.slack_client.api_call('chat.postMessage', channel=channel, text=msg, as_user=True)
+    def _slack_msg(self, channel, msg, received=None):
+        metrics.inc('inventory_messages_total')
+        self._outbox.put(channel, msg, received)
 
     def parse_slack_output(self, slack_rtm_output):
 
+        if not slack_rtm_output:
+            return
+
+        with metrics.timer('inventory_dispatch_seconds'):
+            self._profiler.call(self._parse_slack_output, slack_rtm_output)
+
+    def _parse_slack_output(self, slack_rtm_output):
+
         bot_at_token = "<@" + self.bot_client_id + ">"
         output_list = slack_rtm_output
+        received = time.time()
 
         # print output_list
         if output_list and len(output_list) > 0:
+            metrics.inc('inventory_events_total', len(output_list))
             for output in output_list:
-                if output and 'text' in output and \
-                                'user' in output and 'channel' in output and bot_at_token in output['text']:
-
-                    channel_id = output['channel']
-                    user = output['user']
-
-                    try:
-                        rc = self._cmd_parser.parse(output['text'])
+                # a message we fail to handle must not keep us from handling the next ones
+                try:
+                    self._parse_slack_event(output, bot_at_token, received)
+                except Exception as error:
+                    syslog.syslog(syslog.LOG_ERR, 'failed to handle slack event {0}: {1}'.format(output, error))
+
+    def _parse_slack_event(self, output, bot_at_token, received):
+
+        if output and self._users.handle_event(output):
+            return
+
+        if output and 'text' in output and \
+                        'user' in output and 'channel' in output and bot_at_token in output['text']:
+
+            channel_id = output['channel']
+            user = output['user']
+
+            try:
+                cmd = self._cmd_parser.parse_cmd(output['text'])
+
+                if cmd is not None and cmd.has_cmd():
+                    if self._cmd_queue is not None:
+                        self._cmd_queue.put((channel_id, user, cmd, received))
+                    else:
+                        self._cmd_execute(channel_id, user, cmd, received)
+
+            except Exception as error:
+                metrics.inc('inventory_commands_total', cmd='-', result='invalid')
+                self._slack_msg(output['channel'],
+                                u'*ERROR*: _{0}_. You may check the halp.'.format(error), received)
+
+    def rtm_read(self):
+        """
+        read all pending RTM events
+
+        slackclient expects a TLS socket running dry (SSLError 2) and drops the events read so far when it does -
+        we read frame by frame and also stop on EAGAIN of a plain socket, e.g. to a DevBoxInventoryFakeSlack
+        """
+        websocket = self.slack_client.server.websocket
+        events = []
+        while True:
+            try:
+                data = websocket.recv()
+            except SSLError as error:
+                if error.errno == 2:
+                    break
+                raise
+            except socket.error as error:
+                if error.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+
+            if data:
+                try:
+                    event = json.loads(data)
+                    self.slack_client.process_changes(event)
+                except Exception as error:
+                    # a broken frame must not stop reading the ones behind it
+                    syslog.syslog(syslog.LOG_ERR, 'failed to read slack event {0!r}: {1}'.format(data, error))
+                    continue
+                events.append(event)
+
+        return events
+
+    @contextmanager
+    def _boxes_locked(self, cmd):
+
+        # hold the locks of every box the command works on - a pattern is resolved to the boxes matching it. The locks
+        # are taken in order, so commands needing several of them can not deadlock
+        names = [cmd.machine_name]
+        if DevBoxFilter.is_pattern(cmd.machine_name):
+            box_filter = DevBoxFilter.compile(cmd.machine_name)
+            names = [box_data[0] for box_data in self.inventory.box_datas_filter(box_filter)]
+        locks = [self._box_locks[idx] for idx in sorted(set(hash(name) % len(self._box_locks) for name in names))]
+
+        locked = []
+        try:
+            for lock in locks:
+                lock.acquire()
+                locked.append(lock)
+            yield
+        finally:
+            for lock in reversed(locked):
+                lock.release()
 
-                        if rc is True:
+    def _cmd_execute(self, channel_id, user, cmd, received=None):
 
-                            if self._cmd_parser.has_cmd():
+        if received is not None:
+            metrics.observe('inventory_command_wait_seconds', time.time() - received)
 
-                                try:
-                                    rc, msg = self._cmd_routes[self._cmd_parser.cmd](channel_id,
-                                                                                     self._user_name_by_id(user))
-                                    if msg:
-                                        if rc is True:
-                                            self._slack_msg(channel_id, msg)
-                                        else:
-                                            self._slack_msg(channel_id,
-                                                            u'*ERROR*: _{0}_ You may check the halp.'.format(msg))
-                                except KeyError:
-                                    self._slack_msg(channel_id,
-                                                    u'*ERROR*: Unknown command _{0}_. You may check the halp.'.format(
-                                                        self._cmd_parser.cmd))
+        result = 'error'
+        start = time.time()
+        try:
+            try:
+                if cmd.cmd in self._box_cmds and cmd.has_machine_name():
+                    # commands on the same box must not interleave - the others run concurrently
+                    with self._boxes_locked(cmd):
+                        rc, msg = self._cmd_run(channel_id, self._user_name_by_id(user), cmd)
+                else:
+                    rc, msg = self._cmd_run(channel_id, self._user_name_by_id(user), cmd)
+                result = 'ok' if rc is True else 'failed'
+                if msg:
+                    if rc is True:
+                        # a command may answer with a list of messages
+                        for part in msg if isinstance(msg, list) else [msg]:
+                            self._slack_msg(channel_id, part, received)
+                    else:
+                        self._slack_msg(channel_id,
+                                        u'*ERROR*: _{0}_ You may check the halp.'.format(msg), received)
+            except KeyError:
+                self._slack_msg(channel_id,
+                                u'*ERROR*: Unknown command _{0}_. You may check the halp.'.format(cmd.cmd), received)
+
+        except Exception as error:
+            self._slack_msg(channel_id, u'*ERROR*: _{0}_. You may check the halp.'.format(error), received)
+
+        finally:
+            metrics.observe('inventory_command_seconds', time.time() - start, cmd=cmd.cmd)
+            metrics.inc('inventory_commands_total', cmd=cmd.cmd, result=result)
+
+    def _cmd_run(self, channel_id, user_name, cmd):
+
+        # a box changed by another bot between reading and writing it - start over using its current data
+        for _ in range(self.conflict_retries):
+            try:
+                return self._cmd_routes[cmd.cmd](channel_id, user_name, cmd)
+            except DevBoxInventoryConflict:
+                metrics.inc('inventory_conflicts_total', cmd=cmd.cmd)
+
+        return False, u'Box *{0}* is changed by others all the time - try again later.'.format(cmd.machine_name)
+
+    def _cmd_worker(self):
 
-                    except Exception as error:
-                        self._slack_msg(output['channel'],
-                                        u'*ERROR*: _{0}_. You may check the halp.'.format(error.message))
+        while True:
+            job = self._cmd_queue.get()
+            if job is None:
+                return
+            # a failing command must not take the worker down - the commands behind it would never be answered
+            try:
+                self._profiler.call(self._cmd_execute, *job)
+            except Exception as error:
+                syslog.syslog(syslog.LOG_ERR, 'command {0} failed: {1}'.format(job[2].cmd, error))
+
+    def _cmd_workers_stop(self):
+        """
+        execute all queued commands and stop the workers
+        """
+        for _ in self._cmd_workers:
+            self._cmd_queue.put(None)
+        for worker in self._cmd_workers:
+            worker.join()
 
     def run(self):
         self._running = True
@@ -299,21 +818,40 @@ class DevBoxInventorySlackBot:
         if self.slack_client.rtm_connect():
             syslog.syslog(syslog.LOG_INFO, 'slack-bot {0} started.'.format(self.bot_user_name))
             while self._running:
-                self.parse_slack_output(self.slack_client.rtm_read())
+                self.parse_slack_output(self.rtm_read())
 
                 '''
                 if command and channel_id:
                     user_name = self._user_name_by_id(user_id)
                     self._parse_command(command, user_name, channel_id)
                 '''
-                time.sleep(0.5)
+                time.sleep(self.poll_interval)
         else:
             syslog.syslog(syslog.LOG_ERR, 'slack-bot {0} failed to connect to slack. check token and bot name.'.format(
                 self.bot_user_name))
 
+        self._cmd_workers_stop()
+        self._leases.close()
+        self._outbox.close()
+        self.inventory.close()
+        self._users.close()
+
+    def run_async(self):
+        """
+        run the bot using an asyncio event loop instead of polling slack (needs python 3)
+        """
+        from DevBoxInventoryAsyncRunner import DevBoxInventoryAsyncRunner
+
+        DevBoxInventoryAsyncRunner(self).run()
+        self._cmd_workers_stop()
+        self._leases.close()
+        self._outbox.close()
+        self.inventory.close()
+        self._users.close()
 
-def env_get(name):
-    val = os.environ.get(name)
+
+def env_get(name, default=None):
+    val = os.environ.get(name, default)
     if val is None:
         raise Exception('missing environment variable: {0}'.format(name))
 
@@ -325,10 +863,33 @@ if __name__ == '__main__':
     bot_name = env_get('slack_inventory_bot_name')
     bot_access_token = env_get('slack_inventory_token')
     inventory_file_path = env_get('slack_inventory_file_path')
+    inventory_journal_size = int(env_get('slack_inventory_journal_size', '0'))
+    inventory_commit_window = int(env_get('slack_inventory_commit_window', '0'))
+    inventory_storage = env_get('slack_inventory_storage', 'pickle')
+    workers = int(env_get('slack_inventory_workers', '4'))
+    run_mode = env_get('slack_inventory_run_mode', 'poll')
+    poll_interval = float(env_get('slack_inventory_poll_interval', '0.5'))
+    api_url = os.environ.get('slack_inventory_api_url')
+    metrics_port = int(env_get('slack_inventory_metrics_port', '0'))
+    profile_seconds = int(env_get('slack_inventory_profile', '0'))
+    shared = env_get('slack_inventory_shared', '0') == '1'
+
+    if metrics_port:
+        # serve the metrics for the whole life of the process - they survive cold restarts of the bot
+        DevBoxInventoryMetricsServer(metrics_port)
 
     try:
         while True:
-            DBISB = DevBoxInventorySlackBot(bot_name, bot_access_token, inventory_file_path)
-            DBISB.run()
+            DBISB = DevBoxInventorySlackBot(bot_name, bot_access_token, inventory_file_path, inventory_journal_size,
+                                            inventory_commit_window, inventory_storage, workers, api_url, shared)
+            DBISB.poll_interval = poll_interval
+            if profile_seconds:
+                # profile the start only - later windows are requested using _profile
+                DBISB.profile(profile_seconds)
+                profile_seconds = 0
+            if run_mode == 'async':
+                DBISB.run_async()
+            else:
+                DBISB.run()
     except KeyboardInterrupt:
         pass
@@ -0,0 +1,496 @@
+"""
+snapshot file format of the DevBoxInventory - memory mapped on load, boxes are decoded on first access
+convert a pickle inventory file: python DevBoxInventorySnapshot.py <inventory file> [--output <snapshot file>]
+
+layout (little endian):
+header   magic 'DBXSNAP\\0', version (uint32), number of boxes (uint32), position of the offset table (uint64),
+         position of the name table (uint64), position of the lease table (uint64), number of leases (uint32) - the
+         last two since version 2
+records  per box: length of the record (uint32), name, ip, user, comment, lease channel (each: length as uint32 -
+         0xffffffff for None - and utf-8), time taken, lease end (each double - NaN for None)
+offsets  position of every record (uint64) in inventory order
+names    record numbers (uint32) sorted by the utf-8 encoded name - a box is found by bisect
+leases   record numbers (uint32) of the boxes having a lease - read on start instead of all boxes
+"""
+import argparse
+import math
+import mmap
+import struct
+from collections import OrderedDict
+from os import O_RDONLY, close, fstat, fsync, link, open as os_open, path, remove, rename
+from threading import RLock
+
+MAGIC = b'DBXSNAP\x00'
+VERSION = 2
+
+_HEADER_V1 = struct.Struct('<8sIIQQ')
+_HEADER = struct.Struct('<8sIIQQQI')
+_LENGTH = struct.Struct('<I')
+_OFFSET = struct.Struct('<Q')
+_FLOATS = struct.Struct('<dd')
+_NONE = 0xffffffff
+
+
+def _str_dump(value, out):
+
+    if value is None:
+        out.append(_LENGTH.pack(_NONE))
+    else:
+        data = value.encode('utf-8')
+        out.append(_LENGTH.pack(len(data)))
+        out.append(data)
+
+
+def _str_load(buf, offset):
+
+    length = _LENGTH.unpack_from(buf, offset)[0]
+    offset += _LENGTH.size
+    if length == _NONE:
+        return None, offset
+
+    return buf[offset:offset + length].decode('utf-8'), offset + length
+
+
+def _float_dump(value):
+
+    return float('nan') if value is None else value
+
+
+def _float_load(value):
+
+    return None if math.isnan(value) else value
+
+
+def record_dumps(box):
+    """
+    the record of the box including its length
+    """
+    lease_end, lease_channel = box.lease or (None, None)
+    out = []
+    for value in (box.name, box.ip, box.user, box.comment, lease_channel):
+        _str_dump(value, out)
+    out.append(_FLOATS.pack(_float_dump(box.taken_timestamp), _float_dump(lease_end)))
+    payload = b''.join(out)
+
+    return _LENGTH.pack(len(payload)) + payload
+
+
+def record_load(buf, offset, box_type):
+    """
+    the box of the record at offset
+    """
+    offset += _LENGTH.size
+    fields = []
+    for _ in range(5):
+        value, offset = _str_load(buf, offset)
+        fields.append(value)
+    name, ip, user, comment, lease_channel = fields
+    taken_timestamp, lease_end = (_float_load(value) for value in _FLOATS.unpack_from(buf, offset))
+
+    return box_type(name, ip, user, comment, taken_timestamp,
+                    (lease_end, lease_channel) if lease_end is not None else None)
+
+
+def _snapshot_build(records):
+
+    # records: (utf-8 encoded name, record, has a lease) in inventory order
+    out = [None]
+    offsets = []
+    position = _HEADER.size
+    for _, record, _ in records:
+        offsets.append(position)
+        out.append(record)
+        position += len(record)
+
+    offsets_position = position
+    out.append(b''.join(_OFFSET.pack(offset) for offset in offsets))
+    names_position = offsets_position + _OFFSET.size * len(offsets)
+    out.append(b''.join(_LENGTH.pack(number) for number in
+                        sorted(range(len(records)), key=lambda number: records[number][0])))
+    leases_position = names_position + _LENGTH.size * len(records)
+    leased = [number for number, (_, _, lease) in enumerate(records) if lease]
+    out.append(b''.join(_LENGTH.pack(number) for number in leased))
+    out[0] = _HEADER.pack(MAGIC, VERSION, len(records), offsets_position, names_position, leases_position,
+                          len(leased))
+
+    return b''.join(out)
+
+
+def snapshot_dumps(boxes):
+    """
+    the snapshot of the boxes given as mapping box name -> box
+    """
+    if isinstance(boxes, DevBoxInventorySnapshot):
+        return boxes.dumps()
+
+    return _snapshot_build([(box.name.encode('utf-8'), record_dumps(box), box.lease is not None)
+                            for box in boxes.values()])
+
+
+def journal_record_dumps(record):
+    """
+    journal record ('del', name) or (op, name, ip, user, comment, time taken, lease) in the record format
+    """
+    op, name = record[:2]
+    out = []
+    _str_dump(op, out)
+    if op == 'del':
+        _str_dump(name, out)
+        payload = b''.join(out)
+        return _LENGTH.pack(len(payload)) + payload
+
+    ip, user, comment, taken_timestamp, lease = record[2:7]
+    lease_end, lease_channel = lease or (None, None)
+    for value in (name, ip, user, comment, lease_channel):
+        _str_dump(value, out)
+    out.append(_FLOATS.pack(_float_dump(taken_timestamp), _float_dump(lease_end)))
+    payload = b''.join(out)
+
+    return _LENGTH.pack(len(payload)) + payload
+
+
+def journal_record_load(journal):
+    """
+    read the next journal record - raises EOFError at the end of the journal or if the record is incomplete
+    """
+    header = journal.read(_LENGTH.size)
+    if len(header) < _LENGTH.size:
+        raise EOFError()
+    length = _LENGTH.unpack(header)[0]
+    payload = journal.read(length)
+    if len(payload) < length:
+        raise EOFError()
+
+    op, offset = _str_load(payload, 0)
+    if op == 'del':
+        return op, _str_load(payload, offset)[0]
+
+    fields = []
+    for _ in range(5):
+        value, offset = _str_load(payload, offset)
+        fields.append(value)
+    name, ip, user, comment, lease_channel = fields
+    taken_timestamp, lease_end = (_float_load(value) for value in _FLOATS.unpack_from(payload, offset))
+
+    return (op, name, ip, user, comment, taken_timestamp,
+            (lease_end, lease_channel) if lease_end is not None else None)
+
+
+class DevBoxInventorySnapshot(object):
+    """
+    box name -> box mapping of a memory mapped snapshot file, used by the inventory like an OrderedDict
+
+    Opening a snapshot reads its header and lease table only. A box is decoded when it is accessed the first time and
+    kept from then on, so changes of it stay - the memory used grows with the number of boxes accessed, not with the
+    number of boxes in the file, until a query looks at all of them. leases() decodes the boxes of the lease table
+    without keeping them. Boxes added or deleted later are kept besides the mapped file.
+
+    The file must never be changed while it is mapped - a new snapshot is written to a new file that replaces the
+    old one.
+    """
+    def __init__(self, snapshot_file, box_type):
+
+        self._box_type = box_type
+        self._file = open(snapshot_file, 'rb')
+        try:
+            if fstat(self._file.fileno()).st_size < _HEADER_V1.size:
+                raise ValueError('{0} is no inventory snapshot'.format(snapshot_file))
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, version, self._count, self._offsets_position, self._names_position = _HEADER_V1.unpack_from(
+                self._map, 0)
+            if magic != MAGIC:
+                raise ValueError('{0} is no inventory snapshot - convert it using DevBoxInventorySnapshot.py'.format(
+                    snapshot_file))
+            if version > VERSION:
+                raise ValueError('snapshot {0} has version {1} - only {2} is known'.format(snapshot_file, version,
+                                                                                         VERSION))
+            # offsets of the records having a lease - None for version 1 files, they have no lease table
+            self._leased = None
+            if version >= 2:
+                leases_position, leases = _HEADER.unpack_from(self._map, 0)[5:]
+                self._leased = set(self._offset(_LENGTH.unpack_from(self._map, leases_position + _LENGTH.size * idx)[0])
+                                   for idx in range(leases))
+        except Exception:
+            self._file.close()
+            raise
+
+        # boxes of the file looked up so far, names of the ones changed and of the boxes of the file deleted since
+        self._decoded = {}
+        self._changed = set()
+        self._deleted = set()
+        # names of the boxes of the file in inventory order once all of them were decoded, None before
+        self._names = None
+        # boxes not in the file - added or added again after they were deleted
+        self._added = OrderedDict()
+
+    def _offset(self, number):
+
+        return _OFFSET.unpack_from(self._map, self._offsets_position + _OFFSET.size * number)[0]
+
+    def _name_at(self, offset):
+
+        # the name is the first field of the record
+        offset += _LENGTH.size
+        length = _LENGTH.unpack_from(self._map, offset)[0]
+        offset += _LENGTH.size
+
+        return self._map[offset:offset + length]
+
+    def _find(self, name):
+
+        # offset of the record of the box in the file or None
+        key = name.encode('utf-8')
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            number = _LENGTH.unpack_from(self._map, self._names_position + _LENGTH.size * middle)[0]
+            if self._name_at(self._offset(number)) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low == self._count:
+            return None
+
+        offset = self._offset(_LENGTH.unpack_from(self._map, self._names_position + _LENGTH.size * low)[0])
+        return offset if self._name_at(offset) == key else None
+
+    def _names_get(self):
+
+        # names of the boxes of the file that were not deleted, in inventory order
+        if self._names is not None:
+            return [name for name in self._names if name not in self._deleted]
+
+        return [name for name, _ in self._records(self._deleted)]
+
+    def _records(self, deleted):
+
+        # (name, offset) of the boxes of the file that were not deleted, in inventory order
+        for number in range(self._count):
+            offset = self._offset(number)
+            name = self._name_at(offset).decode('utf-8')
+            if name not in deleted:
+                yield name, offset
+
+    def get(self, name, default=None):
+
+        box = self._added.get(name)
+        if box is not None:
+            return box
+        if name in self._deleted:
+            return default
+
+        box = self._decoded.get(name)
+        if box is None:
+            offset = self._find(name)
+            if offset is None:
+                return default
+            box = self._decoded[name] = record_load(self._map, offset, self._box_type)
+
+        return box
+
+    def __contains__(self, name):
+
+        if name in self._added:
+            return True
+        if name in self._deleted:
+            return False
+
+        return name in self._decoded or self._find(name) is not None
+
+    def __getitem__(self, name):
+
+        box = self.get(name)
+        if box is None:
+            raise KeyError(name)
+
+        return box
+
+    def __setitem__(self, name, box):
+
+        if name not in self._added and name not in self._deleted and self._find(name) is not None:
+            self._decoded[name] = box
+            self._changed.add(name)
+        else:
+            self._added[name] = box
+
+    def pop(self, name, *default):
+
+        if name in self._added:
+            return self._added.pop(name)
+
+        box = self.get(name)
+        if box is None:
+            if default:
+                return default[0]
+            raise KeyError(name)
+
+        self._decoded.pop(name, None)
+        self._deleted.add(name)
+        return box
+
+    def update(self, boxes):
+
+        for name, box in boxes:
+            self[name] = box
+
+    def __len__(self):
+
+        return self._count - len(self._deleted) + len(self._added)
+
+    def __iter__(self):
+
+        for name in self._names_get():
+            yield name
+        for name in list(self._added):
+            yield name
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+
+        if self._names is not None:
+            # all boxes of the file are decoded - no need to look at the file
+            for name in self._names:
+                if name not in self._deleted:
+                    yield self._decoded[name]
+            for box in list(self._added.values()):
+                yield box
+            return
+
+        for name, offset in self._records(self._deleted):
+            box = self._decoded.get(name)
+            if box is None:
+                box = self._decoded[name] = record_load(self._map, offset, self._box_type)
+            yield box
+        for box in list(self._added.values()):
+            yield box
+
+    def decode(self):
+        """
+        decode and keep the boxes of the file not accessed yet, so values() finds all of them decoded. The mapped file
+        never changes and a box accessed in the meantime is kept as it is - decode may run without holding the lock
+        of the inventory.
+        """
+        if self._names is not None:
+            return
+
+        names = []
+        for number in range(self._count):
+            offset = self._offset(number)
+            name = self._name_at(offset).decode('utf-8')
+            names.append(name)
+            if name not in self._decoded and name not in self._deleted:
+                # a box deleted in the meantime is left behind in _decoded - the deleted names are checked first
+                self._decoded.setdefault(name, record_load(self._map, offset, self._box_type))
+        self._names = names
+
+    def leases(self):
+        """
+        the boxes having a lease - only the records in the lease table of the file are decoded, they are not kept
+        """
+        if self._leased is None:
+            return [box for box in self.values() if box.lease is not None]
+
+        boxes = [box for name, box in list(self._decoded.items())
+                 if box.lease is not None and name not in self._deleted]
+        boxes.extend(box for box in self._added.values() if box.lease is not None)
+        for offset in self._leased:
+            name = self._name_at(offset).decode('utf-8')
+            if name not in self._decoded and name not in self._deleted:
+                boxes.append(record_load(self._map, offset, self._box_type))
+
+        return boxes
+
+    def items(self):
+
+        for box in self.values():
+            yield box.name, box
+
+    def changed(self, name):
+        """
+        tell that the box was changed in place - dumps writes its record again instead of copying it from the file
+        """
+        self._changed.add(name)
+
+    def dumps(self):
+        """
+        snapshot of the current boxes - the records of boxes not changed are copied from the file
+        """
+        records = []
+        for name, offset in self._records(self._deleted):
+            box = self._decoded.get(name)
+            if box is not None and name in self._changed:
+                records.append((name.encode('utf-8'), record_dumps(box), box.lease is not None))
+                continue
+
+            length = _LENGTH.unpack_from(self._map, offset)[0]
+            if box is not None:
+                lease = box.lease is not None
+            elif self._leased is not None:
+                lease = offset in self._leased
+            else:
+                lease = record_load(self._map, offset, self._box_type).lease is not None
+            records.append((name.encode('utf-8'), self._map[offset:offset + _LENGTH.size + length], lease))
+        records.extend((name.encode('utf-8'), record_dumps(box), box.lease is not None)
+                       for name, box in self._added.items())
+
+        return _snapshot_build(records)
+
+    def close(self):
+
+        self._map.close()
+        self._file.close()
+
+
+def _sync_dir(file_name):
+
+    dir_fd = os_open(path.dirname(path.abspath(file_name)), O_RDONLY)
+    try:
+        fsync(dir_fd)
+    finally:
+        close(dir_fd)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='convert a pickle inventory file to a snapshot')
+    parser.add_argument('inventory_file', help='pickle inventory file - its journal is folded in')
+    parser.add_argument('--output', help='snapshot file to write - default: replace the inventory file and keep the '
+                                         'pickle file as <inventory file>.pickle')
+    args = parser.parse_args()
+
+    if not path.exists(args.inventory_file):
+        parser.error('{0} not found'.format(args.inventory_file))
+
+    # imported here - the storages use this module
+    from DevBoxInventory import DevBox
+    from DevBoxInventoryStorage import DevBoxInventoryPickleStorage
+
+    storage = DevBoxInventoryPickleStorage(args.inventory_file)
+    boxes = storage.load(DevBox, RLock())
+    data = snapshot_dumps(boxes)
+    storage.close()
+
+    output = args.output or args.inventory_file
+    tmp_file = '{0}.tmp'.format(output)
+    with open(tmp_file, 'wb') as snapshot_file:
+        snapshot_file.write(data)
+        snapshot_file.flush()
+        fsync(snapshot_file.fileno())
+
+    if not args.output:
+        # keep the pickle file as <inventory file>.pickle - linked before the snapshot replaces it, so a crash leaves
+        # either the pickle file or the snapshot plus the pickle copy on disk
+        pickle_file = '{0}.pickle'.format(args.inventory_file)
+        if path.exists(pickle_file):
+            remove(pickle_file)
+        link(args.inventory_file, pickle_file)
+    rename(tmp_file, output)
+    _sync_dir(output)
+
+    print('{0} boxes written to {1}'.format(len(boxes), output))
+
+
+if __name__ == '__main__':
+    main()
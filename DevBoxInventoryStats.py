@@ -0,0 +1,321 @@
+"""
+utilization of the boxes and their owners - kept up to date on every change of an owner
+"""
+import json
+import os
+import syslog
+from threading import Lock
+from time import time
+
+DAY = 24 * 60 * 60
+
+# fields of the per day aggregates of boxes and users
+HELD, HOLDS, HOLD_SECONDS, OCCUPIED = range(4)
+
+
+def _add(days, day, field, value):
+
+    counts = days.get(day)
+    if counts is None:
+        counts = days[day] = [0.0, 0, 0.0, 0]
+    counts[field] += value
+
+
+class DevBoxInventoryStats(object):
+    """
+    aggregates per box and per user and day: seconds the box was held (a hold spanning several days is split among
+    them), number of holds that ended, their total length and the number of occupies - for users the occupies they
+    did, for boxes the times the box was occupied.
+
+    The inventory reports every change of an owner once it committed the change, still holding the lock of its
+    storage. The change is appended to a journal (<stats_file>.<generation>.journal), commit() is called by the
+    writes of the storage and makes the journal durable. The aggregates are only updated from the journal: before a change is appended and before a report the
+    events appended since the last look - by this bot or by other bots sharing the inventory - are applied, so every
+    change is counted once by each of them. Holds still running are kept as box name -> (owner, taken since).
+
+    At most every save_interval seconds the aggregates are written to stats_file along with the generation of the
+    next journal and the old journal is removed. Days older than keep_days are dropped then.
+    """
+    keep_days = 90
+    save_interval = 60
+
+    def __init__(self, stats_file):
+
+        self._stats_file = stats_file
+        self._lock = Lock()
+        # name -> {day -> counts}
+        self._boxes = {}
+        self._users = {}
+        # box name -> [owner, taken since]
+        self._holds = {}
+        self._saved = 0
+        # journal the events are appended to, bytes of it applied, stat of stats_file when it was read or written
+        self._generation = 0
+        self._offset = 0
+        self._file_state = None
+        self._journal = None
+
+        with self._lock:
+            self._load()
+
+    def _journal_path(self, generation):
+
+        return '{0}.{1}.journal'.format(self._stats_file, generation)
+
+    def _file_state_get(self):
+
+        try:
+            file_stat = os.stat(self._stats_file)
+        except OSError:
+            return None
+
+        return file_stat.st_ino, file_stat.st_size, file_stat.st_mtime
+
+    def _load(self):
+
+        # called with the lock held
+        self._boxes = {}
+        self._users = {}
+        self._holds = {}
+        self._generation = 0
+        self._offset = 0
+        self._file_state = self._file_state_get()
+        try:
+            with open(self._stats_file) as stats_file:
+                state = json.load(stats_file)
+        except (IOError, OSError, ValueError):
+            return
+
+        for aggregates, stored in ((self._boxes, state.get('boxes', {})), (self._users, state.get('users', {}))):
+            for name, days in stored.items():
+                aggregates[name] = dict((int(day), counts) for day, counts in days.items())
+        self._holds = state.get('holds', {})
+        self._generation = state.get('generation', 0)
+        self._saved = state.get('saved', 0)
+
+    def _read(self):
+
+        # called with the lock held - apply what was appended to the journal since the last look
+        if self._file_state_get() != self._file_state:
+            # another bot sharing the inventory wrote the aggregates and started a new journal
+            self._journal_close()
+            self._load()
+
+        try:
+            with open(self._journal_path(self._generation), 'rb') as journal:
+                journal.seek(self._offset)
+                for line in journal:
+                    if not line.endswith(b'\n'):
+                        break
+                    self._offset += len(line)
+                    try:
+                        self._apply(json.loads(line.decode('utf-8')))
+                    except (ValueError, TypeError, IndexError) as error:
+                        syslog.syslog(syslog.LOG_ERR, 'skipped invalid stats event {0!r}: {1}'.format(line, error))
+        except (IOError, OSError):
+            pass
+
+    def _append(self, events, now):
+
+        # called with the lock held and - by the inventory - the lock of its storage
+        self._read()
+        if self._journal is None:
+            self._journal = open(self._journal_path(self._generation), 'ab')
+        for event in events:
+            line = (json.dumps(event, separators=(',', ':')) + '\n').encode('utf-8')
+            self._journal.write(line)
+            self._offset += len(line)
+            self._apply(event)
+        self._journal.flush()
+
+        if now - self._saved >= self.save_interval:
+            self._save(now)
+
+    def _apply(self, event):
+
+        kind, now, name = event[:3]
+        if kind == 'own':
+            prev_user, user = event[3:5]
+            self._hold_end(name, now)
+            if user:
+                self._holds[name] = [user, now]
+                if prev_user:
+                    _add(self._boxes.setdefault(name, {}), int(now // DAY), OCCUPIED, 1)
+                    _add(self._users.setdefault(user, {}), int(now // DAY), OCCUPIED, 1)
+        elif kind == 'hold':
+            user, since = event[3:5]
+            self._hold_end(name, now)
+            self._holds[name] = [user, since]
+        else:
+            # del: the box was deleted, end: the box was found without owner by sync
+            self._hold_end(name, now)
+
+    def _save(self, now):
+
+        # called with the lock held and the journal read up to its end
+        self._prune(now)
+        state = {'boxes': self._boxes, 'users': self._users, 'holds': self._holds,
+                 'generation': self._generation + 1, 'saved': now}
+        try:
+            with open(self._stats_file + '.tmp', 'w') as stats_file:
+                json.dump(state, stats_file, separators=(',', ':'))
+                stats_file.flush()
+                os.fsync(stats_file.fileno())
+            os.rename(self._stats_file + '.tmp', self._stats_file)
+        except (IOError, OSError) as error:
+            syslog.syslog(syslog.LOG_ERR, 'failed to write stats `{0}`: {1}'.format(self._stats_file, error))
+            return
+
+        # the aggregates hold the events of the old journal now
+        self._journal_close()
+        try:
+            os.remove(self._journal_path(self._generation))
+        except OSError:
+            pass
+        self._generation += 1
+        self._offset = 0
+        self._saved = now
+        self._file_state = self._file_state_get()
+
+    def _journal_close(self):
+
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    def _prune(self, now):
+
+        oldest = int(now // DAY) - self.keep_days
+        for aggregates in (self._boxes, self._users):
+            for name in list(aggregates):
+                days = aggregates[name]
+                for day in [day for day in days if day < oldest]:
+                    del days[day]
+                if not days:
+                    del aggregates[name]
+
+    def _hold_end(self, name, now):
+
+        # called with the lock held - books the running hold of the box
+        hold = self._holds.pop(name, None)
+        if hold is None:
+            return
+
+        user, since = hold
+        since = min(since, now)
+        box_days = self._boxes.setdefault(name, {})
+        user_days = self._users.setdefault(user, {})
+        # days beyond keep_days would be dropped anyway
+        start = max(since, now - self.keep_days * DAY)
+        while start < now:
+            day = int(start // DAY)
+            end = min(now, (day + 1) * DAY)
+            _add(box_days, day, HELD, end - start)
+            _add(user_days, day, HELD, end - start)
+            start = end
+
+        day = int(now // DAY)
+        for days in (box_days, user_days):
+            _add(days, day, HOLDS, 1)
+            _add(days, day, HOLD_SECONDS, now - since)
+
+    @property
+    def counting(self):
+        """
+        True if changes were counted before - the inventory has to be synced only when counting starts
+        """
+        with self._lock:
+            self._read()
+            return self._file_state is not None or os.path.exists(self._journal_path(self._generation))
+
+    def sync(self, box_datas):
+        """
+        take over the owners of the boxes (name, ip, owner, comment, time taken) - needed when counting starts on an
+        inventory that has owners already. Called holding the lock of the storage of the inventory.
+        """
+        now = time()
+        with self._lock:
+            self._read()
+            events = []
+            owned = set()
+            for name, _, user, _, taken_timestamp in box_datas:
+                if not user:
+                    continue
+                owned.add(name)
+                hold = self._holds.get(name)
+                if hold is None or hold[0] != user:
+                    events.append(('hold', now, name, user, taken_timestamp or now))
+            events.extend(('end', now, name) for name in self._holds if name not in owned)
+            self._append(events, now)
+
+    def owner_changed(self, name, prev_user, user, now=None):
+
+        now = time() if now is None else now
+        with self._lock:
+            self._append([('own', now, name, prev_user, user)], now)
+
+    def box_deleted(self, name, now=None):
+
+        now = time() if now is None else now
+        with self._lock:
+            self._append([('del', now, name)], now)
+
+    def commit(self):
+        """
+        make the events appended so far durable - called by the group commit of the storage of the inventory
+        """
+        with self._lock:
+            if self._journal is None:
+                return
+            try:
+                os.fsync(self._journal.fileno())
+            except OSError as error:
+                syslog.syslog(syslog.LOG_ERR, 'failed to sync stats journal: {0}'.format(error))
+
+    def report(self, days, now=None):
+        """
+        per box and per user of the last days (today included): ((name, utilization, holds, mean hold seconds,
+        occupied), ...) sorted by utilization and ((user, held seconds, holds, occupies), ...) sorted by held seconds
+        """
+        now = time() if now is None else now
+        first = int(now // DAY) - days + 1
+        window_start = first * DAY
+        window = max(now - window_start, 1)
+
+        with self._lock:
+            self._read()
+            boxes = dict((name, self._window_sum(box_days, first)) for name, box_days in self._boxes.items())
+            users = dict((name, self._window_sum(user_days, first)) for name, user_days in self._users.items())
+            # running holds count up to now
+            for name, (user, since) in self._holds.items():
+                held = max(0.0, now - max(since, window_start))
+                for aggregates, key in ((boxes, name), (users, user)):
+                    counts = aggregates.setdefault(key, [0.0, 0, 0.0, 0])
+                    counts[HELD] += held
+
+        box_rows = [(name, counts[HELD] / window, counts[HOLDS],
+                     counts[HOLD_SECONDS] / counts[HOLDS] if counts[HOLDS] else None, counts[OCCUPIED])
+                    for name, counts in boxes.items() if any(counts)]
+        user_rows = [(name, counts[HELD], counts[HOLDS], counts[OCCUPIED])
+                     for name, counts in users.items() if any(counts)]
+
+        return (sorted(box_rows, key=lambda row: (-row[1], row[0])),
+                sorted(user_rows, key=lambda row: (-row[1], row[0])))
+
+    @staticmethod
+    def _window_sum(days, first):
+
+        total = [0.0, 0, 0.0, 0]
+        for day, counts in days.items():
+            if day >= first:
+                for field, value in enumerate(counts):
+                    total[field] += value
+
+        return total
+
+    def close(self):
+
+        with self._lock:
+            if self._journal is not None:
+                os.fsync(self._journal.fileno())
+            self._journal_close()
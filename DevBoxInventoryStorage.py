@@ -0,0 +1,635 @@
+"""
+storage backends for the DevBoxInventory
+"""
+import fcntl
+import pickle
+import sqlite3
+from collections import OrderedDict
+from contextlib import contextmanager
+from os import O_RDONLY, close, fsync, open as os_open, path, remove, rename, stat
+from sys import stderr
+from threading import Condition, Lock, Thread
+from time import sleep
+
+from DevBoxInventoryMetrics import metrics
+from DevBoxInventorySnapshot import DevBoxInventorySnapshot, journal_record_dumps, journal_record_load, \
+    snapshot_dumps
+
+
+class DevBoxInventoryStorage(object):
+    """
+    interface of a storage backend
+
+    The inventory keeps all boxes in memory and reports every change to the storage while holding its lock.
+    Afterwards it calls commit() to make the changes durable. Writes are group committed: a caller returns as soon
+    as its change is on disk, changes of all callers arriving within commit_window milliseconds are made durable by
+    a single write.
+
+    If a lock_file is given the storage is shared with other processes: changes are done holding exclusive() which
+    locks the lock_file, refresh() returns the inventory as written by another process if it changed since we
+    read or wrote it last.
+    """
+    def __init__(self, commit_window=0, lock_file=None):
+
+        self._inventory = None
+        self._lock = None
+
+        self._lock_file = lock_file
+        self._exclusive_lock = Lock()
+
+        self._commit_window = commit_window / 1000.0
+        self._commit_cond = Condition()
+        self._commit_requested = 0
+        self._commit_done = 0
+        self._committing = False
+        # called by every write of the commit
+        self._sync_funcs = []
+
+    def load(self, box_type, lock):
+        """
+        load the inventory - returns an OrderedDict box name -> box that is owned by the inventory from now on
+        """
+        raise NotImplementedError()
+
+    def box_added(self, box):
+        raise NotImplementedError()
+
+    def box_deleted(self, box):
+        raise NotImplementedError()
+
+    def box_changed(self, box):
+        raise NotImplementedError()
+
+    def box_names_by_user(self, user):
+        """
+        names of the boxes owned by user in inventory order or None if the storage can not answer this query - called
+        with the lock of the inventory held
+        """
+        return None
+
+    def box_names_by_ip(self, ip):
+        """
+        names of the boxes having the ip in inventory order or None if the storage can not answer this query - called
+        with the lock of the inventory held
+        """
+        return None
+
+    @property
+    def shared(self):
+        return self._lock_file is not None
+
+    @contextmanager
+    def exclusive(self):
+        """
+        keep other threads and - for a shared storage - other processes from changing the storage
+        """
+        if self._lock_file is None:
+            yield
+            return
+
+        # flock only excludes other processes, the threads of this process share the lock file
+        with self._exclusive_lock:
+            with open(self._lock_file, 'a') as lock_file:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def refresh(self):
+        """
+        the inventory as changed by another process or None if it did not change - the returned OrderedDict is owned
+        by the inventory from now on. Called with the lock of the inventory held.
+        """
+        return None
+
+    def _sync(self):
+        """
+        make all changes reported so far durable
+        """
+        raise NotImplementedError()
+
+    def sync_with(self, func):
+        """
+        call func with every write of commit - files kept along with the storage are made durable by the same group
+        commit
+        """
+        self._sync_funcs.append(func)
+
+    def commit(self):
+        """
+        make all changes done so far durable - returns after a write that started after the call completed
+        """
+        metrics.inc('inventory_storage_commits_total')
+        with self._commit_cond:
+            self._commit_requested += 1
+            generation = self._commit_requested
+            while self._committing:
+                self._commit_cond.wait()
+            if self._commit_done >= generation:
+                # another caller wrote our change in the meantime
+                return
+            self._committing = True
+
+        committed = 0
+        try:
+            if self._commit_window > 0:
+                # give changes that arrive in the next few milliseconds the chance to ride on this write
+                sleep(self._commit_window)
+            with self._commit_cond:
+                committed = self._commit_requested
+            with metrics.timer('inventory_storage_sync_seconds'):
+                self._sync()
+                for func in self._sync_funcs:
+                    func()
+        finally:
+            with self._commit_cond:
+                self._committing = False
+                self._commit_done = max(self._commit_done, committed)
+                self._commit_cond.notify_all()
+
+    def close(self):
+        pass
+
+
+class DevBoxInventoryPickleStorage(DevBoxInventoryStorage):
+    """
+    store the inventory as pickle file
+
+    If journal_size is > 0 changes are appended to a journal file next to the inventory file instead of
+    rewriting the whole inventory. The journal is replayed on load and compacted into the inventory file by a
+    background thread as soon as it holds more than journal_size records.
+
+    A shared inventory file (no journal) is reloaded if its inode, size or mtime differ from the ones we saw last.
+    """
+    def __init__(self, inventory_file, journal_size=0, commit_window=0, shared=False):
+
+        if shared and journal_size > 0:
+            raise Exception('a shared inventory file can not use a journal')
+
+        super(DevBoxInventoryPickleStorage, self).__init__(commit_window,
+                                                           '{0}.lock'.format(inventory_file) if shared else None)
+
+        self._inventory_file = inventory_file
+        self._box_type = None
+        # stat of the inventory file when we read or wrote it last
+        self._file_state = None
+
+        self._journal_size = journal_size
+        self._journal_file = '{0}.journal'.format(inventory_file)
+        self._journal_compact_file = '{0}.journal.compact'.format(inventory_file)
+        self._journal = None
+        self._journal_records = 0
+        self._journal_lock = Lock()
+        self._compactor = None
+
+    def load(self, box_type, lock):
+
+        self._box_type = box_type
+        self._lock = lock
+        self._inventory = OrderedDict()
+
+        with self.exclusive():
+            file_state = self._file_state_get()
+            try:
+                self._load()
+            except IOError:
+                self._save()
+            else:
+                self._file_state = file_state
+
+        return self._inventory
+
+    def _file_state_get(self):
+
+        try:
+            file_stat = stat(self._inventory_file)
+        except OSError:
+            return None
+
+        return file_stat.st_ino, file_stat.st_size, file_stat.st_mtime
+
+    def refresh(self):
+
+        if self._lock_file is None:
+            return None
+
+        # stat before reading - a change done while we read is detected next time
+        file_state = self._file_state_get()
+        if file_state is None or file_state == self._file_state:
+            return None
+
+        inventory = self._inventory
+        self._inventory = OrderedDict()
+        try:
+            self._load()
+        except Exception as error:
+            stderr.write('Failed to reload inventory file `{0}` cause: {1}'.format(self._inventory_file, error))
+            self._inventory = inventory
+            return None
+
+        self._file_state = file_state
+        return self._inventory
+
+    def _save(self):
+
+        try:
+            with metrics.timer('inventory_storage_save_seconds'):
+                with self._lock:
+                    data = self._snapshot_dumps()
+                    count = len(self._inventory)
+                self._write_snapshot(data)
+                self._file_state = self._file_state_get()
+
+            return count
+
+        except Exception as error:
+            raise Exception('Failed to create inventory file in `{0}` cause: {1}'.format(self._inventory_file, error))
+
+    def _write_snapshot(self, data):
+
+        # never truncate the inventory file in place - write a temporary file and replace the old one so a crash
+        # leaves either the old or the new inventory on disk
+        tmp_file = '{0}.tmp'.format(self._inventory_file)
+        with open(tmp_file, "wb") as inv_file:
+            inv_file.write(data)
+            inv_file.flush()
+            fsync(inv_file.fileno())
+        rename(tmp_file, self._inventory_file)
+        self._sync_dir()
+
+    def _sync_dir(self):
+
+        try:
+            dir_fd = os_open(path.dirname(path.abspath(self._inventory_file)), O_RDONLY)
+        except OSError:
+            return
+        try:
+            fsync(dir_fd)
+        except OSError:
+            pass
+        finally:
+            close(dir_fd)
+
+    def _snapshot_dumps(self):
+
+        # called with the inventory lock held
+        return pickle.dumps(self._inventory)
+
+    def _snapshot_read(self):
+
+        try:
+            with open(self._inventory_file, "rb") as inv_file:
+                inventory = pickle.load(inv_file)
+        except IOError as error:
+            if error.errno == 2:
+                raise IOError('File not found')
+            else:
+                raise Exception('Failed to load inventory file from `{0}` cause: {1}'.format(self._inventory_file, error))
+        except EOFError as error:
+            raise Exception(
+                'Failed to load inventory file from `{0}` cause file is empty or has invalid format.'.format(
+                    self._inventory_file))
+
+        except Exception as error:
+            raise Exception('Failed to load inventory file from `{0}` cause: {1}'.format(self._inventory_file, error))
+
+        if isinstance(inventory, list):
+            # inventory files written by v0.2 and older hold a plain list of boxes - index them by name
+            # and write the file back in the new format
+            self._inventory.update((box.name, box) for box in inventory)
+            self._save()
+        else:
+            self._inventory.update(inventory)
+
+    def _load(self):
+
+        self._snapshot_read()
+        journal_files = [journal_file for journal_file in (self._journal_compact_file, self._journal_file)
+                         if path.exists(journal_file)]
+        if journal_files:
+            for journal_file in journal_files:
+                self._journal_replay(journal_file)
+            # fold the replayed records into the inventory file and start with an empty journal - even if nothing
+            # was replayed, new records must never be appended behind a torn one
+            self._save()
+            for journal_file in journal_files:
+                remove(journal_file)
+
+        return len(self._inventory)
+
+    def _journal_replay(self, journal_file):
+
+        replayed = 0
+        with open(journal_file, "rb") as journal:
+            while True:
+                offset = journal.tell()
+                try:
+                    record = self._journal_record_load(journal)
+                except Exception as error:
+                    # the last record may be incomplete if we died while appending it - the journal ends at the last
+                    # complete one
+                    journal.seek(0, 2)
+                    size = journal.tell()
+                    if size > offset:
+                        stderr.write('Dropped {0} bytes of journal `{1}` behind offset {2} ({3} records replayed) '
+                                     'cause: {4}\n'.format(size - offset, journal_file, offset, replayed,
+                                                          error.__class__.__name__))
+                    break
+                self._journal_apply(record)
+                replayed += 1
+
+        return replayed
+
+    def _journal_apply(self, record):
+
+        if record[0] == 'del':
+            self._inventory.pop(record[1], None)
+        else:
+            # add and set records carry the complete box state so replaying a record twice is harmless - records
+            # written before leases were introduced have no lease
+            name, ip, user, comment, taken_timestamp = record[1:6]
+            lease = record[6] if len(record) > 6 else None
+            box = self._inventory.get(name)
+            if box is None:
+                self._inventory[name] = self._box_type(name, ip, user, comment, taken_timestamp, lease)
+            else:
+                box.ip = ip
+                box.user = user
+                box.comment = comment
+                box.taken_timestamp = taken_timestamp
+                box.lease = lease
+
+    def _journal_append(self, op, box):
+
+        # called with the inventory lock held so the records are written in the order the changes were made
+        if self._journal_size <= 0:
+            return
+
+        if op == 'del':
+            record = (op, box.name)
+        else:
+            record = (op, box.name, box.ip, box.user, box.comment, box.taken_timestamp, box.lease)
+
+        with self._journal_lock:
+            try:
+                if self._journal is None:
+                    self._journal = open(self._journal_file, "ab")
+                self._journal_record_dump(record, self._journal)
+                self._journal.flush()
+            except Exception as error:
+                raise Exception('Failed to write journal file `{0}` cause: {1}'.format(self._journal_file, error))
+
+            self._journal_records += 1
+            if self._journal_records > self._journal_size and self._compactor is None:
+                self._journal_compact_start()
+
+    @staticmethod
+    def _journal_record_dump(record, journal):
+        pickle.dump(record, journal, pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def _journal_record_load(journal):
+        return pickle.load(journal)
+
+    def _journal_compact_start(self):
+
+        # called with the journal lock held: take a copy of the current state and start a new journal, the
+        # old one is kept until the snapshot containing its records is written
+        fsync(self._journal.fileno())
+        self._journal.close()
+        self._journal = None
+        self._journal_records = 0
+        if path.exists(self._journal_compact_file):
+            # a previous compaction failed - keep its records in front of the current ones
+            with open(self._journal_compact_file, "ab") as compact_file, open(self._journal_file, "rb") as journal:
+                compact_file.write(journal.read())
+            remove(self._journal_file)
+        else:
+            rename(self._journal_file, self._journal_compact_file)
+
+        snapshot = self._snapshot_dumps()
+
+        self._compactor = Thread(target=self._journal_compact, args=(snapshot,))
+        self._compactor.daemon = True
+        self._compactor.start()
+
+    def _journal_compact(self, snapshot):
+
+        try:
+            self._write_snapshot(snapshot)
+            remove(self._journal_compact_file)
+        except Exception as error:
+            stderr.write('Failed to compact journal `{0}` cause: {1}'.format(self._journal_compact_file, error))
+        finally:
+            with self._journal_lock:
+                self._compactor = None
+
+    def box_added(self, box):
+        self._journal_append('add', box)
+
+    def box_deleted(self, box):
+        self._journal_append('del', box)
+
+    def box_changed(self, box):
+        self._journal_append('set', box)
+
+    def _sync(self):
+
+        if self._journal_size > 0:
+            with self._journal_lock:
+                if self._journal is not None:
+                    fsync(self._journal.fileno())
+        else:
+            self._save()
+
+    def close(self):
+        """
+        wait for a running journal compaction and close the journal
+        """
+        compactor = self._compactor
+        if compactor is not None:
+            compactor.join()
+
+        with self._journal_lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+
+
+class DevBoxInventorySnapshotStorage(DevBoxInventoryPickleStorage):
+    """
+    store the inventory as snapshot file (see DevBoxInventorySnapshot) instead of a pickle file
+
+    Loading maps the file and reads its header only, boxes are decoded on first access - the time to load and the
+    memory used do not grow with the number of boxes. Journal and sharing work as for the pickle storage, the journal
+    records are written in the record format of the snapshot. Pickle files are converted by DevBoxInventorySnapshot.py.
+    """
+    def _snapshot_dumps(self):
+
+        # called with the inventory lock held
+        return snapshot_dumps(self._inventory)
+
+    def _snapshot_read(self):
+
+        try:
+            self._inventory = DevBoxInventorySnapshot(self._inventory_file, self._box_type)
+        except IOError as error:
+            if error.errno == 2:
+                raise IOError('File not found')
+            raise Exception('Failed to load inventory file from `{0}` cause: {1}'.format(self._inventory_file, error))
+        except Exception as error:
+            raise Exception('Failed to load inventory file from `{0}` cause: {1}'.format(self._inventory_file, error))
+
+    def _journal_apply(self, record):
+
+        super(DevBoxInventorySnapshotStorage, self)._journal_apply(record)
+        if record[0] != 'del':
+            self._snapshot_changed(record[1])
+
+    def box_changed(self, box):
+
+        # boxes are changed in place - the snapshot has to write their records again
+        self._snapshot_changed(box.name)
+        super(DevBoxInventorySnapshotStorage, self).box_changed(box)
+
+    def _snapshot_changed(self, name):
+
+        # a new inventory is a plain mapping until its first snapshot is read - all its records are written anyway
+        if isinstance(self._inventory, DevBoxInventorySnapshot):
+            self._inventory.changed(name)
+
+    @staticmethod
+    def _journal_record_dump(record, journal):
+        journal.write(journal_record_dumps(record))
+
+    @staticmethod
+    def _journal_record_load(journal):
+        return journal_record_load(journal)
+
+
+class DevBoxInventorySqliteStorage(DevBoxInventoryStorage):
+    """
+    store the inventory in an sqlite database - every change updates a single row
+
+    A shared database is reloaded if PRAGMA data_version tells another connection committed a change.
+    """
+    def __init__(self, db_file, commit_window=0, shared=False):
+
+        super(DevBoxInventorySqliteStorage, self).__init__(commit_window,
+                                                           '{0}.lock'.format(db_file) if shared else None)
+
+        self._db_file = db_file
+        self._db = None
+        self._box_type = None
+        self._data_version = None
+
+    def load(self, box_type, lock):
+
+        self._box_type = box_type
+        self._lock = lock
+        self._inventory = OrderedDict()
+
+        try:
+            self._db = sqlite3.connect(self._db_file, check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS boxes ('
+                             'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                             'name TEXT NOT NULL UNIQUE, '
+                             'ip TEXT, '
+                             'user TEXT, '
+                             'comment TEXT, '
+                             'taken_timestamp REAL, '
+                             'lease_end REAL, '
+                             'lease_channel TEXT)')
+            columns = [row[1] for row in self._db.execute('PRAGMA table_info(boxes)')]
+            if 'lease_end' not in columns:
+                # databases written before leases were introduced
+                self._db.execute('ALTER TABLE boxes ADD COLUMN lease_end REAL')
+                self._db.execute('ALTER TABLE boxes ADD COLUMN lease_channel TEXT')
+            # owner and ip queries are answered by the database (see box_names_by_user and box_names_by_ip)
+            self._db.execute('CREATE INDEX IF NOT EXISTS boxes_user ON boxes (user)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS boxes_ip ON boxes (ip)')
+            self._db.commit()
+            self._select()
+
+        except sqlite3.Error as error:
+            raise Exception('Failed to load inventory database from `{0}` cause: {1}'.format(self._db_file, error))
+
+        return self._inventory
+
+    def _select(self):
+
+        self._data_version = self._db.execute('PRAGMA data_version').fetchone()[0]
+        for name, ip, user, comment, taken_timestamp, lease_end, lease_channel in self._db.execute(
+                'SELECT name, ip, user, comment, taken_timestamp, lease_end, lease_channel FROM boxes ORDER BY id'):
+            self._inventory[name] = self._box_type(name, ip, user, comment, taken_timestamp,
+                                                   (lease_end, lease_channel) if lease_end is not None else None)
+
+    def refresh(self):
+
+        if self._lock_file is None:
+            return None
+
+        inventory = self._inventory
+        try:
+            # data_version only changes on commits of other connections
+            if self._db.execute('PRAGMA data_version').fetchone()[0] == self._data_version:
+                return None
+            self._inventory = OrderedDict()
+            self._select()
+        except sqlite3.Error as error:
+            stderr.write('Failed to reload inventory database `{0}` cause: {1}'.format(self._db_file, error))
+            self._inventory = inventory
+            return None
+
+        return self._inventory
+
+    def box_added(self, box):
+        lease_end, lease_channel = box.lease or (None, None)
+        self._db.execute('INSERT INTO boxes (name, ip, user, comment, taken_timestamp, lease_end, lease_channel) '
+                         'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                         (box.name, box.ip, box.user, box.comment, box.taken_timestamp, lease_end, lease_channel))
+
+    def box_deleted(self, box):
+        self._db.execute('DELETE FROM boxes WHERE name = ?', (box.name,))
+
+    def box_changed(self, box):
+        lease_end, lease_channel = box.lease or (None, None)
+        self._db.execute('UPDATE boxes SET ip = ?, user = ?, comment = ?, taken_timestamp = ?, lease_end = ?, '
+                         'lease_channel = ? WHERE name = ?',
+                         (box.ip, box.user, box.comment, box.taken_timestamp, lease_end, lease_channel, box.name))
+
+    def box_names_by_user(self, user):
+        return [row[0] for row in self._db.execute('SELECT name FROM boxes WHERE user = ? ORDER BY id', (user,))]
+
+    def box_names_by_ip(self, ip):
+        return [row[0] for row in self._db.execute('SELECT name FROM boxes WHERE ip = ? ORDER BY id', (ip,))]
+
+    def _sync(self):
+
+        try:
+            with self._lock:
+                self._db.commit()
+        except sqlite3.Error as error:
+            raise Exception('Failed to write inventory database `{0}` cause: {1}'.format(self._db_file, error))
+
+    def close(self):
+
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+def storage_create(storage_type, inventory_file, journal_size=0, commit_window=0, shared=False):
+    """
+    create the storage backend given by name (pickle, snapshot or sqlite) - shared if other processes use it as well
+    """
+    if storage_type == 'pickle':
+        return DevBoxInventoryPickleStorage(inventory_file, journal_size, commit_window, shared)
+    elif storage_type == 'snapshot':
+        return DevBoxInventorySnapshotStorage(inventory_file, journal_size, commit_window, shared)
+    elif storage_type == 'sqlite':
+        return DevBoxInventorySqliteStorage(inventory_file, commit_window, shared)
+
+    raise Exception('unknown inventory storage {0}'.format(storage_type))
@@ -1,4 +1,30 @@
-from DevBoxInventoryCmdParser import DevBoxInventoryCmdParser
+import pickle
+import os
+from collections import OrderedDict
+from multiprocessing import Process
+import random
+import requests
+import struct
+from threading import Event, RLock, Thread
+from time import sleep, time
+
+from DevBoxInventory import DevBoxInventory, DevBox, DevBoxInventoryConflict
+from DevBoxInventoryBulk import boxes_parse
+from DevBoxInventoryCmdParser import DevBoxInventoryCmd, DevBoxInventoryCmdParser
+from DevBoxInventoryCmdParserLegacy import DevBoxInventoryCmdParserLegacy
+from DevBoxInventoryFakeSlack import DevBoxInventoryFakeSlack
+from DevBoxInventoryFilter import DevBoxFilter
+from DevBoxInventoryHistory import DevBoxInventoryHistory
+from DevBoxInventoryLeases import DevBoxInventoryLeases, lease_parse
+from DevBoxInventoryMetrics import DevBoxInventoryMetrics, DevBoxInventoryMetricsServer
+from DevBoxInventoryOutbox import DevBoxInventoryOutbox
+from DevBoxInventoryProfiler import DevBoxInventoryProfiler, profile_summary
+from DevBoxInventoryRenderer import DevBoxInventoryRenderer
+from DevBoxInventorySlackBot import DevBoxInventorySlackBot
+from DevBoxInventoryUsers import DevBoxInventoryUserDirectory
+from DevBoxInventorySnapshot import DevBoxInventorySnapshot, snapshot_dumps
+from DevBoxInventoryStats import DevBoxInventoryStats, DAY
+from DevBoxInventoryStorage import DevBoxInventoryPickleStorage, DevBoxInventorySqliteStorage, storage_create
 
 
 def test_detect_bot_name():
@@ -169,3 +195,942 @@ def test_detect_arguments():
         cp.parse('<@inventory> add fre comment:"" ip:1.2.3.4 comment:"baz for bar"\"')
     except Exception as error:
         assert error.message == 'unknown argument name "'
+
+
+def test_parse_cmd():
+
+    cp = DevBoxInventoryCmdParser('inventory', ['help', 'list', 'add'], ['ip', 'comment'])
+
+    assert cp.parse_cmd('<@XinventoryX> add foo') is None
+
+    cmd = cp.parse_cmd('<@inventory> add foo ip:1.2.3.4 comment:"foo bar"')
+    other = cp.parse_cmd('<@inventory> list')
+    assert isinstance(cmd, DevBoxInventoryCmd)
+    assert cmd.has_cmd() and cmd.cmd == 'add'
+    assert cmd.has_machine_name() and cmd.machine_name == 'foo'
+    assert cmd.get_arg('ip') == '1.2.3.4'
+    assert cmd.get_arg('comment') == 'foo bar'
+    assert cmd.has_reminder() == False
+    assert other.cmd == 'list'
+    assert other.has_machine_name() == False
+    assert other.has_arg('ip') == False
+
+    cmd = cp.parse_cmd('<@inventory>')
+    assert cmd.has_cmd() == False
+
+    try:
+        cp.parse_cmd('<@inventory> add foo XXX')
+        assert False
+    except Exception as error:
+        assert str(error) == 'unknown argument name XXX'
+
+    cmd = cp.parse_cmd('<@inventory> add\nfoo,1.2.3.4\nbar')
+    assert cmd.cmd == 'add' and cmd.has_machine_name() == False
+    assert cmd.has_body() and cmd.body == 'foo,1.2.3.4\nbar'
+    assert cp.parse_cmd('<@inventory> add foo').has_body() == False
+
+
+def test_parse_legacy_equivalence():
+
+    def parse(parser, cmd_line):
+        try:
+            rc = parser.parse(cmd_line)
+        except Exception as error:
+            rc = str(error)
+        return (rc, parser.cmd, parser.machine_name, parser.reminder,
+                parser.get_arg('ip'), parser.get_arg('comment'))
+
+    tokens = ['<@inventory>', '<@inventory>', 'add', 'list', 'foo', 'bar', 'ip:', 'comment:', 'ip:1.2.3.4',
+              'comment:"foo bar"', '"', ':', ' ', ' ', '  ', '\t', 'x']
+    legacy = DevBoxInventoryCmdParserLegacy('inventory', ['list', 'add'], ['ip', 'comment'])
+    cp = DevBoxInventoryCmdParser('inventory', ['list', 'add'], ['ip', 'comment'])
+    rnd = random.Random(4711)
+
+    for _ in range(5000):
+        cmd_line = ''.join(rnd.choice(tokens) for _ in range(rnd.randint(0, 12)))
+        if rnd.random() < 0.7:
+            cmd_line = '<@inventory> ' + cmd_line
+        assert parse(cp, cmd_line) == parse(legacy, cmd_line), repr(cmd_line)
+
+
+def test_inventory_box_lookup(tmpdir):
+
+    inv = DevBoxInventory(str(tmpdir.join('inventory')))
+
+    assert inv.box_add('foo', ip='1.2.3.4') == 1
+    assert inv.box_add('bar') == 1
+    assert inv.box_add('foo') == 0
+    assert list(inv.box_names()) == ['foo', 'bar']
+
+    assert inv.box_data_get('foo') == ('foo', '1.2.3.4', None, None)
+    assert inv.box_data_get('baz') == (None, None, None, None)
+
+    assert inv.box_data_set('bar', user='hecke') == 1
+    assert inv.box_data_set('baz', user='hecke') == 0
+    assert inv.box_data_get('bar') == ('bar', None, 'hecke', None)
+
+    assert inv.box_del('foo') == 1
+    assert inv.box_del('foo') == 0
+    assert list(inv.box_names()) == ['bar']
+
+    inv = DevBoxInventory(str(tmpdir.join('inventory')))
+    assert list(inv.box_names()) == ['bar']
+    assert inv.box_data_get('bar') == ('bar', None, 'hecke', None)
+
+
+def test_inventory_migrate_list_file(tmpdir):
+
+    inv_file = tmpdir.join('inventory')
+    with open(str(inv_file), 'wb') as f:
+        pickle.dump([DevBox('foo'), DevBox('bar', user='hecke')], f)
+
+    inv = DevBoxInventory(str(inv_file))
+    assert list(inv.box_names()) == ['foo', 'bar']
+    assert inv.box_data_get('bar') == ('bar', None, 'hecke', None)
+
+    with open(str(inv_file), 'rb') as f:
+        assert not isinstance(pickle.load(f), list)
+
+
+def test_inventory_journal(tmpdir):
+
+    inv_file = str(tmpdir.join('inventory'))
+
+    inv = DevBoxInventory(inv_file, journal_size=3)
+    for i in range(10):
+        inv.box_add('box{0}'.format(i))
+    inv.box_data_set('box1', user='hecke', comment='foo')
+    inv.box_del('box2')
+    inv.close()
+
+    inv = DevBoxInventory(inv_file, journal_size=3)
+    assert len(list(inv.box_names())) == 9
+    assert 'box2' not in inv.box_names()
+    assert inv.box_data_get('box1') == ('box1', None, 'hecke', 'foo')
+    inv.close()
+
+    # an incomplete record at the end of the journal is dropped
+    with open(inv_file + '.journal', 'ab') as journal:
+        journal.write(pickle.dumps(('del', 'box3'))[:-2])
+    inv = DevBoxInventory(inv_file, journal_size=3)
+    assert len(list(inv.box_names())) == 9
+    assert not os.path.exists(inv_file + '.journal')
+
+    # changes made after the torn record was dropped are replayed
+    inv.box_del('box4')
+    inv.close()
+    inv = DevBoxInventory(inv_file, journal_size=3)
+    assert len(list(inv.box_names())) == 8
+    assert 'box4' not in inv.box_names()
+
+
+def test_inventory_box_datas_apply(tmpdir):
+
+    for storage_type in ('pickle', 'snapshot'):
+        inv_file = str(tmpdir.join('inventory-{0}'.format(storage_type)))
+        inv = DevBoxInventory(inv_file, storage=storage_create(storage_type, inv_file))
+        inv.box_add('foo')
+        applying = Event()
+        done = []
+
+        def func(box_datas):
+            applying.set()
+            sleep(0.2)
+            done.append('apply')
+            return [box_data[2] for box_data in box_datas]
+
+        def take():
+            applying.wait(5)
+            inv.box_data_set('foo', user='hecke')
+            done.append('take')
+
+        # no box is changed while func runs - not even by other threads of a storage that is not shared
+        taker = Thread(target=take)
+        taker.start()
+        assert inv.box_datas_apply(func) == [None]
+        taker.join(5)
+        assert done == ['apply', 'take']
+        inv.close()
+
+
+def test_inventory_snapshot(tmpdir):
+
+    inv_file = str(tmpdir.join('inventory'))
+    boxes = OrderedDict((name, DevBox(name, user=user)) for name, user in (('foo', 'hecke'), (u'b\xe4r', None),
+                                                                          ('baz', None)))
+    boxes['baz'].lease = (1.0, 'C1')
+    with open(inv_file, 'wb') as snapshot_file:
+        snapshot_file.write(snapshot_dumps(boxes))
+
+    snapshot = DevBoxInventorySnapshot(inv_file, DevBox)
+    assert len(snapshot) == 3
+    assert list(snapshot) == ['foo', u'b\xe4r', 'baz']
+    assert snapshot.get('missing') is None
+    assert 'foo' in snapshot and not snapshot._decoded
+    assert [box.name for box in snapshot.leases()] == ['baz'] and not snapshot._decoded
+    assert [box.user for box in snapshot.values()] == ['hecke', None, None]
+    assert len(snapshot._decoded) == 3
+    assert snapshot['baz'].lease == (1.0, 'C1')
+    assert snapshot['baz'] is snapshot['baz']
+    snapshot['baz'].user = 'other'
+    snapshot.changed('baz')
+    assert snapshot.pop('foo').user == 'hecke'
+    snapshot['foo'] = DevBox('foo')
+    snapshot['new'] = DevBox('new')
+    assert list(snapshot) == [u'b\xe4r', 'baz', 'foo', 'new']
+    snapshot['new'].lease = (2.0, 'C2')
+    assert [box.user for box in snapshot.values()] == [None, 'other', None, None]
+    assert sorted(box.name for box in snapshot.leases()) == ['baz', 'new']
+    with open(inv_file + '.new', 'wb') as snapshot_file:
+        snapshot_file.write(snapshot.dumps())
+    snapshot.close()
+    snapshot = DevBoxInventorySnapshot(inv_file + '.new', DevBox)
+    assert [(box.name, box.user) for box in snapshot.values()] == \
+        [(u'b\xe4r', None), ('baz', 'other'), ('foo', None), ('new', None)]
+    assert sorted(box.name for box in snapshot.leases()) == ['baz', 'new']
+
+    # version 1 files have no lease table - their leases are found by reading all boxes
+    data = snapshot_dumps(boxes)
+    with open(inv_file + '.v1', 'wb') as snapshot_file:
+        snapshot_file.write(data[:8] + struct.pack('<I', 1) + data[12:])
+    snapshot = DevBoxInventorySnapshot(inv_file + '.v1', DevBox)
+    assert [box.name for box in snapshot.leases()] == ['baz']
+    assert [box.name for box in DevBoxInventorySnapshot(inv_file + '.v1', DevBox).values()] == \
+        ['foo', u'b\xe4r', 'baz']
+
+    for journal_size in (0, 3):
+        inv_file = str(tmpdir.join('inventory-{0}'.format(journal_size)))
+        inv = DevBoxInventory(inv_file, storage=storage_create('snapshot', inv_file, journal_size))
+        for i in range(10):
+            inv.box_add('box{0}'.format(i))
+        inv.box_data_set('box1', user='hecke', comment='foo', lease=(1.0, 'C1'))
+        inv.box_del('box2')
+        inv.close()
+
+        inv = DevBoxInventory(inv_file, storage=storage_create('snapshot', inv_file, journal_size))
+        assert len(inv) == 9
+        # the leases are read from the lease table - the boxes are decoded once by the first query reading all
+        decoded = set(inv._inventory._decoded)
+        assert inv.box_leases() == [('box1', 'hecke', 1.0, 'C1')]
+        assert set(inv._inventory._decoded) == decoded
+        assert len(inv.box_datas()) == 9
+        assert len(inv._inventory._decoded) + len(inv._inventory._added) == 9 and inv._inventory._names is not None
+        assert inv.box_data_get('box1') == ('box1', None, 'hecke', 'foo')
+        assert inv.box_leases() == [('box1', 'hecke', 1.0, 'C1')]
+        assert [box[0] for box in inv.box_datas_by_user('hecke')] == ['box1']
+        assert [box[0] for box in inv.box_datas_filter(DevBoxFilter.compile('box*'))][:3] == ['box0', 'box1', 'box3']
+        inv.close()
+
+    # pickle inventory files are converted by DevBoxInventorySnapshot.py - the snapshot storage does not read them
+    inv_file = str(tmpdir.join('inventory-pickle'))
+    DevBoxInventory(inv_file).box_add('foo')
+    try:
+        storage_create('snapshot', inv_file).load(DevBox, RLock())
+        assert False
+    except Exception as e:
+        assert 'no inventory snapshot' in str(e)
+    storage = DevBoxInventoryPickleStorage(inv_file)
+    with open(inv_file + '.snapshot', 'wb') as snapshot_file:
+        snapshot_file.write(snapshot_dumps(storage.load(DevBox, RLock())))
+    assert list(DevBoxInventorySnapshot(inv_file + '.snapshot', DevBox)) == ['foo']
+
+
+def test_inventory_group_commit(tmpdir):
+
+    inv_file = str(tmpdir.join('inventory'))
+    inv = DevBoxInventory(inv_file, commit_window=50)
+
+    writes = []
+    write_snapshot = inv._storage._write_snapshot
+
+    def counting_write_snapshot(data):
+        writes.append(data)
+        write_snapshot(data)
+
+    inv._storage._write_snapshot = counting_write_snapshot
+
+    threads = [Thread(target=inv.box_add, args=('box{0}'.format(i),)) for i in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert 0 < len(writes) < 20
+    assert not tmpdir.join('inventory.tmp').check()
+    assert len(list(DevBoxInventory(inv_file).box_names())) == 20
+
+
+def test_inventory_sqlite_storage(tmpdir):
+
+    db_file = str(tmpdir.join('inventory.db'))
+
+    inv = DevBoxInventory(db_file, storage=DevBoxInventorySqliteStorage(db_file))
+    for name in ('foo', 'bar', 'baz'):
+        inv.box_add(name)
+    inv.box_data_set('baz', user='hecke', comment='foo bar')
+    inv.box_data_set('foo', user='hecke')
+    inv.box_del('bar')
+    assert [box[0] for box in inv.box_datas_by_user('hecke')] == ['foo', 'baz']
+    inv.close()
+
+    inv = DevBoxInventory(db_file, storage=DevBoxInventorySqliteStorage(db_file))
+    assert list(inv.box_names()) == ['foo', 'baz']
+    assert inv.box_data_get('baz') == ('baz', None, 'hecke', 'foo bar')
+    assert inv.box_datas_by_user('nobody') == []
+    assert [box[0] for box in inv.box_datas_by_user('hecke')] == ['foo', 'baz']
+    inv.box_data_set('foo', ip='10.0.0.1')
+    assert [box[0] for box in inv.box_datas_by_ip('10.0.0.1')] == ['foo']
+    assert [box[0] for box in inv.box_datas_filter(DevBoxFilter.compile('b*', owner='hecke'))] == ['baz']
+    # owner and ip queries are answered by the indexes of the database, the inventory does not build its own
+    assert inv._position is None
+    assert set(row[0] for row in inv._storage._db.execute("SELECT name FROM sqlite_master WHERE type = 'index'")) >= \
+        set(['boxes_user', 'boxes_ip'])
+    inv.close()
+
+
+def _shared_boxes_add(storage_type, inventory_file, prefix, count):
+
+    inv = DevBoxInventory(inventory_file, storage=storage_create(storage_type, inventory_file, shared=True))
+    for idx in range(count):
+        inv.box_add('{0}{1}'.format(prefix, idx))
+    inv.close()
+
+
+def test_inventory_shared(tmpdir):
+
+    for storage_type in ('pickle', 'sqlite'):
+        inventory_file = str(tmpdir.join('inventory.{0}'.format(storage_type)))
+        inv = DevBoxInventory(inventory_file, storage=storage_create(storage_type, inventory_file, shared=True))
+        other = DevBoxInventory(inventory_file, storage=storage_create(storage_type, inventory_file, shared=True))
+
+        assert inv.box_add('foo') == 1
+        version = other.version
+        assert other.box_names() == ['foo']
+        assert other.box_add('foo') == 0
+
+        box_data = other.box_data_get('foo')
+        assert inv.box_data_set('foo', user='hecke', expected=box_data) == 1
+        assert other.version > version
+        try:
+            other.box_data_set('foo', user='tester', expected=box_data)
+            assert False
+        except DevBoxInventoryConflict:
+            pass
+        assert other.box_data_get('foo') == ('foo', None, 'hecke', None)
+        assert [box[0] for box in other.box_datas_by_user('hecke')] == ['foo']
+
+        # concurrent writers must not lose each others changes
+        writers = [Process(target=_shared_boxes_add, args=(storage_type, inventory_file, prefix, 20))
+                   for prefix in ('a', 'b', 'c')]
+        for writer in writers:
+            writer.start()
+        for writer in writers:
+            writer.join()
+        assert len(inv.box_names()) == 61
+        assert len(other.box_datas_free()) == 60
+        inv.close()
+        other.close()
+
+    try:
+        storage_create('pickle', inventory_file, journal_size=10, shared=True)
+        assert False
+    except Exception as error:
+        assert str(error) == 'a shared inventory file can not use a journal'
+
+
+def test_inventory_leases(tmpdir):
+
+    assert lease_parse('4h') == 4 * 60 * 60
+    assert lease_parse('30m') == 30 * 60
+    assert lease_parse('2') == 2 * 60 * 60
+    assert lease_parse('1d') == 24 * 60 * 60
+    assert lease_parse('0h') is None
+    assert lease_parse('4w') is None
+
+    for storage_type, journal_size in (('pickle', 0), ('pickle', 10), ('sqlite', 0)):
+        inventory_file = str(tmpdir.join('inventory-{0}-{1}'.format(storage_type, journal_size)))
+        inv = DevBoxInventory(inventory_file, storage=storage_create(storage_type, inventory_file, journal_size))
+        for name in ('foo', 'bar', 'baz'):
+            inv.box_add(name)
+        inv.box_data_set('foo', user='hecke', lease=(100.0, 'C1'))
+        inv.box_data_set('bar', user='hecke', lease=(200.0, 'C2'))
+        inv.box_data_set('bar', user='other')
+        inv.close()
+
+        inv = DevBoxInventory(inventory_file, storage=storage_create(storage_type, inventory_file, journal_size))
+        assert inv.box_leases() == [('foo', 'hecke', 100.0, 'C1')]
+        assert inv.box_lease_get('bar') is None
+        assert inv.box_lease_expire('foo', 50.0) is None
+        assert inv.box_lease_expire('foo', 100.0) == 'hecke'
+        assert inv.box_data_get('foo') == ('foo', None, '', None)
+        assert inv.box_leases() == []
+        inv.close()
+
+    inv = DevBoxInventory(str(tmpdir.join('inventory')))
+    for name in ('foo', 'bar', 'baz'):
+        inv.box_add(name)
+    now = time()
+    inv.box_data_set('foo', user='hecke', lease=(now + 0.4, 'C1'))
+    inv.box_data_set('bar', user='hecke', lease=(now + 0.3, 'C2'))
+    inv.box_data_set('baz', user='hecke', lease=(now - 1, 'C3'))
+
+    events = []
+    leases = DevBoxInventoryLeases(inv, lambda *args: events.append(('remind',) + args),
+                                   lambda *args: events.append(('expire',) + args), remind_before=0.2)
+    assert leases.rebuild() == 3
+    # bar is put before its lease ends - its events are dropped
+    inv.box_data_set('bar', user='')
+    # the lease of foo is extended
+    inv.box_data_set('foo', lease=(now + 0.6, 'C1'))
+    leases.schedule('foo', now + 0.6)
+
+    sleep(0.8)
+    leases.close()
+    assert events == [('expire', 'baz', 'hecke', now - 1, 'C3'),
+                      ('remind', 'foo', 'hecke', now + 0.6, 'C1'),
+                      ('expire', 'foo', 'hecke', now + 0.6, 'C1')]
+    assert inv.box_data_get('foo') == ('foo', None, '', None)
+
+
+def test_inventory_history(tmpdir):
+
+    history_dir = str(tmpdir.join('inventory.history'))
+    inv = DevBoxInventory(str(tmpdir.join('inventory')), history=DevBoxInventoryHistory(history_dir, 200))
+    for name in ('foo', 'bar'):
+        inv.box_add(name)
+    inv.box_data_set('foo', user='hecke')
+    inv.box_data_set('foo', comment='no change of the owner')
+    inv.box_data_set('foo', user='other')
+    inv.box_data_set('foo', user='')
+    for idx in range(10):
+        inv.box_data_set('bar', user='user{0}'.format(idx))
+    inv.box_del('bar')
+    inv.close()
+
+    history = DevBoxInventoryHistory(history_dir, 200)
+    assert len([file_name for file_name in tmpdir.join('inventory.history').listdir() if file_name.ext == '.log']) > 1
+    assert [event[1:] for event in history.events('foo')] == [('take', 'hecke', ''),
+                                                             ('occupy', 'other', 'hecke'),
+                                                             ('put', '', 'other')]
+    events = history.events('bar')
+    assert [event[1] for event in events] == ['take'] + ['occupy'] * 9 + ['del']
+    assert [event[1:] for event in history.events('bar', limit=2)] == [('occupy', 'user9', 'user8'),
+                                                                       ('del', '', 'user9')]
+    assert history.events('bar', since=events[5][0]) == [event for event in events if event[0] >= events[5][0]]
+    assert history.events('bar', since=events[-1][0] + 1) == []
+    assert history.events('baz') == []
+
+    # a second writer sharing the history
+    other = DevBoxInventoryHistory(history_dir, 200)
+    other.record('take', 'foo', 'hecke', '')
+    assert history.events('foo', limit=1)[0][1:] == ('take', 'hecke', '')
+    other.close()
+    history.close()
+
+
+def test_inventory_stats(tmpdir):
+
+    stats_file = str(tmpdir.join('inventory.stats'))
+    now = 1000 * DAY
+    stats = DevBoxInventoryStats(stats_file)
+    # foo held by hecke over midnight, then occupied by other
+    stats.owner_changed('foo', '', 'hecke', now - DAY - 60 * 60)
+    stats.owner_changed('foo', 'hecke', 'other', now + 60 * 60)
+    stats.owner_changed('foo', 'other', '', now + 2 * 60 * 60)
+    stats.owner_changed('bar', '', 'hecke', now + 3 * 60 * 60)
+    stats.close()
+
+    stats = DevBoxInventoryStats(stats_file)
+    box_rows, user_rows = stats.report(1, now + 4 * 60 * 60)
+    assert box_rows == [('foo', 0.5, 2, (DAY + 3 * 60 * 60) / 2.0, 1), ('bar', 0.25, 0, None, 0)]
+    assert user_rows == [('hecke', 2 * 60 * 60.0, 1, 0), ('other', 60 * 60.0, 1, 1)]
+    box_rows, user_rows = stats.report(2, now + 4 * 60 * 60)
+    assert user_rows[0] == ('hecke', DAY + 2 * 60 * 60.0, 1, 0)
+
+    # boxes put while nobody was counting
+    stats.sync([('foo', None, '', None, None), ('bar', None, '', None, None)])
+    assert stats.report(1)[1][0][0] == 'hecke'
+    assert not stats._holds
+    stats.close()
+
+
+def test_inventory_stats_journal(tmpdir):
+
+    stats_file = str(tmpdir.join('inventory.stats'))
+    now = time()
+    # two bots sharing an inventory - each change is counted once by both of them
+    first = DevBoxInventoryStats(stats_file)
+    second = DevBoxInventoryStats(stats_file)
+    assert not first.counting
+    first.owner_changed('foo', '', 'hecke', now - 60)
+    assert second.counting
+    second.owner_changed('foo', 'hecke', 'other', now - 30)
+    first.owner_changed('bar', '', 'hecke', now - 20)
+    assert first.report(1, now) == second.report(1, now)
+    assert first.report(1, now)[1] == [('hecke', 50.0, 1, 0), ('other', 30.0, 0, 1)]
+
+    # the aggregates are written and a new journal is started - the other bot picks them up
+    second.save_interval = 0
+    second.box_deleted('bar', now - 10)
+    assert not os.path.exists(stats_file + '.1.journal')
+    first.owner_changed('foo', 'other', '', now - 5)
+    assert os.path.exists(stats_file + '.2.journal')
+    assert first.report(1, now) == second.report(1, now)
+
+    # changes not written to the aggregates survive a crash - they are replayed from the journal
+    report = first.report(1, now)
+    assert DevBoxInventoryStats(stats_file).report(1, now) == report
+
+
+def test_inventory_stats_commit(tmpdir):
+
+    inv_file = str(tmpdir.join('inventory'))
+    stats = DevBoxInventoryStats(inv_file + '.stats')
+    inv = DevBoxInventory(inv_file, stats=stats)
+    inv.box_add('foo')
+    inv.box_add('bar')
+    inv.box_data_set('foo', user='hecke')
+    assert [row[0] for row in stats.report(1)[1]] == ['hecke']
+
+    # the stats learn about a change only once it was committed
+    sync = inv._storage._sync
+
+    def sync_fail():
+        raise IOError('disk full')
+
+    inv._storage._sync = sync_fail
+    try:
+        inv.box_data_set('bar', user='other')
+        assert False
+    except IOError:
+        pass
+    assert [row[0] for row in stats.report(1)[1]] == ['hecke']
+
+    # the journal of the stats is synced by the writes of the storage - no sync of its own per change
+    syncs = []
+    inv._storage._sync = lambda: syncs.append('storage') or sync()
+    assert inv._storage._sync_funcs == [stats.commit]
+    inv._storage._sync_funcs[:] = [lambda: syncs.append('stats') or stats.commit()]
+    inv.box_data_set('foo', user='')
+    assert syncs == ['storage', 'stats']
+    assert [row[0] for row in stats.report(1)[1]] == ['hecke']
+    inv.close()
+
+
+def test_boxes_parse():
+
+    assert boxes_parse('```name,comment\nfoo, "a, b"\n\nbar```') == [('foo', None, 'a, b'), ('bar', None, None)]
+    assert boxes_parse('foo,1.2.3.4\nbar,,x &amp; y') == [('foo', '1.2.3.4', None), ('bar', None, 'x & y')]
+
+    for text, error in (('', 'no boxes given'),
+                        ('foo\nfoo', 'box foo is given twice'),
+                        ('lab-*', 'box name lab-* contains wildcards'),
+                        ('name,owner\nfoo,bar', 'unknown column owner'),
+                        ('foo,1.2.3.4,bar,baz', 'row 1 has more than 3 columns'),
+                        ('"foo bar"', 'invalid box name "foo bar"')):
+        try:
+            boxes_parse(text)
+            assert False
+        except ValueError as e:
+            assert str(e) == error
+
+
+def test_inventory_bulk(tmpdir):
+
+    inv = DevBoxInventory(str(tmpdir.join('inventory')))
+    saved = []
+    save = inv._storage._save
+    inv._storage._save = lambda: saved.append(save())
+
+    assert inv.box_add_many([('foo', None, None, None), ('bar', '1.2.3.4', None, 'x'), ('baz', None, None, None)]) == []
+    assert len(saved) == 1
+    assert inv.box_add_many([('qux', None, None, None), ('foo', None, None, None)]) == ['foo']
+    assert inv.box_names() == ['foo', 'bar', 'baz']
+    assert len(saved) == 1
+
+    changes = [(name, None, 'hecke', None, inv.box_data_get(name)) for name in ('foo', 'bar')]
+    assert inv.box_data_set_many(changes) == 2
+    assert len(saved) == 2
+    assert [box[0] for box in inv.box_datas_by_user('hecke')] == ['foo', 'bar']
+
+    # all or nothing
+    assert inv.box_data_set_many([('baz', None, 'tester', None, None), ('qux', None, 'tester', None, None)]) == 0
+    try:
+        inv.box_data_set_many([('baz', None, 'tester', None, None), ('foo', None, 'tester', None, changes[0][4])])
+        assert False
+    except DevBoxInventoryConflict:
+        pass
+    assert inv.box_datas_by_user('tester') == []
+    assert len(saved) == 2
+
+
+def test_devbox_state():
+
+    box = DevBox('foo', user=''.join(['hec', 'ke']))
+    other = DevBox('bar')
+    other.user = ''.join(['he', 'cke'])
+    assert box.user is other.user
+
+    box = pickle.loads(pickle.dumps(DevBox('foo', '1.2.3.4', 'hecke', 'bar', 1.0), 0))
+    assert (box.name, box.ip, box.user, box.comment, box.taken_timestamp) == ('foo', '1.2.3.4', 'hecke', 'bar', 1.0)
+
+    # state of boxes pickled by v0.2
+    box = DevBox.__new__(DevBox)
+    box.__setstate__({'_name': 'foo', '_ip': None, '_user': 'hecke', '_comment': None, '_taken_timestamp': 1.0})
+    assert (box.name, box.ip, box.user, box.comment, box.taken_timestamp) == ('foo', None, 'hecke', None, 1.0)
+
+
+def test_inventory_indexes(tmpdir):
+
+    inv = DevBoxInventory(str(tmpdir.join('inventory')))
+    for name in ('foo', 'bar', 'baz', 'fum'):
+        inv.box_add(name, ip='10.0.0.1' if name != 'bar' else None)
+
+    inv.box_data_set('fum', user='hecke')
+    inv.box_data_set('foo', user='hecke')
+    inv.box_data_set('baz', user='tester', ip='10.0.0.2')
+
+    assert [box[0] for box in inv.box_datas_by_user('hecke')] == ['foo', 'fum']
+    assert [box[0] for box in inv.box_datas_by_user('tester')] == ['baz']
+    assert inv.box_datas_by_user('nobody') == []
+    assert [box[0] for box in inv.box_datas_free()] == ['bar']
+    assert [box[0] for box in inv.box_datas_by_ip('10.0.0.1')] == ['foo', 'fum']
+
+    inv.box_data_set('foo', user='')
+    inv.box_del('fum')
+    assert inv.box_datas_by_user('hecke') == []
+    assert [box[0] for box in inv.box_datas_free()] == ['foo', 'bar']
+    assert [box[0] for box in inv.box_datas_by_ip('10.0.0.1')] == ['foo']
+
+    inv = DevBoxInventory(str(tmpdir.join('inventory')))
+    assert [box[0] for box in inv.box_datas_by_user('tester')] == ['baz']
+    assert [box[0] for box in inv.box_datas_free()] == ['foo', 'bar']
+
+
+def test_inventory_filter(tmpdir):
+
+    inv = DevBoxInventory(str(tmpdir.join('inventory')))
+    inv.box_add('lab-1', ip='10.1.0.1', comment='Blues')
+    inv.box_add('lab-2', ip='10.2.0.1')
+    inv.box_add('lab-10', ip='10.1.7.3', comment='the blues brothers')
+    inv.box_add('dev-1', ip='fe80::1')
+    inv.box_add('lab')
+    inv.box_data_set('lab-10', user='hecke')
+
+    def names(**kwargs):
+        return [box[0] for box in inv.box_datas_filter(DevBoxFilter.compile(**kwargs))]
+
+    assert names(pattern='lab-*') == ['lab-1', 'lab-2', 'lab-10']
+    assert names(pattern='lab-?') == ['lab-1', 'lab-2']
+    assert names(pattern='*-1') == ['lab-1', 'dev-1']
+    assert names(pattern='lab') == ['lab']
+    assert names(pattern='lab-*', ip='10.1.0.0/16') == ['lab-1', 'lab-10']
+    assert names(ip='10.1.0.1') == ['lab-1']
+    assert names(ip='fe80::/64') == ['dev-1']
+    assert names(comment='BLUES') == ['lab-1', 'lab-10']
+    assert names(owner='hecke') == ['lab-10']
+    assert names(pattern='lab-*', owner='') == ['lab-1', 'lab-2']
+
+    assert DevBoxFilter.compile(pattern='lab-*') is DevBoxFilter.compile(pattern='lab-*')
+    assert DevBoxFilter.compile().is_empty()
+
+    try:
+        DevBoxFilter('*', ip='10.0.0.0/33')
+        assert False
+    except Exception as error:
+        assert str(error) == 'invalid network 10.0.0.0/33'
+
+
+def test_renderer_chunks():
+
+    renderer = DevBoxInventoryRenderer(max_size=1000)
+    box_datas = [('box{0}'.format(i), None, None, 'x' * (i % 30), None) for i in range(200)]
+
+    chunks = list(renderer.chunks(renderer.rows(box_datas)))
+    assert len(chunks) > 1
+    assert all(len(chunk) <= 1000 for chunk in chunks)
+    assert all(chunk.startswith(u'```\n' + renderer.header) and chunk.endswith(u'```') for chunk in chunks)
+    assert u''.join(chunk[len(u'```\n' + renderer.header):-len(u'```')] for chunk in chunks) == \
+        u''.join(renderer.rows(box_datas))
+
+    assert list(renderer.chunks(renderer.rows([]))) == []
+
+    # pages behind the ones asked for are not rendered
+    rendered = []
+    renderer.row = lambda *box_data: rendered.append(box_data[0]) or DevBoxInventoryRenderer.row(renderer, *box_data)
+    pages, number, rows_left = renderer.pages(box_datas, 2, 2)
+    assert pages == chunks[1:3] and number == 3
+    # the first row of the next page is rendered to find the end of the last one
+    assert len(rendered) == len(box_datas) - rows_left + 1
+    assert renderer.pages_estimate(number, rows_left, len(box_datas) - rows_left) in range(len(chunks) - 4,
+                                                                                         len(chunks) - 1)
+    assert renderer.pages(box_datas, len(chunks) + 1) == ([], len(chunks), 0)
+    assert renderer.pages_estimate(3, 0, 100) == 0
+
+
+def test_renderer_cache(tmpdir):
+
+    inv = DevBoxInventory(str(tmpdir.join('inventory')))
+    version = inv.version
+    inv.box_add('foo')
+    inv.box_add('bar')
+    inv.box_data_set('bar', user='hecke')
+    inv.box_data_set('baz', user='hecke')
+    inv.box_del('foo')
+    assert inv.version == version + 4
+
+    renderer = DevBoxInventoryRenderer()
+    row = renderer.row('foo', None, 'hecke', None, 1.0)
+    assert renderer.row('foo', None, 'hecke', None, 1.0) is row
+    assert renderer.row('foo', None, 'hecke', 'bar', 1.0) is not row
+
+    renderer.output_put(1, 'show', ['foo'])
+    assert renderer.output_get(1, 'show') == ['foo']
+    assert renderer.output_get(1, 'show free') is None
+    assert renderer.output_get(2, 'show') is None
+    renderer.output_put(2, 'show free', ['bar'])
+    assert renderer.output_get(1, 'show') is None
+
+
+def test_outbox():
+
+    class Response(object):
+        def __init__(self, status_code, result, headers=None):
+            self.status_code = status_code
+            self.headers = headers or {}
+            self._result = result
+
+        def json(self):
+            return self._result
+
+    class Requester(object):
+        def __init__(self):
+            self.posted = []
+
+        def do(self, token, request, post_data):
+            if not self.posted:
+                # rate limit the first call
+                self.posted.append(None)
+                return Response(429, {}, {'Retry-After': '0.1'})
+            self.posted.append((post_data['channel'], post_data['text']))
+            return Response(200, {'ok': True})
+
+    class Server(object):
+        api_requester = Requester()
+
+    class SlackClient(object):
+        token = 'token'
+        server = Server()
+
+    outbox = DevBoxInventoryOutbox(SlackClient())
+    with outbox._cond:
+        # keep the workers waiting until all messages are queued
+        outbox.put('C1', 'foo')
+        outbox.put('C1', 'bar')
+        outbox.put('C2', 'baz')
+        assert outbox.depth == 3
+    outbox.close()
+
+    posted = SlackClient.server.api_requester.posted
+    assert posted[0] is None
+    assert sorted(posted[1:]) == [('C1', 'foo\nbar'), ('C2', 'baz')]
+    stats = outbox.stats()
+    assert stats['depth'] == 0 and stats['sent'] == 2 and stats['merged'] == 1 and stats['retried'] == 1
+
+
+def test_user_directory(tmpdir):
+
+    class SlackClient(object):
+        def __init__(self):
+            self.calls = []
+
+        def api_call(self, method, **kwargs):
+            self.calls.append(method)
+            if method == 'users.list':
+                if kwargs.get('cursor') == 'page2':
+                    return {'ok': True, 'members': [{'id': 'U2', 'name': 'tester'}]}
+                return {'ok': True, 'members': [{'id': 'U1', 'name': 'hecke'}],
+                        'response_metadata': {'next_cursor': 'page2'}}
+            if method == 'users.info':
+                return {'ok': True, 'user': {'id': kwargs['user'], 'name': 'newbie'}}
+
+    cache_file = str(tmpdir.join('users'))
+
+    client = SlackClient()
+    users = DevBoxInventoryUserDirectory(client, cache_file)
+    assert users.load() == 2
+    assert client.calls == ['users.list', 'users.list']
+    assert users.name_by_id('U1') == 'hecke'
+    assert users.id_by_name('tester') == 'U2'
+
+    assert users.name_by_id('U3') == 'newbie'
+    assert users.handle_event({'type': 'user_change', 'user': {'id': 'U1', 'name': 'hecke2'}})
+    assert not users.handle_event({'type': 'message', 'text': 'foo'})
+    assert users.name_by_id('U1') == 'hecke2'
+    assert users.id_by_name('hecke') is None
+    # single changes are written on close - not for every event
+    with open(cache_file) as cache:
+        assert 'hecke2' not in cache.read()
+    users.close()
+
+    # warm start from the cache file
+    client = SlackClient()
+    users = DevBoxInventoryUserDirectory(client, cache_file)
+    assert users.load() == 3
+    assert client.calls == []
+    assert users.name_by_id('U1') == 'hecke2'
+
+    users.expire()
+    users = DevBoxInventoryUserDirectory(client, cache_file)
+    users.load()
+    assert client.calls == ['users.list', 'users.list']
+
+
+def test_fake_slack(tmpdir):
+
+    fake = DevBoxInventoryFakeSlack({'U0': 'inventory', 'U1': 'hecke'}).start()
+    bot = DevBoxInventorySlackBot('inventory', 'xoxb-fake', str(tmpdir.join('inventory')), workers=0,
+                                  api_url=fake.api_url)
+    bot.inventory.box_add('foo')
+    bot.poll_interval = 0.01
+    runner = Thread(target=bot.run)
+    runner.start()
+
+    try:
+        while not fake.connections:
+            sleep(0.01)
+        # an unknown command is answered and does not stop the bot
+        fake.send_event({'type': 'message', 'channel': 'C1', 'user': 'U1', 'text': '<@U0> bogus'})
+        _, channel, text = fake.posts.get(timeout=5)
+        assert channel == 'C1'
+        assert text.startswith('*ERROR*: _unknown command bogus_.')
+
+        fake.send_event({'type': 'message', 'channel': 'C1', 'user': 'U1', 'text': '<@U0> take foo'})
+        fake.send_event({'type': 'message', 'channel': 'C1', 'user': 'U1', 'text': '<@U0> show'})
+
+        # the outbox may merge both replies into one post
+        _, channel, text = fake.posts.get(timeout=5)
+        assert channel == 'C1'
+        assert text.startswith('Box *foo* now in use by *hecke*.')
+        if 'foo                      hecke' not in text:
+            text = fake.posts.get(timeout=5)[2]
+        assert 'foo                      hecke' in text
+        assert bot.inventory.box_data_get('foo')[2] == 'hecke'
+    finally:
+        bot._running = False
+        runner.join(5)
+        fake.stop()
+
+
+def test_fake_slack_workers(tmpdir):
+
+    fake = DevBoxInventoryFakeSlack({'U0': 'inventory', 'U1': 'hecke'}).start()
+    bot = DevBoxInventorySlackBot('inventory', 'xoxb-fake', str(tmpdir.join('inventory')), workers=1,
+                                  api_url=fake.api_url)
+    bot.inventory.box_add('foo')
+    bot.poll_interval = 0.01
+    runner = Thread(target=bot.run)
+    runner.start()
+
+    try:
+        while not fake.connections:
+            sleep(0.01)
+        # a command failing in the worker is answered and the worker keeps serving the next ones
+        for _ in range(2):
+            fake.send_event({'type': 'message', 'channel': 'C1', 'user': 'U1', 'text': '<@U0> show ip:10.0.0.0/33'})
+            _, channel, text = fake.posts.get(timeout=5)
+            assert channel == 'C1'
+            assert text.startswith('*ERROR*: _invalid network 10.0.0.0/33_.')
+
+        fake.send_event({'type': 'message', 'channel': 'C1', 'user': 'U1', 'text': '<@U0> take foo'})
+        assert fake.posts.get(timeout=5)[2].startswith('Box *foo* now in use by *hecke*.')
+
+        # a pattern holds the locks of all boxes matching it - the lock of the box and of the pattern may differ
+        bot.inventory.box_add('fum')
+        stripes = set(hash(name) % bot.box_locks for name in ('foo', 'fum'))
+        with bot._boxes_locked(DevBoxInventoryCmd('put', 'f*', {}, None)):
+            assert [idx for idx, lock in enumerate(bot._box_locks) if lock.locked()] == sorted(stripes)
+        assert not any(lock.locked() for lock in bot._box_locks)
+    finally:
+        bot._running = False
+        runner.join(5)
+        fake.stop()
+
+
+def test_metrics():
+
+    registry = DevBoxInventoryMetrics()
+    registry.inc('inventory_commands_total', cmd='take', result='ok')
+    registry.inc('inventory_commands_total', cmd='take', result='ok')
+    for seconds in (0.002, 0.003, 0.02, 3.0):
+        registry.observe('inventory_command_seconds', seconds, cmd='take')
+    with registry.timer('inventory_dispatch_seconds'):
+        pass
+    registry.gauge('inventory_boxes', lambda: 42)
+
+    assert registry.percentile('inventory_command_seconds', 50, cmd='take') == 0.005
+    assert registry.percentile('inventory_command_seconds', 99, cmd='take') == 5.0
+    assert registry.percentile('inventory_command_seconds', 50, cmd='put') is None
+
+    text = registry.render()
+    assert '# TYPE inventory_commands_total counter' in text
+    assert 'inventory_commands_total{cmd="take",result="ok"} 2' in text
+    assert 'inventory_command_seconds_bucket{cmd="take",le="0.005"} 2' in text
+    assert 'inventory_command_seconds_bucket{cmd="take",le="+Inf"} 4' in text
+    assert 'inventory_command_seconds_count{cmd="take"} 4' in text
+    assert 'inventory_dispatch_seconds_count 1' in text
+    assert 'inventory_boxes 42' in text
+    assert 'inventory_command_seconds{cmd="take"}' in registry.summary()
+
+    server = DevBoxInventoryMetricsServer(0, registry=registry)
+    try:
+        response = requests.get('http://127.0.0.1:{0}/metrics'.format(server.port))
+        assert response.status_code == 200
+        assert response.text == registry.render()
+    finally:
+        server.close()
+
+
+def test_profiler():
+
+    def busy(count):
+        return sum(range(count))
+
+    profiler = DevBoxInventoryProfiler()
+    results = []
+    assert profiler.call(busy, 10) == 45
+    assert profiler.start(0.2, lambda stats, calls: results.append((stats, calls)))
+    assert not profiler.start(0.2, lambda stats, calls: None)
+
+    assert profiler.call(busy, 1000) == 499500
+    worker = Thread(target=profiler.call, args=(profiler.call, busy, 10))
+    worker.start()
+    worker.join()
+
+    while not results:
+        sleep(0.01)
+    stats, calls = results[0]
+    assert calls == 2
+    assert not profiler.active
+    assert [key for key in stats.stats if key[2] == 'busy'][0]
+    assert 'busy' in profile_summary(stats)
+
+    # overlapping calls of several threads share the profiler of the window
+    def slow(count):
+        sleep(0.01)
+        return busy(count)
+
+    results = []
+    assert profiler.start(0.5, lambda stats, calls: results.append((stats, calls)))
+    returned = []
+    workers = [Thread(target=lambda: returned.append(profiler.call(slow, 10))) for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert returned == [45] * 4
+
+    while not results:
+        sleep(0.01)
+    assert results[0][1] == 4
+    assert [key for key in results[0][0].stats if key[2] == 'slow'][0]
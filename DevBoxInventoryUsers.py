@@ -0,0 +1,169 @@
+"""
+directory of the slack users known to the DevBoxInventorySlackBot
+"""
+import json
+import syslog
+from os import rename
+from threading import RLock
+from time import time
+
+
+class DevBoxInventoryUserDirectory(object):
+    """
+    maps slack user ids to user names
+
+    The directory is loaded from cache_file if it is younger than ttl seconds, otherwise users.list is read page by
+    page. Afterwards it is kept up to date by the team_join and user_change events, ids not known yet or older than
+    ttl are looked up using users.info. A complete read is written to cache_file right away, single changes at most
+    every save_interval seconds and on close.
+    """
+    save_interval = 60
+
+    def __init__(self, slack_client, cache_file=None, ttl=24 * 60 * 60, page_size=200):
+
+        self._slack_client = slack_client
+        self._cache_file = cache_file
+        self._ttl = ttl
+        self._page_size = page_size
+
+        self._lock = RLock()
+        # user id -> (user name, time the entry was fetched)
+        self._users = {}
+        self._ids_by_name = {}
+        self._loaded = 0
+        self._saved = 0
+        self._dirty = False
+
+    def __len__(self):
+        return len(self._users)
+
+    def load(self):
+        """
+        fill the directory from the cache file or - if there is none or it is outdated - from slack
+        """
+        with self._lock:
+            if not self._cache_load() or self._loaded + self._ttl < time():
+                self.refresh()
+
+        return len(self._users)
+
+    def refresh(self):
+        """
+        read all users from slack
+        """
+        users = {}
+        cursor = None
+        now = time()
+
+        while True:
+            kwargs = {'limit': self._page_size}
+            if cursor:
+                kwargs['cursor'] = cursor
+            api_call = self._slack_client.api_call('users.list', **kwargs)
+            if not api_call.get('ok'):
+                syslog.syslog(syslog.LOG_ERR, 'failed to read users: {0}'.format(api_call.get('error')))
+                return False
+
+            for user in api_call.get('members', []):
+                if 'name' in user:
+                    users[user.get('id')] = (user.get('name'), now)
+
+            cursor = api_call.get('response_metadata', {}).get('next_cursor')
+            if not cursor:
+                break
+
+        with self._lock:
+            self._users = users
+            self._ids_by_name = dict((name, user_id) for user_id, (name, _) in users.items())
+            self._loaded = now
+            self._cache_save()
+
+        return True
+
+    def expire(self):
+        """
+        mark the directory as outdated so the next load reads all users from slack
+        """
+        with self._lock:
+            self._loaded = 0
+            self._cache_save()
+
+    def name_by_id(self, user_id):
+
+        with self._lock:
+            entry = self._users.get(user_id)
+
+        if entry is None or entry[1] + self._ttl < time():
+            api_call = self._slack_client.api_call('users.info', user=user_id)
+            if api_call.get('ok') and 'name' in api_call.get('user', {}):
+                self._update(api_call['user'])
+                return api_call['user']['name']
+
+        return entry[0] if entry else None
+
+    def id_by_name(self, name):
+
+        with self._lock:
+            return self._ids_by_name.get(name)
+
+    def handle_event(self, event):
+        """
+        update the directory from an RTM event - returns True if the event was a user event
+        """
+        if event.get('type') in ('team_join', 'user_change') and 'name' in event.get('user', {}):
+            self._update(event['user'])
+            return True
+
+        return False
+
+    def _update(self, user):
+
+        with self._lock:
+            old = self._users.get(user['id'])
+            if old is not None and self._ids_by_name.get(old[0]) == user['id']:
+                del self._ids_by_name[old[0]]
+            self._users[user['id']] = (user['name'], time())
+            self._ids_by_name[user['name']] = user['id']
+            # the whole directory is written - don't do that for every event
+            self._dirty = True
+            if self._saved + self.save_interval <= time():
+                self._cache_save()
+
+    def close(self):
+        """
+        write changes not saved yet to the cache file
+        """
+        with self._lock:
+            if self._dirty:
+                self._cache_save()
+
+    def _cache_load(self):
+
+        if not self._cache_file:
+            return False
+
+        try:
+            with open(self._cache_file, 'r') as cache_file:
+                cache = json.load(cache_file)
+            self._users = dict((user_id, tuple(entry)) for user_id, entry in cache['users'].items())
+            self._ids_by_name = dict((name, user_id) for user_id, (name, _) in self._users.items())
+            self._loaded = cache['loaded']
+        except (IOError, ValueError, KeyError, TypeError):
+            return False
+
+        return True
+
+    def _cache_save(self):
+
+        if not self._cache_file:
+            return
+
+        try:
+            tmp_file = '{0}.tmp'.format(self._cache_file)
+            with open(tmp_file, 'w') as cache_file:
+                json.dump({'loaded': self._loaded, 'users': self._users}, cache_file)
+            rename(tmp_file, self._cache_file)
+            self._saved = time()
+            self._dirty = False
+        except (IOError, OSError) as error:
+            syslog.syslog(syslog.LOG_WARNING, 'failed to write user cache `{0}`: {1}'.format(self._cache_file, error))